@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""
+A script that measures the latency of fetching blocks from the providers as the
+number of blocks grows, comparing fetch_blocks on a pool of workers with the
+former approach starting one thread per block and collecting the blocks in a
+dictionary proxied by a multiprocessing.Manager.
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import time
+
+import numpy
+
+from pyproxy.metadata import MetaBlock
+from pyproxy.providers.dispatcher import BlockFetcher, fetch_blocks
+from pyproxy.providers.io_pool import IOPool
+
+BLOCKS = [1, 10, 100]
+
+
+class InMemoryProvider(object):
+    """
+    A provider serving blocks from memory after an optional delay
+    """
+    def __init__(self, latency=0.0):
+        """
+        Args:
+            latency(float, optional): Delay in seconds before each read
+        """
+        self.latency = latency
+        self.blocks = {}
+
+    def get(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.blocks.get(key)
+
+    def put(self, data, key):
+        self.blocks[key] = data
+
+
+def fetch_blocks_with_manager(providers, metablocks):
+    """
+    Fetches blocks with one thread per block and collects them in a dictionary
+    proxied by a multiprocessing.Manager started for the call.
+    Args:
+        providers(dict(str, Provider)): The providers indexed by name
+        metablocks(list(MetaBlock)): The metablocks describing the blocks to fetch
+    Returns:
+        dict(str, bytes): The blocks indexed by key
+    """
+    manager = multiprocessing.Manager()
+    blocks = manager.dict()
+    fetchers = []
+    for metablock in metablocks:
+        possible_providers = {key: providers[key] for key in metablock.providers}
+        fetcher = BlockFetcher(possible_providers, metablock)
+        fetcher.start()
+        fetchers.append(fetcher)
+    for fetcher in fetchers:
+        fetcher.join()
+        blocks.update(fetcher.queue)
+    return blocks
+
+
+def measure(function, providers, metablocks, requests):
+    """
+    Measures the latency of a fetching function.
+    Args:
+        function(function): The fetching function to call
+        providers(dict(str, Provider)): The providers indexed by name
+        metablocks(list(MetaBlock)): The metablocks describing the blocks to fetch
+        requests(int): Number of calls to average over
+    Returns:
+        float: The mean latency in milliseconds
+    """
+    latencies = []
+    for _ in xrange(requests):
+        start = time.time()
+        function(providers, metablocks)
+        end = time.time()
+        latencies.append((end - start) * 1000)
+    return numpy.mean(latencies)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(__file__, description="Microbenchmark for the block fetching of the dispatcher")
+    PARSER.add_argument("-r", "--requests", type=int, default=20, help="Number of requests per measure")
+    PARSER.add_argument("-s", "--size", type=int, default=1024 * 1024, help="Size of the blocks in bytes")
+    PARSER.add_argument("-l", "--latency", type=float, default=0.0,
+                        help="Simulated latency of the providers in seconds")
+    PARSER.add_argument("-p", "--providers", type=int, default=3, help="Number of providers")
+    ARGS = PARSER.parse_args()
+    PROVIDERS = {"provider-{:d}".format(index): InMemoryProvider(ARGS.latency)
+                 for index in xrange(ARGS.providers)}
+    DATA = os.urandom(ARGS.size)
+    METABLOCKS = []
+    for block_index in xrange(max(BLOCKS)):
+        key = "document-{:02d}".format(block_index)
+        for provider in PROVIDERS.values():
+            provider.put(DATA, key)
+        METABLOCKS.append(MetaBlock(key, providers=PROVIDERS.keys(),
+                                    checksum=hashlib.sha256(DATA).digest()))
+    POOL = IOPool()
+    print "{:>8s} {:>16s} {:>16s}".format("blocks", "manager (ms)", "pool (ms)")
+    for number_of_blocks in BLOCKS:
+        with_manager = measure(fetch_blocks_with_manager, PROVIDERS, METABLOCKS[:number_of_blocks],
+                               ARGS.requests)
+        with_pool = measure(lambda providers, metablocks: fetch_blocks(providers, metablocks, POOL),
+                            PROVIDERS, METABLOCKS[:number_of_blocks], ARGS.requests)
+        print "{:8d} {:16.3f} {:16.3f}".format(number_of_blocks, with_manager, with_pool)
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+"""
+A script that measures the latency of the random pointer selection as the
+number of pointers grows, comparing Files.select_random_blocks with the former
+approach issuing one ZRANGE per selected index.
+"""
+import argparse
+import time
+
+import numpy
+
+from pyproxy.metadata import Files
+
+POINTERS = [1, 2, 5, 10, 20, 50, 100]
+
+
+def select_random_blocks_one_by_one(files, requested):
+    """
+    Selects random blocks issuing one ZRANGE request per selected index before
+    fetching the blocks.
+    Args:
+        files(Files): Metadata server to query
+        requested(int): The number of random blocks to select
+    Returns:
+        list(MetaBlock): randomly selected blocks
+    """
+    blocks_available = files.redis.zcard("block_index")
+    if blocks_available <= requested:
+        return files.get_blocks(files.redis.zrange("block_index", 0, blocks_available))
+    selected_keys = []
+    for index in files.select_pointers(requested, blocks_available):
+        selected_keys.append(files.redis.zrange("block_index", index, index + 1)[0])
+    return files.get_blocks(selected_keys)
+
+
+def measure(function, files, requested, requests):
+    """
+    Measures the latency of a selection function.
+    Args:
+        function(function): The selection function to call
+        files(Files): Metadata server to query
+        requested(int): The number of random blocks to select
+        requests(int): Number of calls to average over
+    Returns:
+        float: The mean latency in milliseconds
+    """
+    latencies = []
+    for _ in xrange(requests):
+        start = time.time()
+        function(files, requested)
+        end = time.time()
+        latencies.append((end - start) * 1000)
+    return numpy.mean(latencies)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(__file__, description="Microbenchmark for the random pointer selection")
+    PARSER.add_argument("--host", type=str, default="metadata", help="Host of the metadata server")
+    PARSER.add_argument("--port", type=int, default=6379, help="Port of the metadata server")
+    PARSER.add_argument("-r", "--requests", type=int, default=100, help="Number of requests per measure")
+    ARGS = PARSER.parse_args()
+    FILES = Files(host=ARGS.host, port=ARGS.port)
+    print "Blocks available: {:d}".format(FILES.get_number_of_blocks_available())
+    print "{:>8s} {:>16s} {:>16s}".format("t", "one-by-one (ms)", "batched (ms)")
+    for t in POINTERS:
+        one_by_one = measure(select_random_blocks_one_by_one, FILES, t, ARGS.requests)
+        batched = measure(lambda files, requested: files.select_random_blocks(requested),
+                          FILES, t, ARGS.requests)
+        print "{:8d} {:16.3f} {:16.3f}".format(t, one_by_one, batched)
@@ -0,0 +1,31 @@
+#! /usr/bin/env python
+"""
+A script that moves the blocks stored by a disk provider from one layout to
+another. The proxies using the folder should be stopped while the blocks are
+moved.
+"""
+import argparse
+import logging
+
+from pyproxy.providers.disk import Disk, migrate_layout
+
+LOGGER = logging.getLogger("migrate_disk_layout")
+LOGGER.setLevel(logging.INFO)
+CONSOLE_HANDLER = logging.StreamHandler()
+CONSOLE_HANDLER.setLevel(logging.INFO)
+LOGGER.addHandler(CONSOLE_HANDLER)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(__file__, description="A script that moves the blocks of a disk provider to another layout")
+    PARSER.add_argument("folder", type=str,
+                        help="Folder where the disk provider stores the blocks")
+    PARSER.add_argument("--from", dest="source", type=str, choices=[Disk.FLAT, Disk.HASHED], default=Disk.FLAT,
+                        help="Current layout of the folder")
+    PARSER.add_argument("--to", dest="destination", type=str, choices=[Disk.FLAT, Disk.HASHED], default=Disk.HASHED,
+                        help="Layout to move the blocks to")
+    PARSER.add_argument("--fanout-levels", type=int, default=Disk.FANOUT_LEVELS,
+                        help="Number of levels of directories of the hashed layout")
+    ARGS = PARSER.parse_args()
+    MOVED = migrate_layout(ARGS.folder, ARGS.source, ARGS.destination, fanout_levels=ARGS.fanout_levels)
+    LOGGER.info("Moved {:d} blocks".format(MOVED))
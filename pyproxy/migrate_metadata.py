@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+"""
+A script that rewrites the metadata stored in version 1 records (string fields)
+to compact version 2 records in place and moves the documents entangled with
+the blocks to the sets of pointing documents
+"""
+import argparse
+import logging
+
+import redis
+
+from pyproxy.metadata import Files
+
+BLOCK_V1_FIELDS = ["creation_date", "block_type", "checksum", "size", "entangled_with"]
+DOCUMENT_V1_FIELDS = ["creation_date", "original_size", "entangling_blocks"]
+
+LOGGER = logging.getLogger("migrate_metadata")
+LOGGER.setLevel(logging.INFO)
+CONSOLE_HANDLER = logging.StreamHandler()
+CONSOLE_HANDLER.setLevel(logging.INFO)
+LOGGER.addHandler(CONSOLE_HANDLER)
+
+
+def migrate_records(files, keys, convert, obsolete_fields):
+    """
+    Rewrites version 1 records to version 2 records. The records are watched
+    so that concurrent updates are not lost.
+    Args:
+        files(Files): Metadata server
+        keys(list(str)): Keys of the hashes to migrate
+        convert(function): Function converting a version 1 record to a version 2 record
+        obsolete_fields(list(str)): Version 1 fields to remove from the hashes
+    Returns:
+        int: The number of records migrated
+    """
+    while True:
+        with files.redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(*keys)
+                records = [pipeline.hgetall(key) for key in keys]
+                migrated = {}
+                for key, record in zip(keys, records):
+                    if record and "record" not in record:
+                        migrated[key] = convert(record)
+                pipeline.multi()
+                for key, record in migrated.items():
+                    pipeline.hmset(key, record)
+                    pipeline.hdel(key, *obsolete_fields)
+                pipeline.execute()
+                return len(migrated)
+            except redis.WatchError:
+                LOGGER.info("Records modified during migration, retrying batch")
+
+
+def migrate(files, batch_size):
+    """
+    Migrates all the blocks and documents of a metadata server
+    Args:
+        files(Files): Metadata server
+        batch_size(int): Number of records migrated at once
+    Returns:
+        (int, int): The number of blocks and documents migrated
+    """
+    def convert_block(record):
+        block = Files.parse_metablock(record)
+        return Files.serialize_metablock(block, files.get_provider_ids(sorted(block.providers)))
+
+    def convert_document(record):
+        converted = Files.serialize_metadata(Files.parse_metadata(record))
+        # The blocks of the document are not parsed, keep the existing list
+        converted["blocks"] = record.get("blocks", "")
+        return converted
+
+    # The sets of pointing documents replace the entangled_with field of the
+    # blocks and must be filled before the field is removed
+    indexed = files.rebuild_entanglement_graph()
+    LOGGER.info("Indexed the pointers of {:d} documents".format(indexed))
+
+    migrated_blocks = 0
+    block_names = files.list_blocks()
+    for index in xrange(0, len(block_names), batch_size):
+        keys = ["{:s}{:s}".format(Files.BLOCK_PREFIX, name) for name in block_names[index:index + batch_size]]
+        migrated_blocks += migrate_records(files, keys, convert_block, BLOCK_V1_FIELDS)
+        LOGGER.info("Migrated {:d} blocks out of {:d}".format(migrated_blocks, len(block_names)))
+
+    migrated_documents = 0
+    document_names = files.keys()
+    for index in xrange(0, len(document_names), batch_size):
+        keys = ["{:s}{:s}".format(Files.FILE_PREFIX, name) for name in document_names[index:index + batch_size]]
+        migrated_documents += migrate_records(files, keys, convert_document, DOCUMENT_V1_FIELDS)
+        LOGGER.info("Migrated {:d} documents out of {:d}".format(migrated_documents, len(document_names)))
+    return migrated_blocks, migrated_documents
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(__file__, description="A script that migrates metadata records to the compact format")
+    PARSER.add_argument("--host", type=str, default="metadata", help="Host of the metadata server")
+    PARSER.add_argument("--port", type=int, default=6379, help="Port of the metadata server")
+    PARSER.add_argument("--batch-size", type=int, default=Files.READ_BUFFER_SIZE,
+                        help="Number of records migrated at once")
+    ARGS = PARSER.parse_args()
+    MIGRATED_BLOCKS, MIGRATED_DOCUMENTS = migrate(Files(host=ARGS.host, port=ARGS.port), ARGS.batch_size)
+    LOGGER.info("Migrated {:d} blocks and {:d} documents".format(MIGRATED_BLOCKS, MIGRATED_DOCUMENTS))
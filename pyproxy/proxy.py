@@ -22,7 +22,8 @@ import offline
 
 import pyproxy.playcloud_pb2 as playcloud_pb2
 
-from pyproxy.metadata import extract_entanglement_data, Files
+from pyproxy.metadata import extract_entanglement_data, parse_cursor
+from pyproxy.metadata_sharding import create_files
 from pyproxy.playcloud_pb2 import Strip
 import pyproxy.coder_client
 import pyproxy.proxy_service
@@ -46,8 +47,8 @@ CODER_CLIENT = pyproxy.coder_client.LocalCoderClient()
 # Loading dispatcher
 DISPATCHER = pyproxy.pyproxy_globals.get_dispatcher_instance()
 
-# Loading the Files metadata structure
-FILES = Files()
+# Loading the Files metadata structure shared with the dispatcher
+FILES = DISPATCHER.files
 
 # Bottle webapp configuration
 bottle.BaseRequest.MEMFILE_MAX = 1024 * 1024 * 1024
@@ -101,7 +102,8 @@ def get(key):
         strips = []
         for block in blocks:
             strip = Strip()
-            strip.data = block
+            # Blocks read from memory mapped files are only copied here
+            strip.data = str(block)
             strips.append(strip)
 
         LOGGER.debug("Received blocks from redis")
@@ -193,25 +195,113 @@ def put_keyless():
 def list_files():
     """
     List the files stored in the system.
+    The listing is streamed as chunked JSON and can be paged with the optional
+    query parameters cursor (cursor returned by the previous page) and limit
+    (maximum number of files to list, greater than 0). The cursor to use for
+    the next page is returned under the cursor key and is null once the
+    listing is over.
     Returns:
-        (string): A listing of the files serialized as JSON
+        (generator): A listing of the files serialized as JSON
+    """
+    cursor = request.query.get("cursor")
+    try:
+        if cursor is not None:
+            parse_cursor(cursor)
+    except ValueError:
+        return abort(400, "cursor must be a cursor returned by a previous listing")
+    try:
+        limit = request.query.get("limit")
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        return abort(400, "limit must be an integer")
+    # An empty page could not tell whether files remain
+    if limit is not None and limit <= 0:
+        return abort(400, "limit must be greater than 0")
+    response.content_type = "application/json"
+    return stream_files(cursor, limit)
+
+
+def stream_files(cursor, limit):
     """
-    entries = [meta.__json__() for meta in FILES.values()]
-    return json.dumps({"files": entries})
+    Serializes the listing of the files stored in the system one file at a time.
+    Args:
+        cursor(str): Cursor of the last file of the previous page, None to
+                     start from the beginning
+        limit(int): Maximum number of files to list, None to list them all
+    Yields:
+        (string): Chunks of the listing serialized as JSON
+    """
+    yield '{"files": ['
+    listed = 0
+    next_cursor = None
+    # One more file is read to know whether the listing goes on
+    listing = FILES.iter_listing(cursor=cursor, limit=None if limit is None else limit + 1)
+    for file_cursor, meta in listing:
+        if listed == limit:
+            next_cursor = cursor
+            break
+        if listed:
+            yield ","
+        yield json.dumps(meta.__json__())
+        cursor = file_cursor
+        listed += 1
+    yield '], "cursor": {:s}}}'.format(json.dumps(next_cursor))
 
 
 @APP.route("/dict", method="GET")
 def dictionary():
     """
     Show the dictionary used by the proxy to the trace blocks used in encoding.
+    The optional query parameter since restricts the dictionary to the
+    documents added since that timestamp (in seconds since the epoch).
     """
-    graph = FILES.get_entanglement_graph()
+    since = request.query.get("since")
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return abort(400, "since must be a timestamp")
+    graph = FILES.get_entanglement_graph(since=since)
     for path in EMPTY_FILES:
         graph[empty_file] = MetaDocument(path)
     response.content_type = "application/json"
     return graph
 
 
+@APP.route("/__stats", method="GET")
+def statistics():
+    """
+    Show the usage statistics of the proxy's internal components.
+    Returns:
+        (dict): The statistics of each component
+    """
+    response.content_type = "application/json"
+    stats = {
+        "metadata_cache": FILES.get_cache_statistics(),
+        "io_pool": DISPATCHER.pool.statistics(),
+        "writes": DISPATCHER.write_statistics.statistics(),
+        "circuit_breakers": DISPATCHER.breakers.statistics(),
+        "verification": DISPATCHER.verifier.statistics()
+    }
+    if DISPATCHER.hedging is not None:
+        stats["hedging"] = DISPATCHER.hedging.statistics()
+    if DISPATCHER.block_cache is not None:
+        stats["block_cache"] = DISPATCHER.block_cache.statistics()
+    return stats
+
+
+@APP.route("/__providers", method="GET")
+def provider_scores():
+    """
+    Show the scores used to choose the replicas to read blocks from.
+    Returns:
+        (dict): The latency and error rate scores of each provider
+    """
+    response.content_type = "application/json"
+    return DISPATCHER.scores.statistics()
+
+
 @APP.route("/R3Knge0dnlDxZcHXH6iip9DZ+greFpvIKYpSTuhyHWLHybrc6Kmt1H84NkI71wjI", method="GET")
 def dummy_route():
     """
@@ -232,7 +322,7 @@ def seed_system():
             configuration["entanglement"]["type"] != "step":
         seed_logger.info("No need to see the system")
         return
-    files = Files(host="metadata")
+    files = create_files(configuration.get("metadata"))
     pointers_available = files.get_number_of_blocks_available()
     pointers_needed = configuration["entanglement"]["configuration"]["t"]
     difference = pointers_needed - pointers_available
@@ -7,7 +7,8 @@ import math
 import os
 import struct
 
-from pyproxy.metadata import compute_block_key, Files
+from pyproxy.metadata import compute_block_key, find_header_delimiter
+from pyproxy.metadata_sharding import create_files
 from pyproxy.coder_client import CoderClient
 
 HEADER_DELIMITER = chr(29)
@@ -120,6 +121,17 @@ class FragmentMetadata(object):
                self.backend_id == other.backend_id and \
                self.backend_version == other.backend_version
 
+DISPATCHER_CONFIGURATION_PATH = os.path.join(os.path.dirname(__file__), "..", "dispatcher.json")
+
+def get_metadata_server():
+    """
+    Returns the metadata backend described in the dispatcher configuration
+    Returns:
+        Files|ShardedFiles: The metadata backend
+    """
+    with open(DISPATCHER_CONFIGURATION_PATH, "r") as handle:
+        return create_files(json.load(handle).get("metadata"))
+
 def get_block_metadata(path, index):
     """
     Returns the block metadata
@@ -129,7 +141,7 @@ def get_block_metadata(path, index):
     Returns:
         MetaBlock: Block metadata
     """
-    files = Files()
+    files = get_metadata_server()
     key = compute_block_key(path, index)
     return files.get_block(key)
 
@@ -144,7 +156,7 @@ def find_pointing_documents(path, index):
         list(Metadata): List of documents that used the block as a pointer
     """
     block_metadata = get_block_metadata(path, index)
-    files = Files()
+    files = get_metadata_server()
     pointing_documents = files.get_files(block_metadata.entangled_with)
     return pointing_documents
 
@@ -174,12 +186,12 @@ def split_strip_header(strip_data):
      * the original size of the data
      * the pyeclib fragment header
     Args:
-        strip_data(bytes): The full strip as returned by the coder
+        strip_data(bytes|buffer): The full strip as returned by the coder
     Returns:
         (list((str, int)), int, FragmentHeader): The strip's header
     """
-    start = strip_data.find(HEADER_DELIMITER)
-    end = strip_data.find(HEADER_DELIMITER, start + 1)
+    start = find_header_delimiter(strip_data)
+    end = find_header_delimiter(strip_data, start + 1)
     return (
         strip_data[:start],
         int(strip_data[start + len(HEADER_DELIMITER):end]),
@@ -190,12 +202,12 @@ def get_fragment(strip_data):
     """
     Returns the actual data part of the pyeclib fragment
     Args:
-        strip_data(bytes): The full strip as returned by the coder
+        strip_data(bytes|buffer): The full strip as returned by the coder
     Returns:
         bytes: The data part of the fragment
     """
-    start = strip_data.find(HEADER_DELIMITER) + len(HEADER_DELIMITER)
-    end = strip_data.find(HEADER_DELIMITER, start) + len(HEADER_DELIMITER)
+    start = find_header_delimiter(strip_data) + len(HEADER_DELIMITER)
+    end = find_header_delimiter(strip_data, start) + len(HEADER_DELIMITER)
     data = strip_data[end + 80:]
     return data
 
@@ -237,12 +249,12 @@ def reconstruct_as_pointer(path, index):
     documents = find_pointing_documents(path, index)
     if not documents:
         raise RuntimeError("Could not find any pointing document")
-    with open(os.path.join(os.path.dirname(__file__), "..", "dispatcher.json"), "r") as handle:
+    with open(DISPATCHER_CONFIGURATION_PATH, "r") as handle:
         entanglement_configuration = json.load(handle)["entanglement"]["configuration"]
     source_blocks = entanglement_configuration["s"]
     pointer_blocks = entanglement_configuration["t"]
     offset = source_blocks  + pointer_blocks
-    files = Files()
+    files = get_metadata_server()
     for document in documents:
         index_to_reconstruct = get_position_in_codeword(document, metablock)
         coder_client = CoderClient()
@@ -1,11 +1,15 @@
 """
 Metadata management for the files and blocks stored in playcloud
 """
+import array
 import datetime
+import itertools
 import logging
 import json
 import random
 import socket
+import struct
+import threading
 import time
 
 import enum
@@ -13,6 +17,8 @@ import IPy
 import numpy
 import redis
 
+from pyproxy.metadata_cache import KeyspaceInvalidator, LRUCache
+
 LOGGER = logging.getLogger("metadata")
 
 def compute_block_key(path, index, length=2):
@@ -27,6 +33,16 @@ def compute_block_key(path, index, length=2):
     """
     return path + "-" + str(index).zfill(length)
 
+def extract_path_from_block_key(key):
+    """
+    Extracts the path of the document a block belongs to from its key
+    Args:
+        key(str): Key of the block
+    Returns:
+        str: The path of the document
+    """
+    return key[:key.rfind("-")]
+
 def uniform_random_selection(t, n):
     """
     Args:
@@ -97,9 +113,12 @@ class MetaBlock(object):
     """
     A class that represents a data block
     """
+    __slots__ = ["key", "providers", "creation_date", "block_type", "checksum",
+                 "entangled_with", "size", "fast_checksum"]
+
     def __init__(self, key, providers=None, creation_date=None,
                  block_type=BlockType.DATA, checksum=None, entangled_with=None,
-                 size=0):
+                 size=0, fast_checksum=None):
         """
         MetaBlock constructor
         Args:
@@ -112,6 +131,9 @@ class MetaBlock(object):
             checksum (bytes, optional): SHA256 digest of the data
             entangled_with(list(str), optional): List of documents the block is
                                                  entangled with
+            size(int, optional): Size of the block in bytes
+            fast_checksum(int, optional): CRC32 of the data, checked instead of
+                                          the SHA256 digest by fast reads
         """
         self.key = key
         if providers:
@@ -129,6 +151,32 @@ class MetaBlock(object):
         else:
             self.entangled_with = []
         self.size = size
+        self.fast_checksum = fast_checksum
+
+    def freeze(self):
+        """
+        Returns an immutable snapshot of the block that can be shared by the
+        readers of the metadata cache
+        Returns:
+            tuple: The attributes of the block
+        """
+        return (self.key, tuple(self.providers), self.creation_date, self.block_type,
+                self.checksum, tuple(self.entangled_with), self.size, self.fast_checksum)
+
+    @staticmethod
+    def thaw(frozen):
+        """
+        Builds a block from a snapshot returned by freeze
+        Args:
+            frozen(tuple): The attributes of the block
+        Returns:
+            MetaBlock: A new block
+        """
+        key, providers, creation_date, block_type, checksum, entangled_with, size, fast_checksum = frozen
+        return MetaBlock(key, providers=list(providers), creation_date=creation_date,
+                         block_type=block_type, checksum=checksum,
+                         entangled_with=list(entangled_with), size=size,
+                         fast_checksum=fast_checksum)
 
     def __json__(self):
         """
@@ -142,6 +190,7 @@ class MetaBlock(object):
             "creation_date": self.creation_date.isoformat(),
             "block_type": self.block_type.name,
             "checksum": convert_binary_to_hex_digest(self.checksum),
+            "fast_checksum": self.fast_checksum,
             "entangled_with": self.entangled_with
         }
 
@@ -167,6 +216,7 @@ class MetaDocument(object):
     """
     A class describing how a file has been stored in the system
     """
+    __slots__ = ["path", "creation_date", "blocks", "entangling_blocks", "original_size"]
 
     def __init__(self, path, original_size=0):
         """
@@ -181,6 +231,32 @@ class MetaDocument(object):
         self.entangling_blocks = []
         self.original_size = original_size
 
+    def freeze(self):
+        """
+        Returns an immutable snapshot of the document without its blocks that
+        can be shared by the readers of the metadata cache
+        Returns:
+            tuple: The attributes of the document and the keys of its blocks
+        """
+        return (self.path, self.creation_date,
+                tuple(tuple(entangling_block) for entangling_block in self.entangling_blocks),
+                self.original_size, tuple(block.key for block in self.blocks))
+
+    @staticmethod
+    def thaw(frozen):
+        """
+        Builds a document without its blocks from a snapshot returned by freeze
+        Args:
+            frozen(tuple): The attributes of the document and the keys of its blocks
+        Returns:
+            (MetaDocument, tuple(str)): A new document and the keys of its blocks
+        """
+        path, creation_date, entangling_blocks, original_size, block_keys = frozen
+        document = MetaDocument(path, original_size=original_size)
+        document.creation_date = creation_date
+        document.entangling_blocks = [list(entangling_block) for entangling_block in entangling_blocks]
+        return document, block_keys
+
     def __json__(self):
         """
         Returns a representation of a MetaBlock as a serializable dictionary
@@ -200,16 +276,37 @@ class MetaDocument(object):
         """
         return json.dumps(self.__json__())
 
+HEADER_DELIMITER = chr(29)
+HEADER_SEARCH_SIZE = 4096
+
+def find_header_delimiter(block_data, start=0):
+    """
+    Finds the next header delimiter of a block. Buffers over memory mapped
+    blocks cannot be searched, so they are searched by small windows rather
+    than copied as a whole.
+    Args:
+        block_data(str|buffer): A data block with an entanglement header
+        start(int, optional): Position from which to search
+    Returns:
+        int: The position of the delimiter, -1 if there is none
+    """
+    if isinstance(block_data, str):
+        return block_data.find(HEADER_DELIMITER, start)
+    for window_start in xrange(start, len(block_data), HEADER_SEARCH_SIZE):
+        pos = block_data[window_start:window_start + HEADER_SEARCH_SIZE].find(HEADER_DELIMITER)
+        if pos >= 0:
+            return window_start + pos
+    return -1
+
 def extract_entanglement_data(block_data):
     """
     Extract and list the entangling information from the blocks header
     Args:
-        block_data(str): A data block with an entanglement header
+        block_data(str|buffer): A data block with an entanglement header
     Returns:
         list((str, int)): A list of the blocks used for entanglement
     """
-    header_delimiter = chr(29)
-    pos = block_data.find(header_delimiter)
+    pos = find_header_delimiter(block_data)
     if pos <= 0:
         return ""
     raw_header = block_data[:pos]
@@ -219,17 +316,311 @@ def extract_entanglement_data(block_data):
 def extract_document_size(block_data):
     """
     Args:
-        block_data(str): A data block with an entanglement header
+        block_data(str|buffer): A data block with an entanglement header
     Returns:
         int: The size of the original document
     """
-    if not block_data or not isinstance(block_data, str):
+    if not block_data or not isinstance(block_data, (str, buffer)):
         raise ValueError("argument block_data must be a non-empty sequence of bytes")
-    header_delimiter = chr(29)
-    start = block_data.find(header_delimiter) + 1
-    end = block_data.find(header_delimiter, start)
+    start = find_header_delimiter(block_data) + 1
+    end = find_header_delimiter(block_data, start)
     return int(block_data[start:end])
 
+# Lua function reading a block hash and the set of documents pointing to it.
+# The documents of the set and of the "entangled_with" field of the blocks
+# stored before the sets were introduced are merged, sorted and appended to
+# the flattened hash as the "entangled_with" field, overriding the legacy one.
+READ_BLOCK_FUNCTION = """
+local function read_block(block_prefix, pointed_by_prefix, block_key)
+    local block_hash = redis.call("HGETALL", block_prefix .. block_key)
+    if #block_hash > 0 then
+        local documents = redis.call("SMEMBERS", pointed_by_prefix .. block_key)
+        if #documents > 0 then
+            local merged = {}
+            for _, document in ipairs(documents) do
+                merged[document] = true
+            end
+            for field = 1, #block_hash, 2 do
+                if block_hash[field] == "entangled_with" then
+                    for document in string.gmatch(block_hash[field + 1], "[^,]+") do
+                        merged[document] = true
+                    end
+                end
+            end
+            documents = {}
+            for document in pairs(merged) do
+                table.insert(documents, document)
+            end
+            table.sort(documents)
+            table.insert(block_hash, "entangled_with")
+            table.insert(block_hash, table.concat(documents, ","))
+        end
+    end
+    return block_hash
+end
+"""
+
+# Lua script resolving documents and their blocks in a single round trip.
+# KEYS holds the document hashes, ARGV[1] the prefix of the block hashes and
+# ARGV[2] the prefix of the sets of pointing documents.
+# Each entry of the reply is either an empty list if the document does not
+# exist or a list whose first element is the flattened document hash followed
+# by the flattened hashes of its blocks (empty if the block is missing).
+FETCH_FILES_SCRIPT = READ_BLOCK_FUNCTION + """
+local function split_blocks_field(path, joined_keys)
+    local extracted_keys = {}
+    local pos = 1
+    while pos <= #joined_keys do
+        local start = string.find(joined_keys, path, pos, true)
+        if not start then
+            break
+        end
+        local stop = string.find(joined_keys, ",", start + #path, true)
+        if not stop then
+            table.insert(extracted_keys, string.sub(joined_keys, start))
+            break
+        end
+        table.insert(extracted_keys, string.sub(joined_keys, start, stop - 1))
+        pos = stop
+    end
+    return extracted_keys
+end
+
+local documents = {}
+for index, file_key in ipairs(KEYS) do
+    local file_hash = redis.call("HGETALL", file_key)
+    local document = {}
+    if #file_hash > 0 then
+        local fields = {}
+        for field = 1, #file_hash, 2 do
+            fields[file_hash[field]] = file_hash[field + 1]
+        end
+        table.insert(document, file_hash)
+        for _, block_key in ipairs(split_blocks_field(fields["path"], fields["blocks"] or "")) do
+            table.insert(document, read_block(ARGV[1], ARGV[2], block_key))
+        end
+    end
+    documents[index] = document
+end
+return documents
+"""
+
+# Lua script resolving randomly selected positions in the block index and
+# fetching the matching blocks in a single round trip.
+# KEYS[1] is the block index, ARGV[1] the prefix of the block hashes, ARGV[2]
+# the prefix of the sets of pointing documents and the rest of ARGV the
+# selected positions. Each entry of the reply is a list made of the block key
+# and its flattened hash (empty if the block is missing).
+SELECT_BLOCKS_SCRIPT = READ_BLOCK_FUNCTION + """
+local blocks = {}
+for position = 3, #ARGV do
+    local index = tonumber(ARGV[position])
+    local selected = redis.call("ZRANGE", KEYS[1], index, index)
+    if #selected > 0 then
+        local block_key = selected[1]
+        table.insert(blocks, {block_key, read_block(ARGV[1], ARGV[2], block_key)})
+    end
+end
+return blocks
+"""
+
+# Lua script returning the entries of the entanglement graph for the documents
+# created since a given timestamp in a single round trip.
+# KEYS[1] is the file index, KEYS[2] the entanglement graph and ARGV[1] the
+# timestamp. The reply is a flattened list of paths and graph entries.
+GRAPH_SINCE_SCRIPT = """
+local entries = {}
+for _, path in ipairs(redis.call("ZRANGEBYSCORE", KEYS[1], ARGV[1], "+inf")) do
+    local entry = redis.call("HGET", KEYS[2], path)
+    if entry then
+        table.insert(entries, path)
+        table.insert(entries, entry)
+    end
+end
+return entries
+"""
+
+# Lua script replacing the providers of a block while keeping the provider
+# index in sync.
+# KEYS[1] is the block hash and KEYS[2] the hash mapping provider ids to names.
+# ARGV[1] is the prefix of the provider index, ARGV[2] the block key, ARGV[3]
+# the comma-joined list of providers and ARGV[4] the packed ids of the same
+# providers, used for blocks stored in version 2 records.
+# Replies 0 if the block does not exist, 1 otherwise.
+SET_PROVIDERS_SCRIPT = """
+local previous_field = redis.call("HGET", KEYS[1], "providers")
+if not previous_field then
+    return 0
+end
+local previous_providers = {}
+if redis.call("HEXISTS", KEYS[1], "record") == 1 then
+    for position = 1, #previous_field, 2 do
+        local provider_id = struct.unpack(">H", previous_field, position)
+        table.insert(previous_providers, redis.call("HGET", KEYS[2], tostring(provider_id)))
+    end
+    redis.call("HSET", KEYS[1], "providers", ARGV[4])
+else
+    for provider in string.gmatch(previous_field, "[^,]+") do
+        table.insert(previous_providers, provider)
+    end
+    redis.call("HSET", KEYS[1], "providers", ARGV[3])
+end
+local providers = {}
+for provider in string.gmatch(ARGV[3], "[^,]+") do
+    providers[provider] = true
+end
+for _, provider in ipairs(previous_providers) do
+    if not providers[provider] then
+        redis.call("SREM", ARGV[1] .. provider, ARGV[2])
+    end
+end
+for provider, _ in pairs(providers) do
+    redis.call("SADD", ARGV[1] .. provider, ARGV[2])
+end
+return 1
+"""
+
+# Lua script adding providers to a block, or parking them in a pending set
+# merged by put if the block has not been stored yet.
+# KEYS[1] is the block hash and KEYS[2] the set of pending providers of the
+# block. ARGV[1] is the prefix of the provider index, ARGV[2] the block key,
+# ARGV[3] the time to live of the pending set in seconds, ARGV[4] the packed
+# ids of the providers and the rest of ARGV the names of the same providers.
+# Replies 0 if the providers are pending, 1 if they were added to the block
+# and 2 if the block had no providers before.
+ADD_PROVIDERS_SCRIPT = """
+local field = redis.call("HGET", KEYS[1], "providers")
+if not field then
+    redis.call("SADD", KEYS[2], unpack(ARGV, 5))
+    redis.call("EXPIRE", KEYS[2], ARGV[3])
+    return 0
+end
+local reply = 1
+if #field == 0 then
+    reply = 2
+end
+local packed = redis.call("HEXISTS", KEYS[1], "record") == 1
+local known = {}
+if packed then
+    for position = 1, #field, 2 do
+        known[string.sub(field, position, position + 1)] = true
+    end
+else
+    for provider in string.gmatch(field, "[^,]+") do
+        known[provider] = true
+    end
+end
+for index = 5, #ARGV do
+    local provider = ARGV[index]
+    local entry = provider
+    if packed then
+        entry = string.sub(ARGV[4], 2 * (index - 5) + 1, 2 * (index - 5) + 2)
+    end
+    if not known[entry] then
+        known[entry] = true
+        if packed then
+            field = field .. entry
+        elseif #field > 0 then
+            field = field .. "," .. entry
+        else
+            field = entry
+        end
+    end
+    redis.call("SADD", ARGV[1] .. provider, ARGV[2])
+end
+redis.call("HSET", KEYS[1], "providers", field)
+return reply
+"""
+
+# Lua script assigning integer ids to providers.
+# KEYS[1] is the hash mapping provider names to ids, KEYS[2] the hash mapping
+# ids to names and ARGV the names of the providers.
+# Replies the ids of the providers in the same order.
+ASSIGN_PROVIDER_IDS_SCRIPT = """
+local provider_ids = {}
+for index, provider in ipairs(ARGV) do
+    local provider_id = redis.call("HGET", KEYS[1], provider)
+    if not provider_id then
+        provider_id = redis.call("HLEN", KEYS[1]) + 1
+        redis.call("HSET", KEYS[1], provider, provider_id)
+        redis.call("HSET", KEYS[2], provider_id, provider)
+    end
+    provider_ids[index] = tonumber(provider_id)
+end
+return provider_ids
+"""
+
+def pairs_to_dict(pairs):
+    """
+    Converts a flattened list of field-value pairs as returned by HGETALL in a
+    Lua script into a dictionary
+    Args:
+        pairs(list(str)): Flattened list of fields and values
+    Returns:
+        dict(str, str): The fields mapped to their values
+    """
+    iterator = iter(pairs)
+    return dict(zip(iterator, iterator))
+
+# Compact binary records (version 2)
+# Blocks and documents are stored as redis hashes. In version 1, every field is
+# a string (dates, comma-joined providers, JSON). In version 2, the immutable
+# fields are packed in a single binary "record" field, dates are stored as
+# microseconds since the epoch and providers as a packed array of integer ids.
+# The presence of the "record" field tells the version of a hash.
+RECORD_VERSION = 2
+EPOCH = datetime.datetime(1970, 1, 1)
+# version, creation date, block type, size, checksum length + checksum,
+# optionally followed by the fast checksum
+BLOCK_RECORD = struct.Struct(">BqBQH")
+FAST_CHECKSUM = struct.Struct(">I")
+# version, creation date, original size, number of entangling blocks
+DOCUMENT_RECORD = struct.Struct(">BqQH")
+# path length + path, index
+ENTANGLING_BLOCK = struct.Struct(">HI")
+PROVIDER_ID_SIZE = struct.calcsize(">H")
+
+def datetime_to_microseconds(date):
+    """
+    Converts a date to a timestamp
+    Args:
+        date(datetime.datetime): The date to convert
+    Returns:
+        int: The number of microseconds elapsed since the epoch
+    """
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def microseconds_to_datetime(timestamp):
+    """
+    Converts a timestamp to a date
+    Args:
+        timestamp(int): The number of microseconds elapsed since the epoch
+    Returns:
+        datetime.datetime: The matching date
+    """
+    return EPOCH + datetime.timedelta(microseconds=timestamp)
+
+def pack_provider_ids(provider_ids):
+    """
+    Packs a list of provider ids
+    Args:
+        provider_ids(list(int)): Ids of the providers
+    Returns:
+        bytes: The packed ids
+    """
+    return struct.pack(">{:d}H".format(len(provider_ids)), *provider_ids)
+
+def unpack_provider_ids(packed_ids):
+    """
+    Unpacks a list of provider ids
+    Args:
+        packed_ids(bytes): The packed ids
+    Returns:
+        tuple(int): Ids of the providers
+    """
+    return struct.unpack(">{:d}H".format(len(packed_ids) / PROVIDER_ID_SIZE), packed_ids)
+
 def split_blocks_field(path, joined_keys):
     pos = 0
     extracted_keys = []
@@ -245,14 +636,248 @@ def split_blocks_field(path, joined_keys):
         pos = end
     return extracted_keys
 
+def format_cursor(score, path):
+    """
+    Encodes the position of a document in the file index as a listing cursor
+    Args:
+        score(float): Score of the document in the file index
+        path(str): Path of the document
+    Returns:
+        str: The cursor resuming a listing after the document
+    """
+    return "{!r}:{:s}".format(score, path)
+
+def parse_cursor(cursor):
+    """
+    Decodes a listing cursor
+    Args:
+        cursor(str): A cursor returned by format_cursor
+    Returns:
+        (float, str): The score and the path of the document the listing
+                      resumes after
+    Raises:
+        ValueError: If cursor is not a valid cursor
+    """
+    score, _, path = str(cursor).partition(":")
+    try:
+        score = float(score)
+    except ValueError:
+        score = None
+    if score is None or not path:
+        raise ValueError("cursor argument must be a cursor returned by a previous listing")
+    return score, path
+
+def iter_listing(files, cursor=None, limit=None):
+    """
+    Lazily lists documents in the order of the file index. The listing resumes
+    from the index entry encoded in the cursor so that each page only reads
+    its own entries.
+    Args:
+        files(Files|ShardedFiles): The metadata to list the documents of
+        cursor(str, optional): Cursor of the last document of the previous
+                               page (defaults to None to start from the
+                               beginning of the index)
+        limit(int, optional): Maximum number of documents to list (defaults
+                              to None for all remaining documents)
+    Yields:
+        (str, MetaDocument): The cursor resuming the listing after the
+                             document and the document
+    Raises:
+        ValueError: If cursor is not a valid cursor or if limit is not an
+                    integer greater or equal to 0
+    """
+    after = None if cursor is None else parse_cursor(cursor)
+    if limit is not None and (not isinstance(limit, (int, long)) or limit < 0):
+        raise ValueError("limit argument must be an integer greater or equal to 0")
+    entries = itertools.islice(files.iter_index_entries("file_index", after=after), limit)
+    while True:
+        batch = list(itertools.islice(entries, Files.READ_BUFFER_SIZE))
+        if not batch:
+            return
+        # Documents deleted since the index was read are skipped
+        documents = {document.path: document
+                     for document in files.get_files([path for _, path in batch], skip_missing=True)}
+        for score, path in batch:
+            if path in documents:
+                yield format_cursor(score, path), documents[path]
+
+class BlockTable(object):
+    """
+    A compact, column oriented, collection of blocks meant for scans over all
+    the blocks of the system. Keys, checksums, providers and entanglement
+    information are appended to flat buffers indexed by offsets instead of
+    being held as one MetaBlock per block. MetaBlock objects are only built
+    when a block is accessed by index or when iterating over the table.
+    """
+    def __init__(self):
+        self.providers_by_id = []
+        self.provider_ids = {}
+        self.key_data = bytearray()
+        self.key_offsets = array.array("L", [0])
+        self.checksum_data = bytearray()
+        self.checksum_offsets = array.array("L", [0])
+        self.entangled_with_data = bytearray()
+        self.entangled_with_offsets = array.array("L", [0])
+        self.provider_data = array.array("H")
+        self.provider_offsets = array.array("L", [0])
+        self.creation_dates = array.array("l")
+        self.block_types = array.array("B")
+        self.sizes = array.array("L")
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        """
+        Builds the MetaBlock stored at a given position
+        Args:
+            index(int): Position of the block in the table
+        Returns:
+            MetaBlock: The block
+        Raises:
+            IndexError: If the index is out of range
+        """
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("index out of range")
+        entangled_with = self.get_entangled_with(index)
+        return MetaBlock(self.get_key(index),
+                         providers=self.get_providers(index),
+                         creation_date=microseconds_to_datetime(self.creation_dates[index]),
+                         block_type=BlockType(self.block_types[index]),
+                         checksum=self.get_checksum(index),
+                         entangled_with=entangled_with.split(",") if entangled_with else [],
+                         size=self.sizes[index])
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def get_key(self, index):
+        """
+        Args:
+            index(int): Position of the block in the table
+        Returns:
+            str: The key of the block
+        """
+        return str(self.key_data[self.key_offsets[index]:self.key_offsets[index + 1]])
+
+    def get_checksum(self, index):
+        """
+        Args:
+            index(int): Position of the block in the table
+        Returns:
+            bytes: The checksum of the block
+        """
+        return str(self.checksum_data[self.checksum_offsets[index]:self.checksum_offsets[index + 1]])
+
+    def get_providers(self, index):
+        """
+        Args:
+            index(int): Position of the block in the table
+        Returns:
+            list(str): The providers hosting the block
+        """
+        start, end = self.provider_offsets[index], self.provider_offsets[index + 1]
+        return [self.providers_by_id[provider_id] for provider_id in self.provider_data[start:end]]
+
+    def get_entangled_with(self, index):
+        """
+        Args:
+            index(int): Position of the block in the table
+        Returns:
+            str: The comma-joined paths of the documents entangled with the block
+        """
+        start, end = self.entangled_with_offsets[index], self.entangled_with_offsets[index + 1]
+        return str(self.entangled_with_data[start:end])
+
+    def get_number_of_pointers(self, index):
+        """
+        Args:
+            index(int): Position of the block in the table
+        Returns:
+            int: The number of documents entangled with the block
+        """
+        start, end = self.entangled_with_offsets[index], self.entangled_with_offsets[index + 1]
+        if start == end:
+            return 0
+        return self.entangled_with_data.count(",", start, end) + 1
+
+    def append(self, key, providers, timestamp, block_type, checksum, entangled_with, size):
+        """
+        Appends a block to the table
+        Args:
+            key(str): Key of the block
+            providers(list(str)): Providers hosting the block
+            timestamp(int): Creation date of the block in microseconds since the epoch
+            block_type(int): Value of the BlockType of the block
+            checksum(bytes): Checksum of the block
+            entangled_with(str): Comma-joined paths of the documents entangled with the block
+            size(int): Size of the block in bytes
+        """
+        self.key_data.extend(key)
+        self.key_offsets.append(len(self.key_data))
+        self.checksum_data.extend(checksum or "")
+        self.checksum_offsets.append(len(self.checksum_data))
+        self.entangled_with_data.extend(entangled_with)
+        self.entangled_with_offsets.append(len(self.entangled_with_data))
+        for provider in providers:
+            provider_id = self.provider_ids.get(provider)
+            if provider_id is None:
+                provider_id = len(self.providers_by_id)
+                self.provider_ids[provider] = provider_id
+                self.providers_by_id.append(provider)
+            self.provider_data.append(provider_id)
+        self.provider_offsets.append(len(self.provider_data))
+        self.creation_dates.append(timestamp)
+        self.block_types.append(block_type)
+        self.sizes.append(size)
+
+    def append_record(self, record, provider_names=None):
+        """
+        Appends a block read from the metadata server to the table without
+        building a MetaBlock for version 2 records
+        Args:
+            record(dict): A dictionary describing the metablock
+            provider_names(dict(int, str), optional): Names of the providers
+                                                      indexed by id, needed for
+                                                      version 2 records
+        Raises:
+            KeyError: If a provider id of a version 2 record is not in provider_names
+        """
+        packed = record.get("record")
+        if packed is None:
+            block = Files.parse_metablock(record)
+            self.append(block.key, block.providers, datetime_to_microseconds(block.creation_date),
+                        block.block_type.value, block.checksum, ",".join(block.entangled_with),
+                        block.size)
+            return
+        _, timestamp, block_type, size, checksum_length = BLOCK_RECORD.unpack_from(packed)
+        checksum = packed[BLOCK_RECORD.size:BLOCK_RECORD.size + checksum_length]
+        provider_names = provider_names or {}
+        providers = [provider_names[provider_id]
+                     for provider_id in unpack_provider_ids(record.get("providers", ""))]
+        self.append(record.get("key"), providers, timestamp, block_type, checksum,
+                    record.get("entangled_with", "").strip(), size)
+
 class Files(object):
     """
     Represents metadata stored in the cluster
     """
     FILE_PREFIX = "files:"
     BLOCK_PREFIX = "blocks:"
+    POINTED_BY_PREFIX = "pointed_by:"
+    PROVIDER_PREFIX = "provider_blocks:"
+    PENDING_PROVIDERS_PREFIX = "pending_providers:"
+    PENDING_PROVIDERS_TTL = 3600
+    PROVIDER_IDS = "provider_ids"
+    PROVIDER_NAMES = "provider_names"
+    ENTANGLEMENT_GRAPH = "entanglement_graph"
     READ_BUFFER_SIZE = 100
     CONNECTION_POOLS = {}
+    CACHES = {}
+    CACHES_LOCK = threading.Lock()
 
     @staticmethod
     def get_pool(host, port):
@@ -279,7 +904,48 @@ class Files(object):
             Files.CONNECTION_POOLS[host][port] = pool
         return Files.CONNECTION_POOLS[host][port]
 
-    def __init__(self, host="metadata", port=6379, pointer_selector=normal_selection):
+    @staticmethod
+    def get_cache(host, port, capacity):
+        """
+        Gets the existing cache of a given server or creates a new one whose
+        entries are invalidated by the keyspace notifications of the server
+        Args:
+            host(str): Host of the redis server
+            port(int): Port number the redis server is listening on
+            capacity(int): Maximum number of entries in the cache if it has to
+                           be created
+        Returns:
+            LRUCache: The cache of the metadata read from the server
+        """
+        with Files.CACHES_LOCK:
+            if (host, port) not in Files.CACHES:
+                cache = LRUCache(capacity)
+                client = redis.StrictRedis(connection_pool=Files.get_pool(host, port),
+                                           encoding=None,
+                                           socket_keepalive=True)
+                # Blocks cache the documents pointing to them
+                invalidator = KeyspaceInvalidator(client, cache,
+                                                  [Files.FILE_PREFIX, Files.BLOCK_PREFIX],
+                                                  {Files.POINTED_BY_PREFIX: Files.BLOCK_PREFIX})
+                invalidator.start()
+                Files.CACHES[(host, port)] = cache
+            return Files.CACHES[(host, port)]
+
+    def __init__(self, host="metadata", port=6379, pointer_selector=normal_selection,
+                 cache_size=0):
+        """
+        Files constructor
+        Args:
+            host(str, optional): Host of the metadata server
+            port(int, optional): Port number the metadata server is listening on
+            pointer_selector(function, optional): Function used to select the
+                                                  positions of random blocks
+            cache_size(int, optional): Maximum number of documents and blocks
+                                       kept in the in-process cache shared by
+                                       the instances connected to the same
+                                       server, 0 disables the cache (defaults
+                                       to 0)
+        """
         try:
             ip_address = str(IPy.IP(host))
         except ValueError:
@@ -289,6 +955,143 @@ class Files(object):
                                        encoding=None,
                                        socket_keepalive=True)
         self.select_pointers = pointer_selector
+        self.fetch_files = self.redis.register_script(FETCH_FILES_SCRIPT)
+        self.fetch_selected_blocks = self.redis.register_script(SELECT_BLOCKS_SCRIPT)
+        self.fetch_graph_since = self.redis.register_script(GRAPH_SINCE_SCRIPT)
+        self.replace_providers = self.redis.register_script(SET_PROVIDERS_SCRIPT)
+        self.append_providers = self.redis.register_script(ADD_PROVIDERS_SCRIPT)
+        self.assign_provider_ids = self.redis.register_script(ASSIGN_PROVIDER_IDS_SCRIPT)
+        self.provider_ids = {}
+        self.provider_names = {}
+        self.cache = None
+        if cache_size > 0:
+            self.cache = Files.get_cache(ip_address, port, cache_size)
+
+    def get_cached_document(self, file_key):
+        """
+        Assembles a document and its blocks from the cache
+        Args:
+            file_key(str): Key of the document hash
+        Returns:
+            MetaDocument: The cached document, None if the document or one of
+                          its blocks is not cached
+        """
+        if self.cache is None:
+            return None
+        frozen = self.cache.get(file_key)
+        if frozen is None:
+            return None
+        document, block_keys = MetaDocument.thaw(frozen)
+        for key in block_keys:
+            block = self.get_cached_block("{:s}{:s}".format(Files.BLOCK_PREFIX, key))
+            if block is None:
+                return None
+            document.blocks.append(block)
+        return document
+
+    def get_cached_block(self, block_key):
+        """
+        Returns a block from the cache
+        Args:
+            block_key(str): Key of the block hash
+        Returns:
+            MetaBlock: The cached block, None if it is not cached
+        """
+        if self.cache is None:
+            return None
+        frozen = self.cache.get(block_key)
+        if frozen is None:
+            return None
+        return MetaBlock.thaw(frozen)
+
+    def cache_document(self, file_key, document, version):
+        """
+        Caches a document and its blocks
+        Args:
+            file_key(str): Key of the document hash
+            document(MetaDocument): The document to cache
+            version(int): Version of the cache read before the document was
+                          fetched
+        """
+        if self.cache is None:
+            return
+        self.cache_blocks(document.blocks, version)
+        self.cache.put(file_key, document.freeze(), version)
+
+    def cache_blocks(self, blocks, version):
+        """
+        Caches blocks
+        Args:
+            blocks(list(MetaBlock)): The blocks to cache
+            version(int): Version of the cache read before the blocks were
+                          fetched
+        """
+        if self.cache is None:
+            return
+        for block in blocks:
+            self.cache.put("{:s}{:s}".format(Files.BLOCK_PREFIX, block.key), block.freeze(), version)
+
+    def invalidate(self, keys):
+        """
+        Removes entries from the cache
+        Args:
+            keys(list(str)): Keys of the document and block hashes to invalidate
+        """
+        if self.cache is None:
+            return
+        for key in keys:
+            self.cache.invalidate(key)
+
+    def get_cache_statistics(self):
+        """
+        Returns the usage statistics of the cache
+        Returns:
+            dict(str, int): The capacity, size, number of hits and misses of the
+                            cache, None if the cache is disabled
+        """
+        if self.cache is None:
+            return None
+        return self.cache.statistics()
+
+    def get_provider_ids(self, providers):
+        """
+        Returns the integer ids of providers, assigning new ids if needed
+        Args:
+            providers(list(str)): Names of the providers
+        Returns:
+            list(int): Ids of the providers
+        """
+        unknown_providers = list(set(providers).difference(self.provider_ids))
+        if unknown_providers:
+            provider_ids = self.assign_provider_ids(keys=[Files.PROVIDER_IDS, Files.PROVIDER_NAMES],
+                                                    args=unknown_providers)
+            for provider, provider_id in zip(unknown_providers, provider_ids):
+                self.provider_ids[provider] = provider_id
+                self.provider_names[provider_id] = provider
+        return [self.provider_ids[provider] for provider in providers]
+
+    def load_provider_names(self):
+        """
+        Loads the mapping of provider ids to names from the metadata server
+        """
+        for provider_id, provider in self.redis.hgetall(Files.PROVIDER_NAMES).items():
+            self.provider_ids[provider] = int(provider_id)
+            self.provider_names[int(provider_id)] = provider
+
+    def read_metablock(self, record):
+        """
+        Parses a metablock from an object, resolving the ids of the providers
+        Args:
+            record(dict): A dictionary describing the metablock
+        Returns:
+            MetaBlock: The parsed MetaBlock
+        """
+        try:
+            return Files.parse_metablock(record, self.provider_names)
+        except KeyError:
+            # The block may be hosted by providers registered by another process
+            self.load_provider_names()
+            return Files.parse_metablock(record, self.provider_names)
 
     def exists(self, path):
         """
@@ -316,11 +1119,14 @@ class Files(object):
             raise ValueError("path argument must be a valid non-empty string")
         return self.get_files([path])[0]
 
-    def get_files(self, paths):
+    def get_files(self, paths, skip_missing=False):
         """
         Returns a Metadata object stored under a given path.
         Args:
             paths(list(str)): The key the Metadata object was stored under
+            skip_missing(bool, optional): Leave out the documents that do not
+                                          exist instead of raising a KeyError
+                                          (defaults to False)
         Returns:
             MetaDocument: The Metadata object stored under the key
         Raises:
@@ -331,33 +1137,39 @@ class Files(object):
         if not paths:
             raise ValueError("path argument must be a valid list of string")
 
-        pipeline = self.redis.pipeline()
         translated_paths = []
-        # Pipeline command to check that all paths exist
         for path in paths:
             if not path:
                 raise ValueError("path in paths list must be a valid non-empty string")
-            file_key = "{:s}{:s}".format(Files.FILE_PREFIX, path)
-            translated_paths.append(file_key)
-            pipeline.exists(file_key)
-        # Check result from pipelined exists requests to make sure that all the
-        # paths exist and pipeline command to get file hashes
-        for index, in_database in enumerate(pipeline.execute()):
-            if not in_database:
+            translated_paths.append("{:s}{:s}".format(Files.FILE_PREFIX, path))
+        metadata = [self.get_cached_document(file_key) for file_key in translated_paths]
+        missing = [index for index, mtdt in enumerate(metadata) if mtdt is None]
+        if not missing:
+            return sorted(metadata, key=lambda mtdt: mtdt.path)
+        version = self.cache.get_version() if self.cache else None
+        # Fetch the documents and their blocks in one round trip
+        records = self.fetch_files(keys=[translated_paths[index] for index in missing],
+                                   args=[Files.BLOCK_PREFIX, Files.POINTED_BY_PREFIX])
+        for index, record in zip(missing, records):
+            if not record:
+                if skip_missing:
+                    continue
                 raise KeyError("path {:s} not found".format(paths[index]))
-            pipeline.hgetall(translated_paths[index])
-        hashes = pipeline.execute()
-        metadata = []
-        keys = []
-        for hsh in hashes:
+            hsh = pairs_to_dict(record[0])
             mtdt = Files.parse_metadata(hsh)
-            path = hsh.get("path")
-            keys += split_blocks_field(path, hsh.get("blocks"))
-            metadata.append(mtdt)
-        blocks = self.get_blocks(keys)
-        step = len(blocks) / len(metadata)
-        for index in xrange(0, len(metadata)):
-            metadata[index].blocks = blocks[index * step:(index * step) + step]
+            keys = split_blocks_field(hsh.get("path"), hsh.get("blocks", ""))
+            blocks = []
+            for key, block_record in zip(keys, record[1:]):
+                if not block_record:
+                    if skip_missing:
+                        break
+                    raise KeyError("key {:s} not found".format(key))
+                blocks.append(self.read_metablock(pairs_to_dict(block_record)))
+            else:
+                mtdt.blocks = sorted(blocks, key=lambda block: block.key)
+                self.cache_document(translated_paths[index], mtdt, version)
+                metadata[index] = mtdt
+        metadata = [mtdt for mtdt in metadata if mtdt is not None]
         return sorted(metadata, key=lambda mtdt: mtdt.path)
 
     def get_block(self, key):
@@ -380,16 +1192,31 @@ class Files(object):
         Raises:
             KeyError: If one of the keys does not exist
         """
-        pipeline = self.redis.pipeline()
         translated_keys = ["{:s}{:s}".format(Files.BLOCK_PREFIX, key) for key in keys]
-        for key in translated_keys:
-            pipeline.exists(key)
-        for index, is_in_database in enumerate(pipeline.execute()):
-            if not is_in_database:
-                raise KeyError("key {:s} not found ({:d} = {:s})".format(keys[index], index, translated_keys[index]))
+        blocks = []
+        missing = []
+        for index, key in enumerate(translated_keys):
+            block = self.get_cached_block(key)
+            if block is None:
+                missing.append(index)
+            else:
+                blocks.append(block)
+        if not missing:
+            return sorted(blocks, key=lambda block: block.key)
+        version = self.cache.get_version() if self.cache else None
+        pipeline = self.redis.pipeline()
+        for index in missing:
             pipeline.hgetall(translated_keys[index])
-        blocks = [Files.parse_metablock(hsh) for hsh in pipeline.execute()]
-        return sorted(blocks, key=lambda block: block.key)
+            pipeline.smembers("{:s}{:s}".format(Files.POINTED_BY_PREFIX, keys[index]))
+        replies = pipeline.execute()
+        fetched = []
+        # HGETALL returns an empty hash for missing keys
+        for index, hsh, documents in zip(missing, replies[::2], replies[1::2]):
+            if not hsh:
+                raise KeyError("key {:s} not found ({:d} = {:s})".format(keys[index], index, translated_keys[index]))
+            fetched.append(self.read_metablock(Files.merge_pointing_documents(hsh, documents)))
+        self.cache_blocks(fetched, version)
+        return sorted(blocks + fetched, key=lambda block: block.key)
 
     def put(self, path, metadata):
         """
@@ -405,57 +1232,218 @@ class Files(object):
         if not metadata:
             raise ValueError("metadata argument must be a valid Metadata object")
         entangling_block_keys = [compute_block_key(eb[0], eb[1]) for eb in metadata.entangling_blocks]
-        entangling_blocks = self.get_blocks(entangling_block_keys)
 
         pipeline = self.redis.pipeline(transaction=True)
-        for block in entangling_blocks:
-            block.entangled_with.append(path)
-            pipeline.hset("{:s}{:s}".format(Files.BLOCK_PREFIX, block.key),
-                          "entangled_with",
-                          ",".join(sorted(block.entangled_with)))
-        meta_hash = {
-            "path": metadata.path,
-            "creation_date": str(metadata.creation_date),
-            "original_size": metadata.original_size,
-            "blocks": ",".join([block.key for block in metadata.blocks]),
-            "entangling_blocks": json.dumps(metadata.entangling_blocks)
-        }
+        self.write_document(pipeline, path, metadata)
+        Files.write_pointers(pipeline, path, entangling_block_keys)
+        Files.pop_pending_providers(pipeline, metadata)
+        replies = pipeline.execute()
+        self.invalidate(["{:s}{:s}".format(Files.BLOCK_PREFIX, key)
+                         for key in entangling_block_keys + [block.key for block in metadata.blocks]] +
+                        ["{:s}{:s}".format(Files.FILE_PREFIX, path)])
+        self.merge_pending_providers(metadata, replies)
+        end = time.clock()
+        elapsed = end - start
+        LOGGER.debug("Storing metadata for {:s} took {:f} seconds".format(path, elapsed))
+        return path
+
+    def write_document(self, pipeline, path, metadata):
+        """
+        Queues the commands storing a document, its blocks and their entries
+        in the indices of the metadata server
+        Args:
+            pipeline(redis.client.StrictPipeline): Pipeline to the metadata server
+            path(str): Path of the document
+            metadata(MetaDocument): The document to store
+        """
+        meta_hash = Files.serialize_metadata(metadata)
         block_keys = []
         for block in metadata.blocks:
-            block_hash = {
-                "key": block.key,
-                "creation_date": str(block.creation_date),
-                "providers": ",".join(sorted(block.providers)),
-                "block_type": block.block_type.name,
-                "checksum": block.checksum,
-                "entangled_with": ",".join(sorted(block.entangled_with)),
-                "size": block.size
-            }
+            block_hash = Files.serialize_metablock(block, self.get_provider_ids(sorted(block.providers)))
             metablock_key = "{:s}{:s}".format(Files.BLOCK_PREFIX, block.key)
             timestamp = (block.creation_date - datetime.datetime(1970, 1, 1)).total_seconds()
             block_keys.append(timestamp)
             block_keys.append(block.key)
             pipeline.hmset(metablock_key, block_hash)
-        pipeline.zadd("block_index", *block_keys)
+            if block.entangled_with:
+                pipeline.sadd("{:s}{:s}".format(Files.POINTED_BY_PREFIX, block.key),
+                              *block.entangled_with)
+            for provider in set(block.providers):
+                pipeline.sadd("{:s}{:s}".format(Files.PROVIDER_PREFIX, provider), block.key)
+        if block_keys:
+            pipeline.zadd("block_index", *block_keys)
         pipeline.hmset("files:{:s}".format(path), meta_hash)
+        pipeline.hset(Files.ENTANGLEMENT_GRAPH, path,
+                      json.dumps(Files.format_graph_entry(metadata)))
         timestamp = (metadata.creation_date - datetime.datetime(1970, 1, 1)).total_seconds()
         pipeline.zadd("file_index", timestamp, path)
-        pipeline.execute()
-        end = time.clock()
-        elapsed = end - start
-        LOGGER.debug("Storing metadata for {:s} took {:f} seconds".format(path, elapsed))
-        return path
 
     @staticmethod
-    def parse_metablock(record):
+    def pop_pending_providers(pipeline, metadata):
+        """
+        Queues the commands reading and removing the providers added to the
+        blocks of a document before it was stored. They must be the last
+        commands of the pipeline.
+        Args:
+            pipeline(redis.client.StrictPipeline): Pipeline to the metadata server
+            metadata(MetaDocument): The document being stored
+        """
+        for block in metadata.blocks:
+            pending_key = "{:s}{:s}".format(Files.PENDING_PROVIDERS_PREFIX, block.key)
+            pipeline.smembers(pending_key)
+            pipeline.delete(pending_key)
+
+    def merge_pending_providers(self, metadata, replies):
+        """
+        Adds the pending providers read by pop_pending_providers to the blocks
+        of a document once it is stored
+        Args:
+            metadata(MetaDocument): The document stored
+            replies(list): The replies of the pipeline that stored the document
+        """
+        pending = replies[len(replies) - 2 * len(metadata.blocks):][::2]
+        for block, providers in zip(metadata.blocks, pending):
+            if providers:
+                self.add_block_providers(block.key, sorted(providers))
+
+    @staticmethod
+    def write_pointers(pipeline, path, block_keys):
+        """
+        Queues the commands registering a document as pointing to blocks. The
+        documents pointing to a block are kept in a set rather than in the
+        block hash so that adding a pointer is a single atomic SADD.
+        Args:
+            pipeline(redis.client.StrictPipeline): Pipeline to the metadata server
+            path(str): Path of the pointing document
+            block_keys(list(str)): Keys of the blocks pointed at
+        """
+        for key in block_keys:
+            pipeline.sadd("{:s}{:s}".format(Files.POINTED_BY_PREFIX, key), path)
+
+    @staticmethod
+    def serialize_metablock(block, provider_ids):
+        """
+        Serializes a metablock to a version 2 record. The documents entangled
+        with the block are not part of the record, they are kept in the set of
+        pointing documents of the block.
+        Args:
+            block(MetaBlock): The metablock to serialize
+            provider_ids(list(int)): Ids of the providers hosting the block
+        Returns:
+            dict: A dictionary describing the metablock
+        """
+        checksum = block.checksum or ""
+        record = BLOCK_RECORD.pack(RECORD_VERSION,
+                                   datetime_to_microseconds(block.creation_date),
+                                   block.block_type.value,
+                                   block.size,
+                                   len(checksum)) + checksum
+        if block.fast_checksum is not None:
+            record += FAST_CHECKSUM.pack(block.fast_checksum)
+        return {
+            "key": block.key,
+            "record": record,
+            "providers": pack_provider_ids(provider_ids)
+        }
+
+    @staticmethod
+    def serialize_metadata(metadata):
+        """
+        Serializes metadata information to a version 2 record
+        Args:
+            metadata(MetaDocument): The metadata to serialize
+        Returns:
+            dict: A dictionary describing the metadata
+        """
+        parts = [DOCUMENT_RECORD.pack(RECORD_VERSION,
+                                      datetime_to_microseconds(metadata.creation_date),
+                                      metadata.original_size,
+                                      len(metadata.entangling_blocks))]
+        for path, index in metadata.entangling_blocks:
+            path = path.encode("utf-8") if isinstance(path, unicode) else path
+            parts.append(ENTANGLING_BLOCK.pack(len(path), index))
+            parts.append(path)
+        return {
+            "path": metadata.path,
+            "blocks": ",".join([block.key for block in metadata.blocks]),
+            "record": "".join(parts)
+        }
+
+    @staticmethod
+    def merge_pointing_documents(record, documents):
+        """
+        Sets the documents pointing to a block as the entangled_with field of
+        its record. Blocks stored before the documents were kept in a set have
+        the field, which is merged with the set.
+        Args:
+            record(dict): A dictionary describing the metablock
+            documents(set(str)): Paths of the documents pointing to the block
+        Returns:
+            dict: The record
+        """
+        if documents:
+            record["entangled_with"] = ",".join(sorted(Files.merge_legacy_pointers(record.get("entangled_with"),
+                                                                                 documents)))
+        return record
+
+    @staticmethod
+    def merge_legacy_pointers(entangled_with, documents):
+        """
+        Merges the entangled_with field of a block stored before the documents
+        pointing to it were kept in a set with the documents of the set
+        Args:
+            entangled_with(str): Comma-joined paths of the documents, None if
+                                 the block does not have the field
+            documents(set(str)): Paths of the documents in the set
+        Returns:
+            set(str): The paths of the documents pointing to the block
+        """
+        merged = set(documents)
+        entangled_with = (entangled_with or "").strip()
+        if entangled_with:
+            merged.update(entangled_with.split(","))
+        return merged
+
+    @staticmethod
+    def parse_metablock(record, provider_names=None):
         """
         Parses a metablock from an object
         Args:
             record(dict): A dictionary describing the metablock
+            provider_names(dict(int, str), optional): Names of the providers
+                                                      indexed by id, needed for
+                                                      version 2 records
         Returns:
             MetaBlock: The parsed MetaBlock
+        Raises:
+            KeyError: If a provider id of a version 2 record is not in provider_names
         """
         key = record.get("key")
+        entangled_with = record.get("entangled_with", "").strip()
+        if entangled_with:
+            entangled_with = entangled_with.split(",")
+        else:
+            entangled_with = []
+
+        packed = record.get("record")
+        if packed is not None:
+            _, timestamp, block_type, size, checksum_length = BLOCK_RECORD.unpack_from(packed)
+            checksum = packed[BLOCK_RECORD.size:BLOCK_RECORD.size + checksum_length]
+            fast_checksum = None
+            if len(packed) >= BLOCK_RECORD.size + checksum_length + FAST_CHECKSUM.size:
+                fast_checksum = FAST_CHECKSUM.unpack_from(packed, BLOCK_RECORD.size + checksum_length)[0]
+            provider_names = provider_names or {}
+            providers = [provider_names[provider_id]
+                         for provider_id in unpack_provider_ids(record.get("providers", ""))]
+            return MetaBlock(key,
+                             creation_date=microseconds_to_datetime(timestamp),
+                             providers=providers,
+                             block_type=BlockType(block_type),
+                             checksum=checksum,
+                             entangled_with=entangled_with,
+                             size=size,
+                             fast_checksum=fast_checksum)
+
         try:
             creation_date = datetime.datetime.strptime(record.get("creation_date"),"%Y-%m-%d %H:%M:%S.%f")
         except:
@@ -466,12 +1454,6 @@ class Files(object):
         else:
             providers = []
 
-        entangled_with = record.get("entangled_with", "").strip()
-        if entangled_with:
-            entangled_with = entangled_with.split(",")
-        else:
-            entangled_with = []
-
         block_type = BlockType[record.get("block_type")]
         checksum = record.get("checksum")
         size = int(record.get("size", "0"))
@@ -494,6 +1476,19 @@ class Files(object):
             MetaDocument: The parsed Metadata
         """
         path = record.get("path")
+        packed = record.get("record")
+        if packed is not None:
+            _, timestamp, original_size, number_of_entangling_blocks = DOCUMENT_RECORD.unpack_from(packed)
+            metadata = MetaDocument(path, original_size=original_size)
+            metadata.creation_date = microseconds_to_datetime(timestamp)
+            offset = DOCUMENT_RECORD.size
+            for _ in xrange(number_of_entangling_blocks):
+                path_length, index = ENTANGLING_BLOCK.unpack_from(packed, offset)
+                offset += ENTANGLING_BLOCK.size
+                metadata.entangling_blocks.append([packed[offset:offset + path_length], index])
+                offset += path_length
+            return metadata
+
         original_size = int(record.get("original_size"))
         creation_date = datetime.datetime.strptime(record.get("creation_date"),
                                                    "%Y-%m-%d %H:%M:%S.%f")
@@ -518,16 +1513,116 @@ class Files(object):
         """
         return self.redis.zrange("block_index", 0, -1)
 
+    def scan_blocks(self, table=None):
+        """
+        Loads all the blocks of the system in a compact BlockTable, reading
+        READ_BUFFER_SIZE blocks at a time in the order of the block index.
+        Args:
+            table(BlockTable, optional): Table to append the blocks to
+        Returns:
+            BlockTable: All the blocks in the system
+        """
+        if table is None:
+            table = BlockTable()
+        position = 0
+        while True:
+            keys = self.redis.zrange("block_index", position, position + Files.READ_BUFFER_SIZE - 1)
+            if not keys:
+                return table
+            pipeline = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hgetall("{:s}{:s}".format(Files.BLOCK_PREFIX, key))
+                pipeline.smembers("{:s}{:s}".format(Files.POINTED_BY_PREFIX, key))
+            replies = pipeline.execute()
+            for record, documents in zip(replies[::2], replies[1::2]):
+                if not record:
+                    # The block was removed since the index was read
+                    continue
+                Files.merge_pointing_documents(record, documents)
+                try:
+                    table.append_record(record, self.provider_names)
+                except KeyError:
+                    # The block may be hosted by providers registered by another process
+                    self.load_provider_names()
+                    table.append_record(record, self.provider_names)
+            position += len(keys)
+
     def values(self):
         """
         Returns all files metadata objects
         Returns:
             list(MetaDocument): All the metadata object stored in the system
         """
-        filenames = self.keys()
-        if not filenames:
-            return []
-        return self.get_files(filenames)
+        return list(self.iter_values())
+
+    def iter_index_entries(self, name, after=None):
+        """
+        Lazily iterates over the entries of an index in the order of their
+        scores, reading READ_BUFFER_SIZE entries at a time from the last entry
+        read instead of from an offset.
+        Args:
+            name(str): Name of the index
+            after((float, str), optional): Score and member of the entry to
+                                           start after (defaults to None to
+                                           start from the first entry)
+        Yields:
+            (float, str): The scores and the members of the entries
+        """
+        while True:
+            if after is None:
+                entries = self.redis.zrangebyscore(name, "-inf", "+inf", start=0,
+                                                   num=Files.READ_BUFFER_SIZE, withscores=True)
+            else:
+                score, member = after
+                # Entries sharing a score are ordered by member
+                entries = [(tied, tied_score) for tied, tied_score
+                           in self.redis.zrangebyscore(name, score, score, withscores=True)
+                           if tied > member]
+                entries += self.redis.zrangebyscore(name, "({!r}".format(score), "+inf", start=0,
+                                                    num=Files.READ_BUFFER_SIZE, withscores=True)
+            if not entries:
+                return
+            for member, score in entries:
+                yield score, member
+            member, score = entries[-1]
+            after = (score, member)
+
+    def iter_listing(self, cursor=None, limit=None):
+        """
+        Lazily lists the documents in the order of the file index along with
+        the cursors to resume the listing after them.
+        Args:
+            cursor(str, optional): Cursor of the last document of the previous
+                                   page (defaults to None to start from the
+                                   beginning of the index)
+            limit(int, optional): Maximum number of documents to list (defaults
+                                  to None for all remaining documents)
+        Yields:
+            (str, MetaDocument): The cursors and the documents
+        Raises:
+            ValueError: If cursor is not a valid cursor or if limit is not an
+                        integer greater or equal to 0
+        """
+        return iter_listing(self, cursor=cursor, limit=limit)
+
+    def iter_values(self, cursor=None, limit=None):
+        """
+        Lazily iterates over the files metadata objects in the order of the
+        file index, fetching them in batches of READ_BUFFER_SIZE documents.
+        Args:
+            cursor(str, optional): Cursor of the last document of the previous
+                                   page (defaults to None to start from the
+                                   beginning of the index)
+            limit(int, optional): Maximum number of metadata objects to return
+                                  (defaults to None for all remaining objects)
+        Yields:
+            MetaDocument: The metadata objects stored in the system
+        Raises:
+            ValueError: If cursor is not a valid cursor or if limit is not an
+                        integer greater or equal to 0
+        """
+        for _, document in self.iter_listing(cursor=cursor, limit=limit):
+            yield document
 
     def select_random_blocks(self, requested):
         """
@@ -540,42 +1635,125 @@ class Files(object):
         start = time.clock()
         blocks_desired = requested
         blocks_available = self.redis.zcard("block_index")
+        version = self.cache.get_version() if self.cache else None
 
         if blocks_available <= blocks_desired:
-            block_keys = self.redis.zrange("block_index", 0, blocks_available)
-            return [self.get_block(key) for key in block_keys]
-
-        selected_indexes = self.select_pointers(blocks_desired, blocks_available)
+            selected_indexes = range(blocks_available)
+        else:
+            selected_indexes = self.select_pointers(blocks_desired, blocks_available)
 
-        selected_keys = []
-        for index in selected_indexes:
-            selected_key = self.redis.zrange("block_index", index, index + 1)[0]
-            selected_keys.append(selected_key)
-        random_blocks = self.get_blocks(selected_keys)
+        # Resolve the selected positions and fetch the blocks in one round trip
+        records = self.fetch_selected_blocks(keys=["block_index"],
+                                             args=[Files.BLOCK_PREFIX, Files.POINTED_BY_PREFIX] +
+                                             list(selected_indexes))
+        random_blocks = []
+        for key, block_record in records:
+            if not block_record:
+                raise KeyError("key {:s} not found".format(key))
+            random_blocks.append(self.read_metablock(pairs_to_dict(block_record)))
+        random_blocks.sort(key=lambda block: block.key)
+        self.cache_blocks(random_blocks, version)
         end = time.clock()
         elapsed = end - start
         LOGGER.debug("Took {:f} seconds to select random blocks".format(elapsed))
         return random_blocks
 
-    def get_entanglement_graph(self):
+    @staticmethod
+    def format_graph_entry(metadata):
         """
-        Scan the database to return the entanglement graph
+        Formats the entry of a document in the entanglement graph
+        Args:
+            metadata(MetaDocument): The document to describe
+        Returns:
+            list(str): The creation date of the document, the blocks it is
+                       entangled with serialized as JSON and its blocks along
+                       with the first provider hosting them
+        """
+        blocks = sorted(metadata.blocks, key=lambda block: block.key)
+        return [
+            str(metadata.creation_date),
+            json.dumps(metadata.entangling_blocks),
+            str([[block.key, block.providers[0]] for block in blocks if block.providers])
+        ]
+
+    def refresh_graph_entry(self, path):
+        """
+        Rewrites the entry of a document in the entanglement graph from the
+        providers currently stored for its blocks. The document and its blocks
+        are watched so that concurrent updates of its blocks retry the refresh.
+        Args:
+            path(str): Path of the document
+        """
+        file_key = "{:s}{:s}".format(Files.FILE_PREFIX, path)
+        def refresh(pipeline):
+            joined_keys = pipeline.hget(file_key, "blocks")
+            if joined_keys is None:
+                return
+            block_keys = ["{:s}{:s}".format(Files.BLOCK_PREFIX, key)
+                          for key in split_blocks_field(path, joined_keys)]
+            if block_keys:
+                pipeline.watch(*block_keys)
+            record = self.fetch_files(keys=[file_key],
+                                      args=[Files.BLOCK_PREFIX, Files.POINTED_BY_PREFIX])[0]
+            if not record:
+                return
+            hsh = pairs_to_dict(record[0])
+            metadata = Files.parse_metadata(hsh)
+            metadata.blocks = [self.read_metablock(pairs_to_dict(block_record))
+                               for block_record in record[1:] if block_record]
+            pipeline.multi()
+            pipeline.hset(Files.ENTANGLEMENT_GRAPH, path,
+                          json.dumps(Files.format_graph_entry(metadata)))
+        self.redis.transaction(refresh, file_key)
+
+    def get_entanglement_graph(self, since=None):
+        """
+        Returns the entanglement graph maintained by put
+        Args:
+            since(float, optional): Only return the documents added to the file
+                                    index since that timestamp (defaults to
+                                    None for the whole graph)
         Returns:
             dict(str, list): The entanglement graph
         """
-        graph = {}
-        filenames = self.keys()
-        for filename in filenames:
-            metadata = self.get(filename)
-            creation_date = str(metadata.creation_date)
-            entangling_blocks = json.dumps(metadata.entangling_blocks)
-            blocks = str([[block.key, block.providers[0]] for block in metadata.blocks])
-            graph[filename] = [
-                creation_date,
-                entangling_blocks,
-                blocks
-            ]
-        return graph
+        if since is None:
+            entries = self.redis.hgetall(Files.ENTANGLEMENT_GRAPH)
+        else:
+            entries = pairs_to_dict(self.fetch_graph_since(keys=["file_index", Files.ENTANGLEMENT_GRAPH],
+                                                           args=[since]))
+        return {path: json.loads(entry) for path, entry in entries.items()}
+
+    def rebuild_entanglement_graph(self):
+        """
+        Scans the database to rebuild the entanglement graph and its reverse
+        index for documents stored before it was maintained by put
+        Returns:
+            int: The number of documents indexed
+        """
+        indexed = 0
+        for metadata in self.iter_values():
+            pipeline = self.redis.pipeline(transaction=True)
+            pipeline.hset(Files.ENTANGLEMENT_GRAPH, metadata.path,
+                          json.dumps(Files.format_graph_entry(metadata)))
+            Files.write_pointers(pipeline, metadata.path,
+                                 [compute_block_key(eb[0], eb[1]) for eb in metadata.entangling_blocks])
+            pipeline.execute()
+            indexed += 1
+        return indexed
+
+    def get_pointing_documents(self, block_key):
+        """
+        Returns the documents that use a block as a pointer
+        Args:
+            block_key(str): Key of the block
+        Returns:
+            set(str): The paths of the documents pointing to the block
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.hget("{:s}{:s}".format(Files.BLOCK_PREFIX, block_key), "entangled_with")
+        pipeline.smembers("{:s}{:s}".format(Files.POINTED_BY_PREFIX, block_key))
+        entangled_with, documents = pipeline.execute()
+        return Files.merge_legacy_pointers(entangled_with, documents)
 
     def has_been_entangled_enough(self, block_key, pointers):
         """
@@ -598,8 +1776,14 @@ class Files(object):
             raise ValueError("path argument must be a valid non-empty string")
         if not isinstance(pointers, int) or pointers < 0:
             raise ValueError("pointers argument must be a valid integer greater or equal to 0")
-        metablock = self.get_block(block_key)
-        return len(metablock.entangled_with) >= pointers
+        block_name = "{:s}{:s}".format(Files.BLOCK_PREFIX, block_key)
+        pipeline = self.redis.pipeline()
+        pipeline.hmget(block_name, "key", "entangled_with")
+        pipeline.smembers("{:s}{:s}".format(Files.POINTED_BY_PREFIX, block_key))
+        (key, entangled_with), documents = pipeline.execute()
+        if key is None:
+            raise KeyError("key {:s} not found".format(block_key))
+        return len(Files.merge_legacy_pointers(entangled_with, documents)) >= pointers
 
     def get_blocks_from_provider(self, provider):
         """
@@ -611,7 +1795,7 @@ class Files(object):
         """
         if not isinstance(provider, str) or not provider:
             raise ValueError("provider argument must be a non empty string")
-        block_names = self.list_blocks()
+        block_names = sorted(self.redis.smembers("{:s}{:s}".format(Files.PROVIDER_PREFIX, provider)))
         if not block_names:
             return []
         number_of_blocks = len(block_names)
@@ -619,12 +1803,78 @@ class Files(object):
         blocks_from_provider = []
         for index in xrange(0, number_of_blocks, step):
             current_range = block_names[index:index + step]
-            blocks = self.get_blocks(current_range)
-            for block in blocks:
-                if provider in block.providers:
-                    blocks_from_provider.append(block)
+            blocks_from_provider += self.get_blocks(current_range)
         return blocks_from_provider
 
+    def set_block_providers(self, key, providers):
+        """
+        Replaces the list of providers hosting a block and updates the provider
+        index and the entanglement graph entry of its document accordingly
+        Args:
+            key(str): Key of the block
+            providers(list(str)): Names of the providers hosting the block
+        Raises:
+            KeyError: If the block does not exist
+        """
+        block_key = "{:s}{:s}".format(Files.BLOCK_PREFIX, key)
+        providers = sorted(providers)
+        updated = self.replace_providers(keys=[block_key, Files.PROVIDER_NAMES],
+                                         args=[Files.PROVIDER_PREFIX,
+                                               key,
+                                               ",".join(providers),
+                                               pack_provider_ids(self.get_provider_ids(providers))])
+        self.invalidate([block_key])
+        if not updated:
+            raise KeyError("key {:s} not found".format(key))
+        self.refresh_graph_entry(extract_path_from_block_key(key))
+
+    def add_block_providers(self, key, providers):
+        """
+        Adds providers to the list of providers hosting a block. If the block
+        has not been stored yet, the providers are kept aside and added by the
+        put storing it.
+        Args:
+            key(str): Key of the block
+            providers(list(str)): Names of the providers to add
+        """
+        if not providers:
+            return
+        block_key = "{:s}{:s}".format(Files.BLOCK_PREFIX, key)
+        pending_key = "{:s}{:s}".format(Files.PENDING_PROVIDERS_PREFIX, key)
+        added = self.append_providers(keys=[block_key, pending_key],
+                                      args=[Files.PROVIDER_PREFIX,
+                                            key,
+                                            Files.PENDING_PROVIDERS_TTL,
+                                            pack_provider_ids(self.get_provider_ids(providers))] +
+                                      list(providers))
+        self.invalidate([block_key])
+        if added == 2:
+            self.refresh_graph_entry(extract_path_from_block_key(key))
+
+    def rebuild_provider_index(self):
+        """
+        Scans the database to rebuild the provider index for blocks stored
+        before it was maintained by put
+        Returns:
+            int: The number of blocks indexed
+        """
+        block_names = self.list_blocks()
+        for index in xrange(0, len(block_names), Files.READ_BUFFER_SIZE):
+            pipeline = self.redis.pipeline(transaction=True)
+            for block in self.get_blocks(block_names[index:index + Files.READ_BUFFER_SIZE]):
+                for provider in set(block.providers):
+                    pipeline.sadd("{:s}{:s}".format(Files.PROVIDER_PREFIX, provider), block.key)
+            pipeline.execute()
+        return len(block_names)
+
+    def get_number_of_files(self):
+        """
+        Return the number of files in the system
+        Returns:
+             int: number of files in the system
+        """
+        return self.redis.zcard("file_index")
+
     def get_number_of_blocks_available(self):
         """
         Return the number of blocks in the system
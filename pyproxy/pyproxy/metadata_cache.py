@@ -0,0 +1,201 @@
+"""
+An in-process cache for the metadata objects read from the metadata server
+"""
+import collections
+import logging
+import threading
+import time
+
+import redis
+
+LOGGER = logging.getLogger("metadata")
+
+class LRUCache(object):
+    """
+    A thread-safe cache bounded in number of entries that evicts the least
+    recently used entries first. Cached values are shared between readers and
+    must therefore be immutable.
+    """
+    def __init__(self, capacity):
+        """
+        LRUCache constructor
+        Args:
+            capacity(int): Maximum number of entries in the cache
+        Raises:
+            ValueError: If capacity is not an integer greater than 0
+        """
+        if not isinstance(capacity, int) or capacity <= 0:
+            raise ValueError("capacity argument must be an integer greater than 0")
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Version at which each key was last invalidated. Versions older than
+        # the floor have been forgotten to bound the memory used.
+        self.version = 0
+        self.versions = {}
+        self.floor = 0
+
+    def get_version(self):
+        """
+        Returns the current version of the cache, to read before fetching
+        values that will be cached
+        Returns:
+            int: The current version of the cache
+        """
+        with self.lock:
+            return self.version
+
+    def get(self, key):
+        """
+        Returns the value cached under a key
+        Args:
+            key(str): Key of the entry
+        Returns:
+            object: The cached value, None if the key is not cached
+        """
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+        return value
+
+    def put(self, key, value, version=None):
+        """
+        Caches a value under a key
+        Args:
+            key(str): Key of the entry
+            value(object): Immutable value to cache
+            version(int, optional): Version of the cache read before the value
+                                    was fetched. If the key has been invalidated
+                                    since, the value may be stale and is not
+                                    cached.
+        """
+        with self.lock:
+            if version is not None and (version < self.floor or
+                                        self.versions.get(key, version) > version):
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Removes an entry from the cache
+        Args:
+            key(str): Key of the entry
+        """
+        with self.lock:
+            self.version += 1
+            if len(self.versions) >= self.capacity:
+                # Values fetched before now are refused whatever their key
+                self.floor = self.version
+                self.versions.clear()
+            self.versions[key] = self.version
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all entries from the cache
+        """
+        with self.lock:
+            self.version += 1
+            self.floor = self.version
+            self.versions.clear()
+            self.entries.clear()
+
+    def statistics(self):
+        """
+        Returns the usage statistics of the cache
+        Returns:
+            dict(str, int): The capacity, size, number of hits and misses of the cache
+        """
+        with self.lock:
+            return {
+                "capacity": self.capacity,
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class KeyspaceInvalidator(threading.Thread):
+    """
+    Listens to the redis keyspace notifications of the metadata server to
+    invalidate the cached entries modified by other processes
+    """
+    RETRY_INTERVAL_IN_SECONDS = 1
+    NOTIFY_KEYSPACE_EVENTS = "Kghs"
+
+    def __init__(self, client, cache, prefixes, dependencies=None, db=0):
+        """
+        KeyspaceInvalidator constructor
+        Args:
+            client(redis.StrictRedis): Client to the metadata server
+            cache(LRUCache): The cache to invalidate
+            prefixes(list(str)): Prefixes of the keys cached
+            dependencies(dict(str, str), optional): Prefixes of keys that are
+                                                    not cached but whose content
+                                                    is part of the cached entry
+                                                    with the same suffix and the
+                                                    given prefix
+            db(int, optional): Database the keys are stored in
+        """
+        super(KeyspaceInvalidator, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.cache = cache
+        self.dependencies = dependencies or {}
+        self.channel_prefix = "__keyspace@{:d}__:".format(db)
+        self.patterns = [self.channel_prefix + prefix + "*"
+                         for prefix in list(prefixes) + list(self.dependencies)]
+
+    def get_cache_key(self, key):
+        """
+        Returns the key of the cache entry affected by a change of a key
+        Args:
+            key(str): The key modified on the metadata server
+        Returns:
+            str: The key of the affected cache entry
+        """
+        for prefix, cached_prefix in self.dependencies.items():
+            if key.startswith(prefix):
+                return cached_prefix + key[len(prefix):]
+        return key
+
+    def enable_keyspace_notifications(self):
+        """
+        Makes sure that the metadata server publishes the keyspace notifications
+        needed for the invalidation
+        """
+        try:
+            flags = self.client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            missing_flags = [flag for flag in KeyspaceInvalidator.NOTIFY_KEYSPACE_EVENTS if flag not in flags]
+            if missing_flags and "A" not in flags:
+                self.client.config_set("notify-keyspace-events", flags + "".join(missing_flags))
+        except redis.ResponseError as error:
+            LOGGER.warning("Could not enable keyspace notifications, changes made by other processes will not invalidate the metadata cache: {}".format(error))
+
+    def run(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                self.enable_keyspace_notifications()
+                pubsub.psubscribe(*self.patterns)
+                # Entries may have changed while no subscription was active
+                self.cache.clear()
+                for message in pubsub.listen():
+                    key = message["channel"][len(self.channel_prefix):]
+                    self.cache.invalidate(self.get_cache_key(key))
+            except Exception as error:
+                # Whatever stopped the subscription, notifications may have been
+                # missed and the cache cannot be trusted anymore
+                LOGGER.exception("Lost keyspace notifications subscription: {}".format(error))
+                self.cache.clear()
+                time.sleep(KeyspaceInvalidator.RETRY_INTERVAL_IN_SECONDS)
+            finally:
+                pubsub.close()
@@ -0,0 +1,484 @@
+"""
+Metadata spread over several metadata servers. Documents are assigned to the
+servers with consistent hashing on their path and their blocks are stored with
+them so that reading a document and its blocks still hits a single server.
+"""
+import bisect
+import hashlib
+import heapq
+import json
+import random
+
+from pyproxy.metadata import BlockTable, compute_block_key, extract_path_from_block_key, Files, \
+                             iter_listing, normal_selection
+
+DEFAULT_SERVER = "metadata:6379"
+
+def parse_server(server):
+    """
+    Splits the address of a metadata server
+    Args:
+        server(str): Address of the server in the host:port format, the port
+                     defaults to 6379
+    Returns:
+        (str, int): The host and the port of the server
+    """
+    host, _, port = server.partition(":")
+    return host, int(port or 6379)
+
+def hash_key(key):
+    """
+    Hashes a key to a position on the hash ring
+    Args:
+        key(str): The key to hash
+    Returns:
+        int: Position of the key on the ring
+    """
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    A consistent hashing ring assigning keys to nodes. Each node is placed at
+    several points of the ring so that adding or removing a node only moves
+    the keys of its neighbours.
+    """
+    VIRTUAL_NODES = 128
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        """
+        HashRing constructor
+        Args:
+            nodes(list(str)): Names of the nodes
+            virtual_nodes(int, optional): Number of points of each node on the ring
+        Raises:
+            ValueError: If nodes is empty or virtual_nodes is not an integer
+                        greater than 0
+        """
+        if not nodes:
+            raise ValueError("nodes argument must be a non-empty list")
+        if not isinstance(virtual_nodes, int) or virtual_nodes <= 0:
+            raise ValueError("virtual_nodes argument must be an integer greater than 0")
+        self.nodes = list(nodes)
+        points = sorted((hash_key("{:s}#{:d}".format(node, index)), node)
+                        for node in self.nodes
+                        for index in xrange(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def get_node(self, key):
+        """
+        Returns the node a key is assigned to
+        Args:
+            key(str): The key
+        Returns:
+            str: Name of the node
+        """
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.owners[index]
+
+class ShardedFiles(object):
+    """
+    Represents metadata stored across several metadata servers. Exposes the
+    same methods as Files.
+    """
+    def __init__(self, servers, pointer_selector=normal_selection, cache_size=0,
+                 virtual_nodes=HashRing.VIRTUAL_NODES):
+        """
+        ShardedFiles constructor
+        Args:
+            servers(list(str)): Addresses of the metadata servers in the
+                                host:port format
+            pointer_selector(function, optional): Function used to select the
+                                                  positions of random blocks
+            cache_size(int, optional): Maximum number of documents and blocks
+                                       kept in the in-process cache of each
+                                       server, 0 disables the cache (defaults
+                                       to 0)
+            virtual_nodes(int, optional): Number of points of each server on
+                                          the hash ring
+        """
+        self.ring = HashRing(servers, virtual_nodes=virtual_nodes)
+        self.select_pointers = pointer_selector
+        self.shards = {}
+        for server in servers:
+            host, port = parse_server(server)
+            self.shards[server] = Files(host=host, port=port,
+                                        pointer_selector=pointer_selector,
+                                        cache_size=cache_size)
+
+    def get_shard(self, path):
+        """
+        Returns the metadata server storing a document and its blocks
+        Args:
+            path(str): Path of the document
+        Returns:
+            Files: The metadata server
+        """
+        return self.shards[self.ring.get_node(path)]
+
+    def get_block_shard(self, key):
+        """
+        Returns the metadata server storing a block
+        Args:
+            key(str): Key of the block
+        Returns:
+            Files: The metadata server
+        """
+        return self.get_shard(extract_path_from_block_key(key))
+
+    def group_by_shard(self, keys, locate):
+        """
+        Groups keys by the server storing them
+        Args:
+            keys(list(str)): The keys to group
+            locate(function): Function returning the server of a key
+        Returns:
+            dict(Files, list(str)): The keys stored on each server
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(locate(key), []).append(key)
+        return groups
+
+    def iter_index(self, name):
+        """
+        Iterates over an index in the order of the scores of its members,
+        merging the indices of all the servers
+        Args:
+            name(str): Name of the index
+        Yields:
+            str: The members of the index
+        """
+        def iter_shard_index(shard):
+            position = 0
+            while True:
+                entries = shard.redis.zrange(name, position, position + Files.READ_BUFFER_SIZE - 1,
+                                             withscores=True)
+                if not entries:
+                    return
+                for member, score in entries:
+                    yield score, member
+                position += len(entries)
+        for _, member in heapq.merge(*[iter_shard_index(shard) for shard in self.shards.values()]):
+            yield member
+
+    def iter_index_entries(self, name, after=None):
+        """
+        Lazily iterates over the entries of an index in the order of their
+        scores, merging the indices of all the servers. Each server resumes
+        from the given entry.
+        Args:
+            name(str): Name of the index
+            after((float, str), optional): Score and member of the entry to
+                                           start after (defaults to None to
+                                           start from the first entry)
+        Yields:
+            (float, str): The scores and the members of the entries
+        """
+        return heapq.merge(*[shard.iter_index_entries(name, after=after)
+                             for shard in self.shards.values()])
+
+    def get_cache_statistics(self):
+        """
+        Returns the usage statistics of the caches of all the servers
+        Returns:
+            dict(str, int): The capacity, size, number of hits and misses of the
+                            caches, None if the caches are disabled
+        """
+        statistics = None
+        for shard in self.shards.values():
+            shard_statistics = shard.get_cache_statistics()
+            if shard_statistics is None:
+                continue
+            if statistics is None:
+                statistics = dict.fromkeys(shard_statistics, 0)
+            for name, value in shard_statistics.items():
+                statistics[name] += value
+        return statistics
+
+    def exists(self, path):
+        return self.get_shard(path).exists(path)
+
+    def get(self, path):
+        return self.get_shard(path).get(path)
+
+    def get_files(self, paths, skip_missing=False):
+        """
+        Returns the metadata of multiple documents, reading the documents
+        stored on each server in one request
+        Args:
+            paths(list(str)): Paths of the documents
+            skip_missing(bool, optional): Leave out the documents that do not
+                                          exist instead of raising a KeyError
+                                          (defaults to False)
+        Returns:
+            list(MetaDocument): The documents sorted by path
+        Raises:
+            KeyError: If a document or one of its blocks does not exist
+        """
+        documents = []
+        for shard, shard_paths in self.group_by_shard(paths, self.get_shard).items():
+            documents += shard.get_files(shard_paths, skip_missing=skip_missing)
+        return sorted(documents, key=lambda document: document.path)
+
+    def get_block(self, key):
+        return self.get_block_shard(key).get_block(key)
+
+    def get_blocks(self, keys):
+        """
+        Returns multiple blocks, reading the blocks stored on each server in
+        one request
+        Args:
+            keys(list(str)): Keys of the blocks
+        Returns:
+            list(MetaBlock): The blocks sorted by key
+        Raises:
+            KeyError: If one of the keys does not exist
+        """
+        blocks = []
+        for shard, shard_keys in self.group_by_shard(keys, self.get_block_shard).items():
+            blocks += shard.get_blocks(shard_keys)
+        return sorted(blocks, key=lambda block: block.key)
+
+    def put(self, path, metadata):
+        """
+        Stores a document on its server and registers it as pointing to its
+        entangling blocks on the servers storing them. Only the writes made to
+        the server of the document are done in a transaction.
+        Args:
+            path(str): Path of the document
+            metadata(MetaDocument): The object to store
+        Returns:
+            str: The key under which the object was stored
+        """
+        if not path:
+            raise ValueError("path argument must be a valid non-empty string")
+        if not metadata:
+            raise ValueError("metadata argument must be a valid Metadata object")
+        home = self.get_shard(path)
+        entangling_block_keys = [compute_block_key(eb[0], eb[1]) for eb in metadata.entangling_blocks]
+        pointers = self.group_by_shard(entangling_block_keys, self.get_block_shard)
+        local_pointers = pointers.pop(home, [])
+        pipeline = home.redis.pipeline(transaction=True)
+        home.write_document(pipeline, path, metadata)
+        Files.write_pointers(pipeline, path, local_pointers)
+        Files.pop_pending_providers(pipeline, metadata)
+        replies = pipeline.execute()
+        home.invalidate(["{:s}{:s}".format(Files.BLOCK_PREFIX, key)
+                         for key in local_pointers + [block.key for block in metadata.blocks]] +
+                        ["{:s}{:s}".format(Files.FILE_PREFIX, path)])
+        home.merge_pending_providers(metadata, replies)
+        for shard, keys in pointers.items():
+            pipeline = shard.redis.pipeline(transaction=True)
+            Files.write_pointers(pipeline, path, keys)
+            pipeline.execute()
+            shard.invalidate(["{:s}{:s}".format(Files.BLOCK_PREFIX, key) for key in keys])
+        return path
+
+    def keys(self):
+        """
+        Returns the documents stored in the system in the order of the file index
+        Returns:
+            list(str): The paths of the documents
+        """
+        return list(self.iter_index("file_index"))
+
+    def list_blocks(self):
+        """
+        Returns the blocks stored in the system in the order of the block index
+        Returns:
+            list(str): The keys of the blocks
+        """
+        return list(self.iter_index("block_index"))
+
+    def scan_blocks(self, table=None):
+        """
+        Loads all the blocks of the system in a compact BlockTable, one server
+        after the other
+        Args:
+            table(BlockTable, optional): Table to append the blocks to
+        Returns:
+            BlockTable: All the blocks in the system
+        """
+        if table is None:
+            table = BlockTable()
+        for shard in self.shards.values():
+            shard.scan_blocks(table)
+        return table
+
+    def values(self):
+        """
+        Returns all files metadata objects
+        Returns:
+            list(MetaDocument): All the metadata object stored in the system
+        """
+        return list(self.iter_values())
+
+    def iter_listing(self, cursor=None, limit=None):
+        """
+        Lazily lists the documents in the order of the file index merged
+        across the servers along with the cursors to resume the listing after
+        them.
+        Args:
+            cursor(str, optional): Cursor of the last document of the previous
+                                   page (defaults to None to start from the
+                                   beginning of the index)
+            limit(int, optional): Maximum number of documents to list (defaults
+                                  to None for all remaining documents)
+        Yields:
+            (str, MetaDocument): The cursors and the documents
+        Raises:
+            ValueError: If cursor is not a valid cursor or if limit is not an
+                        integer greater or equal to 0
+        """
+        return iter_listing(self, cursor=cursor, limit=limit)
+
+    def iter_values(self, cursor=None, limit=None):
+        """
+        Lazily iterates over the files metadata objects in the order of the
+        file index merged across the servers.
+        Args:
+            cursor(str, optional): Cursor of the last document of the previous
+                                   page (defaults to None to start from the
+                                   beginning of the index)
+            limit(int, optional): Maximum number of metadata objects to return
+                                  (defaults to None for all remaining objects)
+        Yields:
+            MetaDocument: The metadata objects stored in the system
+        Raises:
+            ValueError: If cursor is not a valid cursor or if limit is not an
+                        integer greater or equal to 0
+        """
+        for _, document in self.iter_listing(cursor=cursor, limit=limit):
+            yield document
+
+    def select_random_blocks(self, requested):
+        """
+        Returns up to requested randomly selected metablocks. The number of
+        blocks selected on each server is drawn in proportion to the number of
+        blocks it stores and each server then selects its blocks with the
+        pointer selector.
+        Args:
+            requested(int): The number of random blocks to select
+        Returns:
+            list(MetaBlock): randomly selected blocks
+        """
+        shards = self.shards.values()
+        available = [shard.get_number_of_blocks_available() for shard in shards]
+        selected = [0 for _ in shards]
+        remaining = sum(available)
+        for _ in xrange(min(requested, remaining)):
+            draw = random.randrange(remaining)
+            for index, count in enumerate(available):
+                if draw < count - selected[index]:
+                    selected[index] += 1
+                    break
+                draw -= count - selected[index]
+            remaining -= 1
+        blocks = []
+        for shard, shard_requested in zip(shards, selected):
+            if shard_requested:
+                blocks += shard.select_random_blocks(shard_requested)
+        return sorted(blocks, key=lambda block: block.key)
+
+    def get_entanglement_graph(self, since=None):
+        """
+        Returns the entanglement graph merged across the servers
+        Args:
+            since(float, optional): Only return the documents created since this
+                                    timestamp (defaults to None for all documents)
+        Returns:
+            dict(str, list): The entanglement graph entries indexed by path
+        """
+        graph = {}
+        for shard in self.shards.values():
+            graph.update(shard.get_entanglement_graph(since=since))
+        return graph
+
+    def rebuild_entanglement_graph(self):
+        """
+        Scans the servers to rebuild the entanglement graph and the sets of
+        pointing documents, registering the pointers on the servers storing the
+        blocks pointed at
+        Returns:
+            int: The number of documents indexed
+        """
+        indexed = 0
+        for metadata in self.iter_values():
+            home = self.get_shard(metadata.path)
+            home.redis.hset(Files.ENTANGLEMENT_GRAPH, metadata.path,
+                            json.dumps(Files.format_graph_entry(metadata)))
+            entangling_block_keys = [compute_block_key(eb[0], eb[1]) for eb in metadata.entangling_blocks]
+            for shard, keys in self.group_by_shard(entangling_block_keys, self.get_block_shard).items():
+                pipeline = shard.redis.pipeline(transaction=True)
+                Files.write_pointers(pipeline, metadata.path, keys)
+                pipeline.execute()
+            indexed += 1
+        return indexed
+
+    def get_pointing_documents(self, block_key):
+        return self.get_block_shard(block_key).get_pointing_documents(block_key)
+
+    def has_been_entangled_enough(self, block_key, pointers):
+        if not block_key or not isinstance(block_key, str):
+            raise ValueError("path argument must be a valid non-empty string")
+        return self.get_block_shard(block_key).has_been_entangled_enough(block_key, pointers)
+
+    def get_blocks_from_provider(self, provider):
+        """
+        Returns the list of blocks located on a given provider
+        Args:
+            provider(str): Name of the provider
+        Returns:
+            list(MetaBlock): The blocks stored on the provider
+        """
+        blocks = []
+        for shard in self.shards.values():
+            blocks += shard.get_blocks_from_provider(provider)
+        return blocks
+
+    def set_block_providers(self, key, providers):
+        return self.get_block_shard(key).set_block_providers(key, providers)
+
+    def add_block_providers(self, key, providers):
+        return self.get_block_shard(key).add_block_providers(key, providers)
+
+    def rebuild_provider_index(self):
+        """
+        Rebuilds the provider index of every server
+        Returns:
+            int: The number of blocks indexed
+        """
+        return sum(shard.rebuild_provider_index() for shard in self.shards.values())
+
+    def get_number_of_files(self):
+        return sum(shard.get_number_of_files() for shard in self.shards.values())
+
+    def get_number_of_blocks_available(self):
+        return sum(shard.get_number_of_blocks_available() for shard in self.shards.values())
+
+def create_files(configuration=None, pointer_selector=normal_selection):
+    """
+    Creates the metadata backend described in the metadata section of the
+    dispatcher configuration
+    Args:
+        configuration(dict, optional): The metadata configuration with the
+                                       "servers" to use (host:port), the
+                                       "cache_size" and the number of
+                                       "virtual_nodes" of each server on the
+                                       hash ring
+        pointer_selector(function, optional): Function used to select the
+                                              positions of random blocks
+    Returns:
+        Files|ShardedFiles: A single server backend if only one server is
+                            configured, a sharded backend otherwise
+    """
+    configuration = configuration or {}
+    servers = configuration.get("servers", [DEFAULT_SERVER])
+    cache_size = configuration.get("cache_size", 0)
+    if len(servers) == 1:
+        host, port = parse_server(servers[0])
+        return Files(host=host, port=port, pointer_selector=pointer_selector,
+                     cache_size=cache_size)
+    return ShardedFiles(servers, pointer_selector=pointer_selector, cache_size=cache_size,
+                        virtual_nodes=configuration.get("virtual_nodes", HashRing.VIRTUAL_NODES))
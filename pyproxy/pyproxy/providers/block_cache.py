@@ -0,0 +1,596 @@
+"""
+A local read-through cache of the blocks read from remote providers, made of
+a memory tier and an optional disk tier shared by all the cached providers.
+Only the replicas that passed the checksum verification of the dispatcher are
+admitted, and the cached copy of a replica is dropped whenever the replica is
+written, deleted or found corrupted.
+"""
+import collections
+import itertools
+import logging
+import threading
+
+import pyproxy.providers.disk
+import pyproxy.providers.verification
+
+LOGGER = logging.getLogger("dispatcher")
+
+
+class FrequencySketch(object):
+    """
+    A count-min sketch estimating how often each block was requested recently.
+    The counters saturate at 15 and are halved once enough increments have
+    been recorded so that the estimates favour the recent requests, as in
+    TinyLFU. The counters are halved one column per increment rather than all
+    at once, so that no request pays for a full pass over the sketch.
+    """
+    DEPTH = 4
+    MAXIMUM_COUNT = 15
+    SAMPLE_FACTOR = 10
+
+    def __init__(self, width):
+        """
+        FrequencySketch constructor
+        Args:
+            width(int): Number of counters of each row of the sketch
+        Raises:
+            ValueError: If width is not an integer greater than 0
+        """
+        if not isinstance(width, int) or width <= 0:
+            raise ValueError("width argument must be an integer greater than 0")
+        self.width = width
+        self.rows = [[0] * width for _ in xrange(FrequencySketch.DEPTH)]
+        self.sample_size = width * FrequencySketch.SAMPLE_FACTOR
+        self.increments = 0
+        # Next column to halve, width when no halving is in progress
+        self.halved = width
+
+    def __get_positions(self, key):
+        return [hash((depth, key)) % self.width for depth in xrange(FrequencySketch.DEPTH)]
+
+    def increment(self, key):
+        """
+        Records a request for a key. Once the sample size is reached, the
+        following increments each halve one column of counters until all of
+        them are halved, well before the sample size is reached again.
+        Args:
+            key(str): The key requested
+        """
+        for row, position in zip(self.rows, self.__get_positions(key)):
+            if row[position] < FrequencySketch.MAXIMUM_COUNT:
+                row[position] += 1
+        self.increments += 1
+        if self.increments >= self.sample_size:
+            self.increments /= 2
+            self.halved = 0
+        if self.halved < self.width:
+            for row in self.rows:
+                row[self.halved] >>= 1
+            self.halved += 1
+
+    def estimate(self, key):
+        """
+        Args:
+            key(str): The key requested
+        Returns:
+            int: An estimate of the number of recent requests for the key
+        """
+        return min(row[position] for row, position in zip(self.rows, self.__get_positions(key)))
+
+
+class CacheTier(object):
+    """
+    The entries of a cache tier, bounded in bytes and ordered from the least
+    to the most recently used, along with the hit and miss counters of the
+    tier. The data of the entries is kept by the subclasses. Each entry gets a
+    new token when it is added so that a write can tell whether its entry was
+    discarded or replaced while the data was being written.
+    """
+    def __init__(self, capacity):
+        """
+        CacheTier constructor
+        Args:
+            capacity(int): Maximum number of bytes held by the tier
+        Raises:
+            ValueError: If capacity is not an integer greater than 0
+        """
+        if not isinstance(capacity, (int, long)) or capacity <= 0:
+            raise ValueError("capacity argument must be an integer greater than 0")
+        self.capacity = capacity
+        self.sizes = collections.OrderedDict()
+        self.size = 0
+        self.tokens = {}
+        self.next_token = itertools.count()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "admissions": 0,
+            "rejections": 0,
+            "evictions": 0,
+            "errors": 0
+        }
+
+    def touch(self, key):
+        """
+        Marks an entry as the most recently used one and counts the lookup
+        Args:
+            key(str): Key of the entry
+        Returns:
+            bool: Whether the entry is in the tier
+        """
+        size = self.sizes.pop(key, None)
+        if size is None:
+            self.counters["misses"] += 1
+            return False
+        self.sizes[key] = size
+        self.counters["hits"] += 1
+        return True
+
+    def select_victims(self, size):
+        """
+        Returns the least recently used entries to evict to make room for an
+        entry
+        Args:
+            size(int): Size in bytes of the entry
+        Returns:
+            list(str): The keys of the entries to evict, None if the entry is
+                       larger than the tier
+        """
+        if size > self.capacity:
+            return None
+        victims = []
+        freed = 0
+        for key, entry_size in self.sizes.iteritems():
+            if self.size - freed + size <= self.capacity:
+                break
+            victims.append(key)
+            freed += entry_size
+        return victims
+
+    def add(self, key, size):
+        """
+        Records an entry
+        Args:
+            key(str): Key of the entry
+            size(int): Size in bytes of the entry
+        Returns:
+            int: The token of the entry
+        """
+        self.remove(key)
+        self.sizes[key] = size
+        self.size += size
+        self.counters["admissions"] += 1
+        token = next(self.next_token)
+        self.tokens[key] = token
+        return token
+
+    def remove(self, key):
+        """
+        Forgets an entry
+        Args:
+            key(str): Key of the entry
+        Returns:
+            bool: Whether the entry was in the tier
+        """
+        size = self.sizes.pop(key, None)
+        if size is None:
+            return False
+        self.size -= size
+        del self.tokens[key]
+        return True
+
+    def statistics(self):
+        """
+        Returns:
+            dict: The counters of the tier, its hit rate, the number of entries
+                  and bytes it holds and its capacity
+        """
+        statistics = dict(self.counters)
+        lookups = self.counters["hits"] + self.counters["misses"]
+        statistics["hit_rate"] = float(self.counters["hits"]) / lookups if lookups else 0.0
+        statistics["entries"] = len(self.sizes)
+        statistics["size"] = self.size
+        statistics["capacity"] = self.capacity
+        return statistics
+
+
+class MemoryTier(CacheTier):
+    """
+    A cache tier keeping the blocks in memory
+    """
+    def __init__(self, capacity):
+        super(MemoryTier, self).__init__(capacity)
+        self.blocks = {}
+
+    def read(self, key):
+        return self.blocks.get(key)
+
+    def write(self, key, data):
+        self.blocks[key] = data
+
+    def erase(self, key):
+        self.blocks.pop(key, None)
+
+
+class DiskTier(CacheTier):
+    """
+    A cache tier keeping the blocks in files spread over hashed directories.
+    The blocks left by a previous run are erased since the keys of the blocks
+    only depend on the path of their document, which may have been deleted
+    and uploaded again meanwhile.
+    """
+    def __init__(self, folder, capacity):
+        super(DiskTier, self).__init__(capacity)
+        pyproxy.providers.disk.mkdir_p(folder)
+        self.disk = pyproxy.providers.disk.Disk(folder, layout=pyproxy.providers.disk.Disk.HASHED,
+                                                fsync=pyproxy.providers.disk.Disk.FSYNC_NEVER)
+        for key in self.disk.list():
+            self.disk.delete(key)
+
+    def read(self, key):
+        return self.disk.get(key)
+
+    def write(self, key, data):
+        self.disk.put(data, key)
+
+    def erase(self, key):
+        self.disk.delete(key)
+
+
+class BlockCache(object):
+    """
+    A read-through cache of blocks with a memory tier and an optional disk
+    tier. Blocks missing from the cache are only admitted in a full tier if
+    they are expected to be requested more often than the blocks they evict,
+    their popularity being their estimated frequency of requests plus a bonus
+    for each document pointing to them. The blocks evicted from the memory
+    tier are offered to the disk tier. The cache is best effort: the errors of
+    the tiers are logged and counted, and the entries that could not be
+    written are forgotten.
+    """
+    MEMORY_SIZE = 256 * 1024 * 1024
+    POINTER_WEIGHT = 1
+    POINTER_HINTS = 100000
+
+    def __init__(self, memory_size=MEMORY_SIZE, disk_folder=None, disk_size=0, pointer_weight=POINTER_WEIGHT):
+        """
+        BlockCache constructor
+        Args:
+            memory_size(int, optional): Maximum number of bytes cached in memory
+            disk_folder(str, optional): Folder of the disk tier, None to only
+                                        cache the blocks in memory
+            disk_size(int, optional): Maximum number of bytes cached on disk
+            pointer_weight(int, optional): Bonus added to the popularity of a
+                                           block for each document pointing to
+                                           it
+        Raises:
+            ValueError: If memory_size is not an integer greater than 0,
+                        disk_size is not an integer greater than 0 while
+                        disk_folder is set or pointer_weight is negative
+        """
+        if not isinstance(pointer_weight, (int, float)) or pointer_weight < 0:
+            raise ValueError("pointer_weight argument must be a number greater or equal to 0")
+        self.lock = threading.Lock()
+        self.tiers = [("memory", MemoryTier(memory_size))]
+        if disk_folder is not None:
+            self.tiers.append(("disk", DiskTier(disk_folder, disk_size)))
+        self.pointer_weight = pointer_weight
+        self.pointers = collections.OrderedDict()
+        self.sketch = FrequencySketch(max(memory_size / (64 * 1024), 1024))
+
+    @staticmethod
+    def get_cache_key(provider, key):
+        """
+        Returns the key of the replica of a block read from a provider. The
+        replicas are cached separately so that a corrupted replica does not
+        hide the replicas of the other providers.
+        """
+        return "{:s}/{:s}".format(provider, key)
+
+    def record_pointers(self, metablocks):
+        """
+        Records the number of documents pointing to blocks about to be read
+        Args:
+            metablocks(list(MetaBlock)): The metablocks of the blocks
+        """
+        with self.lock:
+            for metablock in metablocks:
+                self.pointers.pop(metablock.key, None)
+                self.pointers[metablock.key] = len(metablock.entangled_with)
+            while len(self.pointers) > BlockCache.POINTER_HINTS:
+                self.pointers.popitem(last=False)
+
+    def __get_popularity(self, key):
+        return self.sketch.estimate(key) + self.pointer_weight * self.pointers.get(key, 0)
+
+    def get(self, provider, key):
+        """
+        Reads a replica from the cache, moving it to the memory tier if it is
+        read from the disk tier and popular enough
+        Args:
+            provider(str): Name of the provider hosting the replica
+            key(str): Key of the block
+        Returns:
+            bytes: The data of the replica, None if it is not cached
+        """
+        cache_key = BlockCache.get_cache_key(provider, key)
+        with self.lock:
+            self.sketch.increment(key)
+            for index, (_, tier) in enumerate(self.tiers):
+                if tier.touch(cache_key):
+                    break
+            else:
+                return None
+        data = self.__read(tier, cache_key)
+        if data is None:
+            # The entry was evicted while being read or could not be read
+            return None
+        if index > 0:
+            self.__admit(cache_key, key, data, 0, index)
+        return data
+
+    def contains(self, provider, key):
+        """
+        Args:
+            provider(str): Name of the provider hosting the replica
+            key(str): Key of the block
+        Returns:
+            bool: Whether the replica is cached
+        """
+        cache_key = BlockCache.get_cache_key(provider, key)
+        with self.lock:
+            return any(cache_key in tier.sizes for _, tier in self.tiers)
+
+    def put(self, provider, key, data):
+        """
+        Offers a replica read from a provider to the cache unless it is
+        already cached
+        Args:
+            provider(str): Name of the provider hosting the replica
+            key(str): Key of the block
+            data(bytes): The data of the replica
+        """
+        if self.contains(provider, key):
+            return
+        self.__admit(BlockCache.get_cache_key(provider, key), key, str(data), 0, len(self.tiers))
+
+    def __admit(self, cache_key, key, data, first_tier, last_tier):
+        """
+        Offers an entry to the tiers in [first_tier, last_tier[ until one of
+        them admits it, offering the entries it evicts to the following tiers.
+        The entries are read, written and erased outside of the lock, a
+        concurrent read of an entry not written yet being a miss.
+        """
+        token = None
+        erased = []
+        demoted = []
+        admitted = None
+        with self.lock:
+            popularity = self.__get_popularity(key)
+            for index in xrange(first_tier, last_tier):
+                tier = self.tiers[index][1]
+                victims = tier.select_victims(len(data))
+                if victims is None or \
+                   any(self.__get_popularity(victim.split("/", 1)[1]) >= popularity for victim in victims):
+                    tier.counters["rejections"] += 1
+                    continue
+                for victim in victims:
+                    tier.remove(victim)
+                    tier.counters["evictions"] += 1
+                    erased.append((tier, victim))
+                    if index + 1 < len(self.tiers):
+                        demoted.append((index, tier, victim))
+                for other in xrange(index + 1, len(self.tiers)):
+                    if self.tiers[other][1].remove(cache_key):
+                        erased.append((self.tiers[other][1], cache_key))
+                token = tier.add(cache_key, len(data))
+                admitted = tier
+                break
+        # The evicted entries are read before being erased to be demoted
+        demoted = [(index, victim, self.__read(tier, victim)) for index, tier, victim in demoted]
+        for tier, victim in erased:
+            self.__erase(tier, victim)
+        if admitted is not None:
+            self.__write(admitted, cache_key, data, token)
+        for index, victim, victim_data in demoted:
+            if victim_data is not None:
+                self.__admit(victim, victim.split("/", 1)[1], victim_data, index + 1, len(self.tiers))
+
+    def __count_error(self, tier, operation, cache_key, error):
+        LOGGER.warning("Could not {:s} {:s} in the block cache: {}".format(operation, cache_key, error))
+        with self.lock:
+            tier.counters["errors"] += 1
+
+    def __read(self, tier, cache_key):
+        """
+        Reads an entry from a tier
+        Returns:
+            bytes: The data of the entry, None if it is missing or could not be
+                   read
+        """
+        try:
+            return tier.read(cache_key)
+        except (IOError, OSError) as error:
+            self.__count_error(tier, "read", cache_key, error)
+            return None
+
+    def __erase(self, tier, cache_key):
+        """
+        Erases the data of an entry from a tier
+        """
+        try:
+            tier.erase(cache_key)
+        except (IOError, OSError) as error:
+            self.__count_error(tier, "erase", cache_key, error)
+
+    def __write(self, tier, cache_key, data, token):
+        """
+        Writes the data of an entry added to a tier. The entry is forgotten and
+        its data erased if the write failed or if the entry was discarded or
+        replaced in the meantime, since the data written may then be stale or
+        no longer accounted for.
+        """
+        try:
+            tier.write(cache_key, data)
+            written = True
+        except (IOError, OSError) as error:
+            self.__count_error(tier, "write", cache_key, error)
+            written = False
+        with self.lock:
+            if written and tier.tokens.get(cache_key) == token:
+                return
+            tier.remove(cache_key)
+        self.__erase(tier, cache_key)
+
+    def discard(self, provider, key):
+        """
+        Removes a replica from the cache
+        Args:
+            provider(str): Name of the provider hosting the replica
+            key(str): Key of the block
+        """
+        cache_key = BlockCache.get_cache_key(provider, key)
+        with self.lock:
+            tiers = [tier for _, tier in self.tiers if tier.remove(cache_key)]
+        for tier in tiers:
+            self.__erase(tier, cache_key)
+
+    def discard_provider(self, provider):
+        """
+        Removes all the replicas of a provider from the cache
+        Args:
+            provider(str): Name of the provider
+        """
+        prefix = BlockCache.get_cache_key(provider, "")
+        erased = []
+        with self.lock:
+            for _, tier in self.tiers:
+                for cache_key in [cache_key for cache_key in tier.sizes if cache_key.startswith(prefix)]:
+                    tier.remove(cache_key)
+                    erased.append((tier, cache_key))
+        for tier, cache_key in erased:
+            self.__erase(tier, cache_key)
+
+    def statistics(self):
+        """
+        Returns:
+            dict(str, dict): The statistics of each tier
+        """
+        with self.lock:
+            return {name: tier.statistics() for name, tier in self.tiers}
+
+
+class CachingProvider(object):
+    """
+    A storage provider reading through a block cache. The replicas read from
+    the wrapped provider are only cached once the dispatcher has verified
+    them, and the writes and deletions drop the cached copies before going to
+    the wrapped provider.
+    """
+    def __init__(self, name, provider, cache):
+        """
+        CachingProvider constructor
+        Args:
+            name(str): Name of the wrapped provider
+            provider(Provider): The provider to wrap
+            cache(BlockCache): The cache shared by the cached providers
+        """
+        self.name = name
+        self.provider = provider
+        self.cache = cache
+
+    def get(self, key):
+        """
+        Args:
+            key(str): Key of the block
+        Returns:
+            bytes: The data of the block, None if it does not exist
+        """
+        data = self.cache.get(self.name, key)
+        if data is not None:
+            return data
+        return self.provider.get(key)
+
+    def get_many(self, keys):
+        """
+        Reads the blocks missing from the cache in a single batch if the
+        wrapped provider supports it
+        Args:
+            keys(list(str)): Keys of the blocks
+        Returns:
+            list(bytes): The data of each block in the order of the keys, None
+                         for the blocks that do not exist
+        """
+        values = [self.cache.get(self.name, key) for key in keys]
+        missing = [index for index, data in enumerate(values) if data is None]
+        if not missing:
+            return values
+        get_many = getattr(self.provider, "get_many", None)
+        if get_many is not None:
+            fetched = get_many([keys[index] for index in missing])
+        else:
+            fetched = [self.provider.get(keys[index]) for index in missing]
+        for index, data in zip(missing, fetched):
+            values[index] = data
+        return values
+
+    def admit(self, metablock, data, verified=True):
+        """
+        Offers a replica to the cache once it was checked against its
+        metablock
+        Args:
+            metablock(MetaBlock): The metablock describing the block
+            data(bytes): The data of the replica
+            verified(bool, optional): Whether the SHA256 digest or the CRC32 of
+                                      the replica was checked, the SHA256
+                                      digest is checked before caching the
+                                      replica otherwise
+        """
+        if self.cache.contains(self.name, metablock.key):
+            return
+        if not verified and \
+           pyproxy.providers.verification.compute_checksum(data) != metablock.checksum:
+            return
+        self.cache.put(self.name, metablock.key, data)
+
+    def reject(self, key):
+        """
+        Drops the cached copy of a replica that did not match its metablock
+        Args:
+            key(str): Key of the block
+        """
+        self.cache.discard(self.name, key)
+
+    def put(self, data, key):
+        self.cache.discard(self.name, key)
+        return self.provider.put(data, key)
+
+    def put_many(self, blocks):
+        for key in blocks:
+            self.cache.discard(self.name, key)
+        put_many = getattr(self.provider, "put_many", None)
+        if put_many is not None:
+            return put_many(blocks)
+        for key, data in blocks.items():
+            self.provider.put(data, key)
+        return True
+
+    def delete(self, key):
+        self.cache.discard(self.name, key)
+        return self.provider.delete(key)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.cache.discard(self.name, key)
+        delete_many = getattr(self.provider, "delete_many", None)
+        if delete_many is not None:
+            return delete_many(keys)
+        return sum(1 for key in keys if self.provider.delete(key))
+
+    def clear(self):
+        self.cache.discard_provider(self.name)
+        return self.provider.clear()
+
+    def __getattr__(self, name):
+        # ping, list and the other operations go to the wrapped provider
+        return getattr(self.provider, name)
@@ -0,0 +1,277 @@
+"""
+Circuit breakers keeping track of the storage providers that stopped answering
+so that the dispatcher can skip them until they recover
+"""
+import logging
+import threading
+import time
+
+import enum
+
+LOGGER = logging.getLogger("dispatcher")
+
+
+class CircuitState(enum.Enum):
+    """
+    State of a circuit breaker. A CLOSED circuit lets every operation through,
+    an OPEN circuit rejects them and a HALF_OPEN circuit lets operations
+    through to check whether the provider recovered
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+
+class CircuitBreaker(object):
+    """
+    Opens after a number of consecutive failures and moves to HALF_OPEN once
+    the reset timeout elapsed. A success closes the circuit while a failure in
+    the HALF_OPEN state opens it again.
+    """
+    FAILURE_THRESHOLD = 3
+    RESET_TIMEOUT = 5.0
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        """
+        CircuitBreaker constructor
+        Args:
+            failure_threshold(int, optional): Number of consecutive failures
+                                              opening the circuit
+            reset_timeout(float, optional): Time in seconds after which an open
+                                            circuit can be tried again
+        Raises:
+            ValueError: If failure_threshold is not an integer greater than 0 or
+                        reset_timeout is negative
+        """
+        if not isinstance(failure_threshold, int) or failure_threshold <= 0:
+            raise ValueError("failure_threshold argument must be an integer greater than 0")
+        if not isinstance(reset_timeout, (int, float)) or reset_timeout < 0:
+            raise ValueError("reset_timeout argument must be a number greater or equal to 0")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = float(reset_timeout)
+        self.lock = threading.Lock()
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    def get_state(self):
+        """
+        Returns the state of the circuit, moving an OPEN circuit to HALF_OPEN if
+        the reset timeout elapsed
+        Returns:
+            CircuitState: The state of the circuit
+        """
+        with self.lock:
+            if self.state == CircuitState.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitState.HALF_OPEN
+            return self.state
+
+    def is_open(self):
+        """
+        Returns:
+            bool: Whether operations should be rejected
+        """
+        return self.get_state() == CircuitState.OPEN
+
+    def record_success(self):
+        """
+        Records a successful operation, closing the circuit
+        """
+        with self.lock:
+            self.failures = 0
+            self.state = CircuitState.CLOSED
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        Records a failed operation, opening the circuit after too many
+        consecutive failures or a failure while HALF_OPEN
+        Returns:
+            bool: Whether the failure opened the circuit
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitState.OPEN:
+                return False
+            if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitState.OPEN
+                self.opened_at = time.time()
+                self.trips += 1
+                return True
+            return False
+
+    def statistics(self):
+        """
+        Returns:
+            dict: The state of the circuit, the number of consecutive failures
+                  and the number of times it opened
+        """
+        state = self.get_state()
+        with self.lock:
+            return {
+                "state": state.name,
+                "failures": self.failures,
+                "trips": self.trips
+            }
+
+
+class ProviderBreakers(object):
+    """
+    Keeps one circuit breaker per provider and probes the providers whose
+    circuit is not closed in the background to detect their recovery
+    """
+    PROBE_INTERVAL = 1.0
+
+    def __init__(self, probe, failure_threshold=CircuitBreaker.FAILURE_THRESHOLD,
+                 reset_timeout=CircuitBreaker.RESET_TIMEOUT, probe_interval=PROBE_INTERVAL):
+        """
+        ProviderBreakers constructor
+        Args:
+            probe(function): Function taking the name of a provider and
+                             returning whether it answers
+            failure_threshold(int, optional): Number of consecutive failures
+                                              opening the circuit of a provider
+            reset_timeout(float, optional): Time in seconds after which the
+                                            circuit of a provider can be tried
+                                            again
+            probe_interval(float, optional): Time in seconds between two probes
+                                             of the providers
+        Raises:
+            ValueError: If failure_threshold is not an integer greater than 0,
+                        reset_timeout is negative or probe_interval is not a
+                        number greater than 0
+        """
+        if not isinstance(failure_threshold, int) or failure_threshold <= 0:
+            raise ValueError("failure_threshold argument must be an integer greater than 0")
+        if not isinstance(reset_timeout, (int, float)) or reset_timeout < 0:
+            raise ValueError("reset_timeout argument must be a number greater or equal to 0")
+        if not isinstance(probe_interval, (int, float)) or probe_interval <= 0:
+            raise ValueError("probe_interval argument must be a number greater than 0")
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = float(probe_interval)
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.prober = None
+
+    def get_breaker(self, provider):
+        """
+        Returns the circuit breaker of a provider, creating it if needed
+        Args:
+            provider(str): Name of the provider
+        Returns:
+            CircuitBreaker: The circuit breaker of the provider
+        """
+        with self.lock:
+            breaker = self.breakers.get(provider)
+            if breaker is None:
+                breaker = CircuitBreaker(failure_threshold=self.failure_threshold,
+                                         reset_timeout=self.reset_timeout)
+                self.breakers[provider] = breaker
+            return breaker
+
+    def is_open(self, provider):
+        """
+        Args:
+            provider(str): Name of the provider
+        Returns:
+            bool: Whether the operations on the provider should be skipped
+        """
+        return self.get_breaker(provider).is_open()
+
+    def get_healthy(self, providers):
+        """
+        Filters out the providers whose circuit is not closed
+        Args:
+            providers(list(str)): Names of the providers
+        Returns:
+            list(str): The providers whose circuit is closed, all the providers
+                       if none of them is
+        """
+        healthy = [provider for provider in providers
+                   if self.get_breaker(provider).get_state() == CircuitState.CLOSED]
+        return healthy or list(providers)
+
+    def record_success(self, provider):
+        """
+        Records a successful operation on a provider
+        Args:
+            provider(str): Name of the provider
+        """
+        self.get_breaker(provider).record_success()
+
+    def record_failure(self, provider):
+        """
+        Records a failed operation on a provider and starts probing the
+        providers if the failure opened its circuit
+        Args:
+            provider(str): Name of the provider
+        """
+        if self.get_breaker(provider).record_failure():
+            LOGGER.warning("Opening the circuit of provider {:s}".format(provider))
+            self.start_probing()
+
+    def start_probing(self):
+        """
+        Starts the thread probing the providers whose circuit is not closed if
+        it is not running yet
+        """
+        with self.lock:
+            if self.prober is not None:
+                return
+            self.prober = threading.Thread(target=self.run_probes, name="provider-prober")
+            self.prober.daemon = True
+            self.prober.start()
+
+    def probe_providers(self):
+        """
+        Probes the providers whose circuit is HALF_OPEN and records the outcome
+        Returns:
+            int: The number of providers whose circuit is not closed
+        """
+        with self.lock:
+            breakers = self.breakers.items()
+        not_closed = 0
+        for provider, breaker in breakers:
+            state = breaker.get_state()
+            if state == CircuitState.HALF_OPEN:
+                try:
+                    answered = self.probe(provider)
+                except Exception:
+                    answered = False
+                if answered:
+                    LOGGER.info("Closing the circuit of provider {:s}".format(provider))
+                    breaker.record_success()
+                    continue
+                breaker.record_failure()
+            if state != CircuitState.CLOSED:
+                not_closed += 1
+        return not_closed
+
+    def run_probes(self):
+        """
+        Probes the providers until all their circuits are closed
+        """
+        while True:
+            time.sleep(self.probe_interval)
+            if self.probe_providers() > 0:
+                continue
+            with self.lock:
+                self.prober = None
+                breakers = self.breakers.values()
+            # A circuit may have opened while the prober was stopping
+            if any(breaker.get_state() != CircuitState.CLOSED for breaker in breakers):
+                self.start_probing()
+            return
+
+    def statistics(self):
+        """
+        Returns:
+            dict(str, dict): The statistics of the circuit breaker of each
+                             provider
+        """
+        with self.lock:
+            breakers = self.breakers.items()
+        return {provider: breaker.statistics() for provider, breaker in breakers}
@@ -0,0 +1,121 @@
+"""
+Plans the blocks to fetch to read a document when some of its data blocks
+cannot be read from the providers
+"""
+import logging
+
+import pyproxy.metadata
+
+LOGGER = logging.getLogger("dispatcher")
+
+
+class ReadPlan(object):
+    """
+    Plans the waves of block reads needed to read a document.
+    The data blocks whose replicas are all hosted on unavailable providers are
+    considered missing up front, so the first wave already fetches the blocks
+    needed to compensate for them. Each following wave only fetches the
+    compensating blocks for the reads that failed in the previous waves, and
+    the number of these fallback waves is bounded.
+    """
+    FALLBACK_WAVES = 2
+
+    def __init__(self, metablocks, get_coder, is_available=None, fallback_waves=FALLBACK_WAVES):
+        """
+        ReadPlan constructor
+        Args:
+            metablocks(dict(int, MetaBlock)): The metablocks of the document
+                                              indexed by block index
+            get_coder(function): Function returning the coder client asked for
+                                 the blocks compensating for the missing ones
+            is_available(function, optional): Function taking the name of a
+                                              provider and returning whether
+                                              it can be read from, None if all
+                                              the providers are
+            fallback_waves(int, optional): Maximum number of waves fetching the
+                                           compensating blocks after the first
+                                           wave
+        Raises:
+            ValueError: If fallback_waves is not an integer greater or equal
+                        to 0
+        """
+        if not isinstance(fallback_waves, int) or fallback_waves < 0:
+            raise ValueError("fallback_waves argument must be an integer greater or equal to 0")
+        self.metablocks = metablocks
+        self.get_coder = get_coder
+        self.fallback_waves = fallback_waves
+        self.data_indices = sorted(index for index, metablock in metablocks.items()
+                                   if metablock.block_type == pyproxy.metadata.BlockType.DATA)
+        if is_available is None:
+            is_available = lambda provider: True
+        self.missing = set(index for index in self.data_indices
+                           if not any(is_available(provider) for provider in metablocks[index].providers))
+        self.blocks = {}
+        self.waves = 0
+
+    def is_degraded(self):
+        """
+        Returns:
+            bool: Whether blocks compensating for missing data blocks have to
+                  be fetched, which requires a call to the coder
+        """
+        return len(self.missing) > 0
+
+    def is_complete(self):
+        """
+        Returns:
+            bool: Whether enough blocks have been fetched to decode the
+                  document
+        """
+        return len(self.blocks) >= len(self.data_indices)
+
+    def next_wave(self):
+        """
+        Returns the blocks to fetch in the next wave, asking the coder for the
+        blocks compensating for the missing ones if needed
+        Returns:
+            list(MetaBlock): The metablocks of the blocks to fetch, an empty
+                             list if the document is complete or no other
+                             block can be fetched
+        """
+        if self.is_complete() or self.waves > self.fallback_waves:
+            return []
+        if self.waves == 0:
+            indices = set(self.data_indices).difference(self.missing)
+        else:
+            indices = set()
+        if self.missing:
+            needed = self.get_coder().fragments_needed(sorted(self.missing))
+            indices.update(index for index in needed if index in self.metablocks)
+        indices.difference_update(self.blocks)
+        indices.difference_update(self.missing)
+        if not indices:
+            return []
+        self.waves += 1
+        LOGGER.debug("Wave {:d} fetches blocks {:s}".format(self.waves,
+                                                            ", ".join(str(index) for index in sorted(indices))))
+        return [self.metablocks[index] for index in sorted(indices)]
+
+    def add(self, blocks, get_index):
+        """
+        Records the outcome of a wave
+        Args:
+            blocks(dict(str, bytes)): The blocks fetched indexed by key, an
+                                      exception in place of the data of the
+                                      blocks that could not be fetched
+            get_index(function): Function returning the index of a block from
+                                 its key
+        """
+        for key, data in blocks.items():
+            index = get_index(key)
+            if isinstance(data, Exception):
+                self.missing.add(index)
+            else:
+                self.blocks[index] = data
+
+    def get_blocks(self):
+        """
+        Returns:
+            list(bytes): The blocks fetched ordered by index
+        """
+        return [self.blocks[index] for index in sorted(self.blocks)]
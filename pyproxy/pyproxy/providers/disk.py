@@ -2,8 +2,14 @@
 A storage provider that writes blocks to the filesystem
 """
 import errno
+import hashlib
+import mmap
 import os
 import shutil
+import threading
+import urllib
+
+import pyproxy.providers.segments
 
 def mkdir_p(path):
     """
@@ -38,12 +44,222 @@ def clean_path(path):
         clean_key = clean_key[1:]
     return clean_key
 
+def sync_directory(path):
+    """
+    Flushes the entries of a directory to the disk so that the files renamed
+    in it survive a crash
+    Args:
+        path(str): Path to the directory
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
 class Disk(object):
     """
-    A storage provider for playcloud that stores blocks on the disk
+    A storage provider for playcloud that stores blocks on the disk, either
+    each in its own file or appended to segment files. In files mode, the
+    block files either mirror the keys of the blocks or are spread over
+    directories named after the hash of the keys, and they are written to a
+    temporary file renamed over the previous version so that a crash never
+    leaves a torn block behind. In the hashed layout, the files of the keys
+    too long to be quoted into a file name are named after a truncated prefix
+    and the digest of the key, the key being kept in a key file next to them. In mmap read mode, the blocks are returned as
+    read-only buffers over memory mapped files instead of being copied into
+    new strings.
     """
-    def __init__(self, folder="/data"):
+    FILES = "files"
+    SEGMENTS = "segments"
+    COPY = "copy"
+    MMAP = "mmap"
+    FLAT = "flat"
+    HASHED = "hashed"
+    FANOUT_LEVELS = 2
+    FSYNC_ALWAYS = "always"
+    FSYNC_BATCH = "batch"
+    FSYNC_NEVER = "never"
+    TEMPORARY_SUFFIX = ".tmp"
+    KEY_SUFFIX = ".key"
+    # Leaves room for the key and temporary suffixes under the 255 bytes limit
+    MAXIMUM_NAME_LENGTH = 180
+    # Quoted keys never contain it, so it marks the truncated names
+    TRUNCATION_MARK = "~"
+
+    def __init__(self, folder="/data", mode=FILES,
+                 segment_size=pyproxy.providers.segments.SegmentStore.SEGMENT_SIZE,
+                 compaction_threshold=pyproxy.providers.segments.SegmentStore.COMPACTION_THRESHOLD,
+                 read_mode=COPY, layout=FLAT, fanout_levels=FANOUT_LEVELS, fsync=FSYNC_BATCH):
+        """
+        Disk constructor
+        Args:
+            folder(str, optional): Folder where the blocks are stored
+            mode(str, optional): "files" to store each block in its own file,
+                                 "segments" to append the blocks to segment
+                                 files
+            segment_size(int, optional): Size in bytes after which a segment is
+                                         sealed in segments mode
+            compaction_threshold(float, optional): Fraction of dead bytes from
+                                                   which a segment is compacted
+                                                   in segments mode
+            read_mode(str, optional): "copy" to read the blocks into new
+                                      strings, "mmap" to return buffers over
+                                      memory mapped files
+            layout(str, optional): "flat" to store the blocks under their key,
+                                   "hashed" to spread them over directories
+                                   named after the hash of their key in files
+                                   mode
+            fanout_levels(int, optional): Number of levels of directories of
+                                          the hashed layout, each level having
+                                          256 directories
+            fsync(str, optional): "always" to sync every block and its
+                                  directory to the disk before returning,
+                                  "batch" to sync the directories once per
+                                  batch of blocks written, "never" to leave
+                                  the flushes to the operating system, in
+                                  files mode
+        Raises:
+            ValueError: If mode, read_mode, layout or fsync is not supported or
+                        fanout_levels is not an integer between 1 and 16
+        """
+        if mode not in (Disk.FILES, Disk.SEGMENTS):
+            raise ValueError("mode argument must be either files or segments")
+        if read_mode not in (Disk.COPY, Disk.MMAP):
+            raise ValueError("read_mode argument must be either copy or mmap")
+        if layout not in (Disk.FLAT, Disk.HASHED):
+            raise ValueError("layout argument must be either flat or hashed")
+        if not isinstance(fanout_levels, int) or not 1 <= fanout_levels <= 16:
+            raise ValueError("fanout_levels argument must be an integer between 1 and 16")
+        if fsync not in (Disk.FSYNC_ALWAYS, Disk.FSYNC_BATCH, Disk.FSYNC_NEVER):
+            raise ValueError("fsync argument must be one of always, batch or never")
         self.root_folder = folder
+        self.memory_map = read_mode == Disk.MMAP
+        self.layout = layout
+        self.fanout_levels = fanout_levels
+        self.fsync = fsync
+        self.segments = None
+        if mode == Disk.SEGMENTS:
+            self.segments = pyproxy.providers.segments.SegmentStore(folder, segment_size=segment_size,
+                                                                    compaction_threshold=compaction_threshold,
+                                                                    memory_map=self.memory_map)
+
+    def get_path(self, key):
+        """
+        Returns the path of the file of a block in files mode
+        Args:
+            key(str): Key of the block
+        Returns:
+            str: The path of the file holding the block
+        """
+        clean_key = clean_path(key)
+        if self.layout == Disk.FLAT:
+            return os.path.join(self.root_folder, clean_key)
+        digest = hashlib.md5(clean_key).hexdigest()
+        directories = [digest[2 * level:2 * level + 2] for level in xrange(self.fanout_levels)]
+        name = urllib.quote(clean_key, safe="")
+        if len(name) > Disk.MAXIMUM_NAME_LENGTH:
+            digest = hashlib.sha256(clean_key).hexdigest()
+            name = "{:s}{:s}{:s}".format(name[:Disk.MAXIMUM_NAME_LENGTH - len(digest) - 1],
+                                         Disk.TRUNCATION_MARK, digest)
+        return os.path.join(self.root_folder, *(directories + [name]))
+
+    def get_key_path(self, path):
+        """
+        Returns the path of the key file of a block in files mode
+        Args:
+            path(str): The path of the file holding the block
+        Returns:
+            str: The path of the key file, None if the name of the file is not
+                 truncated
+        """
+        if self.layout == Disk.FLAT or Disk.TRUNCATION_MARK not in os.path.basename(path):
+            return None
+        return path + Disk.KEY_SUFFIX
+
+    def is_key_file(self, path):
+        """
+        Args:
+            path(str): Path of a file relative to the root folder
+        Returns:
+            bool: Whether the file is the key file of a block
+        """
+        parts = path.split(os.sep)
+        return self.layout == Disk.HASHED and len(parts) == self.fanout_levels + 1 and \
+               Disk.TRUNCATION_MARK in parts[-1] and parts[-1].endswith(Disk.KEY_SUFFIX)
+
+    def prepare_path(self, key):
+        """
+        Creates the directory of the file of a block and its key file if the
+        name of the file is truncated, so that the file can be written
+        Args:
+            key(str): Key of the block
+        Returns:
+            str: The path of the file holding the block
+        """
+        path = self.get_path(key)
+        mkdir_p(os.path.dirname(path))
+        key_path = self.get_key_path(path)
+        if key_path is not None and not os.path.isfile(key_path):
+            self.__write({key_path: clean_path(key)})
+        return path
+
+    def get_key(self, path):
+        """
+        Returns the key of the block stored in a file in files mode
+        Args:
+            path(str): Path of the file relative to the root folder
+        Returns:
+            str: The key of the block, None if the file does not hold a block
+                 in the layout of the provider
+        """
+        if path.endswith(Disk.TEMPORARY_SUFFIX):
+            return None
+        if self.layout == Disk.FLAT:
+            return path
+        parts = path.split(os.sep)
+        if len(parts) != self.fanout_levels + 1 or self.is_key_file(path):
+            return None
+        key_path = self.get_key_path(os.path.join(self.root_folder, path))
+        if key_path is None:
+            key = urllib.unquote(parts[-1])
+        else:
+            try:
+                with open(key_path, "rb") as handle:
+                    key = handle.read()
+            except IOError:
+                return None
+        if os.path.join(self.root_folder, path) != self.get_path(key):
+            return None
+        return key
+
+    def __write(self, blocks):
+        """
+        Writes blocks to temporary files renamed over the previous versions so
+        that readers, including the buffers still mapping a previous version,
+        never see a partially written block
+        Args:
+            blocks(dict(str, bytes)): The data to store indexed by file path
+        """
+        suffix = ".{:d}.{:d}{:s}".format(os.getpid(), threading.current_thread().ident, Disk.TEMPORARY_SUFFIX)
+        for path in sorted(blocks):
+            temporary_path = path + suffix
+            try:
+                with open(temporary_path, "wb") as handle:
+                    handle.write(blocks[path])
+                    if self.fsync != Disk.FSYNC_NEVER:
+                        handle.flush()
+                        os.fsync(handle.fileno())
+                os.rename(temporary_path, path)
+            except Exception:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise
+            if self.fsync == Disk.FSYNC_ALWAYS:
+                sync_directory(os.path.dirname(path))
+        if self.fsync == Disk.FSYNC_BATCH:
+            for directory in set(os.path.dirname(path) for path in blocks):
+                sync_directory(directory)
 
     def get(self, key):
         """
@@ -51,12 +267,25 @@ class Disk(object):
         Args:
             key(str): Path to the block from the filsystem
         Returns:
-            (byte|None): The data or None if the block does not exist
+            (byte|buffer|None): The data, a buffer over the memory mapped block
+                                in mmap read mode, or None if the block does
+                                not exist
         """
-        clean_key = clean_path(key)
-        path = os.path.join(self.root_folder, clean_key)
+        if self.segments is not None:
+            return self.segments.get(clean_path(key))
+        path = self.get_path(key)
         if not os.path.isfile(path):
             return None
+        if self.memory_map:
+            with open(path, "rb") as handle:
+                size = os.fstat(handle.fileno()).st_size
+                # Empty files cannot be mapped
+                if size == 0:
+                    return ""
+                # The mapping outlives the file descriptor and is released
+                # with the last buffer referencing it
+                mapping = mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+            return buffer(mapping, 0, size)
         with open(path, "r") as handle:
             data = handle.read()
         return data
@@ -68,11 +297,41 @@ class Disk(object):
             value(bytes): The data to store
             key(str): Path to the block from the filsystem
         """
-        clean_key = clean_path(key)
-        path = os.path.join(self.root_folder, clean_key)
-        mkdir_p(os.path.dirname(path))
-        with open(path, "w") as handle:
-            handle.write(value)
+        if self.segments is not None:
+            self.segments.put(value, clean_path(key))
+            return
+        self.__write({self.prepare_path(key): value})
+
+    def get_many(self, keys):
+        """
+        Retrieves several blocks from the disk, reading them in the order of
+        their path on the filesystem
+        Args:
+            keys(list(str)): Paths to the blocks from the filesystem
+        Returns:
+            list(byte|buffer|None): The data of each block in the order of the
+                                    keys, None for the blocks that do not
+                                    exist
+        """
+        values = [None] * len(keys)
+        if self.segments is not None:
+            order = sorted(xrange(len(keys)), key=lambda position: clean_path(keys[position]))
+        else:
+            order = sorted(xrange(len(keys)), key=lambda position: self.get_path(keys[position]))
+        for index in order:
+            values[index] = self.get(keys[index])
+        return values
+
+    def put_many(self, blocks):
+        """
+        Saves several blocks on the disk, creating each directory only once
+        Args:
+            blocks(dict(str, bytes)): The data to store indexed by path
+        """
+        if self.segments is not None:
+            self.segments.put_many({clean_path(key): value for key, value in blocks.items()})
+            return
+        self.__write({self.prepare_path(key): value for key, value in blocks.items()})
 
     def delete(self, key):
         """
@@ -82,19 +341,58 @@ class Disk(object):
         Returns:
             bool: True if the block was deleted, False otherwise.
         """
-        clean_key = clean_path(key)
-        path = os.path.join(self.root_folder, clean_key)
+        if self.segments is not None:
+            return self.segments.delete(clean_path(key))
+        path = self.get_path(key)
         if not os.path.exists(path):
             return False
         os.unlink(path)
+        key_path = self.get_key_path(path)
+        if key_path is not None and os.path.exists(key_path):
+            os.unlink(key_path)
         return not os.path.exists(path)
 
+    def delete_many(self, keys):
+        """
+        Deletes several blocks from the filesystem
+        Args:
+            keys(list(str)): Paths to the blocks from the filsystem
+        Returns:
+            int: The number of blocks deleted
+        """
+        return sum(1 for key in keys if self.delete(key))
+
+    def list(self):
+        """
+        Returns:
+            list(str): The keys of the blocks stored on the disk
+        """
+        if self.segments is not None:
+            return self.segments.list()
+        keys = []
+        for directory, _, files in os.walk(self.root_folder):
+            for name in files:
+                key = self.get_key(os.path.relpath(os.path.join(directory, name), self.root_folder))
+                if key is not None:
+                    keys.append(key)
+        return keys
+
+    def ping(self):
+        """
+        Checks that blocks can be written to the root folder
+        Returns:
+            bool: True if the root folder is a writable directory
+        """
+        return os.path.isdir(self.root_folder) and os.access(self.root_folder, os.W_OK)
+
     def clear(self):
         """
         Removes all blocks from the filesystem
         Returns:
             bool: True if all data was deleted, False otherwise
         """
+        if self.segments is not None:
+            return self.segments.clear()
         for entry in os.listdir(self.root_folder):
             path = os.path.join(self.root_folder, entry)
             if os.path.isdir(path):
@@ -103,3 +401,54 @@ class Disk(object):
                 os.remove(path)
 
         return len(os.listdir(self.root_folder)) == 0
+
+def migrate_layout(folder, source_layout, destination_layout, fanout_levels=Disk.FANOUT_LEVELS):
+    """
+    Moves the block files of a folder from one layout to another and removes
+    the temporary files left by interrupted writes. The files already in the
+    destination layout are left in place so that an interrupted migration can
+    be resumed. The providers using the folder should be stopped while it is
+    migrated.
+    Args:
+        folder(str): Folder where the blocks are stored
+        source_layout(str): Current layout of the folder, "flat" or "hashed"
+        destination_layout(str): Layout to move the blocks to, "flat" or
+                                 "hashed"
+        fanout_levels(int, optional): Number of levels of directories of the
+                                      hashed layout
+    Returns:
+        int: The number of blocks moved
+    Raises:
+        ValueError: If a layout is not supported or fanout_levels is not an
+                    integer between 1 and 16
+    """
+    source = Disk(folder, layout=source_layout, fanout_levels=fanout_levels, fsync=Disk.FSYNC_NEVER)
+    destination = Disk(folder, layout=destination_layout, fanout_levels=fanout_levels, fsync=Disk.FSYNC_NEVER)
+    paths = [os.path.join(directory, name) for directory, _, files in os.walk(folder) for name in files]
+    moved = 0
+    for path in paths:
+        if path.endswith(Disk.TEMPORARY_SUFFIX):
+            os.remove(path)
+            continue
+        relative_path = os.path.relpath(path, folder)
+        # Any file is a valid flat path, only hashed paths can be recognized
+        if destination_layout == Disk.HASHED and \
+           (destination.is_key_file(relative_path) or destination.get_key(relative_path) is not None):
+            continue
+        key = source.get_key(relative_path)
+        if key is None:
+            continue
+        destination_path = destination.get_path(key)
+        if destination_path == path:
+            continue
+        destination.prepare_path(key)
+        os.rename(path, destination_path)
+        key_path = source.get_key_path(path)
+        if key_path is not None and os.path.exists(key_path):
+            os.remove(key_path)
+        moved += 1
+    for directory, _, _ in os.walk(folder, topdown=False):
+        if directory != folder and not os.listdir(directory):
+            os.rmdir(directory)
+    sync_directory(folder)
+    return moved
@@ -1,29 +1,46 @@
 """
 A component that distributes blocks for storage keeps track of their location
 """
-import hashlib
+import functools
 import logging
-import multiprocessing
 import random
 import re
 import socket
 import threading
 import time
 
+import concurrent.futures
 import enum
 import redis
 import botocore.exceptions
 
 import pyproxy.coder_client
 import pyproxy.metadata
+import pyproxy.metadata_sharding
 import pyproxy.playcloud_pb2
+import pyproxy.providers.block_cache
+import pyproxy.providers.circuit_breaker
+import pyproxy.providers.degraded_read
 import pyproxy.providers.disk
+import pyproxy.providers.hedging
+import pyproxy.providers.io_pool
 import pyproxy.providers.redis_provider
+import pyproxy.providers.replica_selection
 import pyproxy.providers.s3
+import pyproxy.providers.segments
+import pyproxy.providers.verification
+import pyproxy.providers.write_quorum
 
 
 logger = logging.getLogger("dispatcher")
 
+CONNECTION_ERRORS = (redis.ConnectionError, redis.TimeoutError, socket.error,
+                     botocore.exceptions.EndpointConnectionError)
+
+PROBE_KEY = "__probe__"
+
+MAXIMUM_BATCH_SIZE = 100
+
 
 class Providers(enum.Enum):
     """
@@ -81,7 +98,18 @@ class ProviderFactory(object):
                     time.sleep(sleep_time)
                     tick += 1
         if provider_type == Providers.disk.name:
-            return initializer(folder=configuration.get("folder", "/data"))
+            return initializer(folder=configuration.get("folder", "/data"),
+                               mode=configuration.get("mode", pyproxy.providers.disk.Disk.FILES),
+                               segment_size=configuration.get("segment_size",
+                                                              pyproxy.providers.segments.SegmentStore.SEGMENT_SIZE),
+                               compaction_threshold=configuration.get(
+                                   "compaction_threshold",
+                                   pyproxy.providers.segments.SegmentStore.COMPACTION_THRESHOLD),
+                               read_mode=configuration.get("read_mode", pyproxy.providers.disk.Disk.COPY),
+                               layout=configuration.get("layout", pyproxy.providers.disk.Disk.FLAT),
+                               fanout_levels=configuration.get("fanout_levels",
+                                                               pyproxy.providers.disk.Disk.FANOUT_LEVELS),
+                               fsync=configuration.get("fsync", pyproxy.providers.disk.Disk.FSYNC_BATCH))
         if provider_type == Providers.s3.name:
             tick = 0
             while True:
@@ -136,6 +164,40 @@ class CouldNotPushException(Exception):
         self.key = key
 
 
+def probe_provider(provider):
+    """
+    Checks whether a provider answers
+    Args:
+        provider(Provider): The provider to check
+    Returns:
+        bool: True if the provider answered
+    """
+    ping = getattr(provider, "ping", None)
+    if ping is not None:
+        return bool(ping())
+    provider.get(PROBE_KEY)
+    return True
+
+
+def push_block(provider, metablock, data):
+    """
+    Stores a block on a provider
+    Args:
+        provider(Provider): The provider that will store the data
+        metablock(MetaBlock): The metablock describing the block
+        data(bytes): The data of the block
+    Returns:
+        MetaBlock: The metablock if the block was stored, a
+                   CouldNotPushException otherwise
+    """
+    logger.debug("Going to put block with key {:s} in provider {:s}".format(metablock.key, str(type(provider))))
+    try:
+        provider.put(data, metablock.key)
+        return metablock
+    except redis.ConnectionError:
+        return CouldNotPushException(provider, metablock.key)
+
+
 class BlockPusher(threading.Thread):
     """
     Threaded code to push blocks using a given provider
@@ -160,16 +222,9 @@ class BlockPusher(threading.Thread):
         Loop through self.blocks, selecting those stored at indices
         listed in self.indices and feeding them to self.provider for storage
         """
-        loop_temp = "Going to put block with key {:s} in provider {:s}"
         for metablock, data in self.blocks.iteritems():
-            logger.debug(loop_temp.format(metablock.key, str(type(self.provider))))
-            try:
-                self.provider.put(data, metablock.key)
-                index = extract_index_from_key(metablock.key)
-                self.queue[index] = metablock
-            except redis.ConnectionError:
-                index = extract_index_from_key(metablock.key)
-                self.queue[index] = CouldNotPushException(self.provider, metablock.key)
+            index = extract_index_from_key(metablock.key)
+            self.queue[index] = push_block(self.provider, metablock, data)
 
 
 class ProviderUnreachableException(Exception):
@@ -226,18 +281,192 @@ def place(elements, providers, replication_factor):
         for provider in providers:
             placement[provider] = indices
         return placement
-    index = random.randint(0, number_of_providers - 1)
-    for _ in xrange(replication_factor):
+    start = random.randint(0, number_of_providers - 1)
+    for replica in xrange(replication_factor):
         for element in xrange(elements):
-            provider_name = providers[index]
+            # Each replica of an element goes to the next provider so that the
+            # replicas of an element never share a provider
+            provider_name = providers[(start + element + replica) % number_of_providers]
             provider = placement.get(provider_name, set())
             provider.add(element)
             placement[provider_name] = provider
-            index = (index + 1) % number_of_providers
     return placement
 
 
-def get_block(providers, metablock, queue):
+def read_replica(provider, provider_key, metablock, pool=None, scores=None, breakers=None, verifier=None):
+    """
+    Reads a replica of a block from a provider and checks its integrity.
+    Args:
+        provider(Provider): The provider hosting the replica
+        provider_key(str): Name of the provider
+        metablock(MetaBlock): The metablock describing the block to fetch
+        pool(IOPool, optional): Pool whose concurrency limits apply to the read
+        scores(ProviderScores, optional): Scores updated with the latency and
+                                          the outcome of the read
+        breakers(ProviderBreakers, optional): Circuit breakers of the providers,
+                                              the read is skipped if the
+                                              circuit of the provider is open
+        verifier(BlockVerifier, optional): Checks made on the replicas read,
+                                           None to check the SHA256 digest of
+                                           every replica
+    Returns:
+        bytes: The data of the block, None if the replica could not be read or
+               does not match the checksum of the block
+    """
+    if breakers is not None and breakers.is_open(provider_key):
+        logger.debug("Skipping provider {:s} whose circuit is open".format(provider_key))
+        return None
+    start = time.time()
+    try:
+        data = __read_replica(provider, provider_key, metablock, pool, verifier)
+        if breakers is not None:
+            breakers.record_success(provider_key)
+    except CONNECTION_ERRORS:
+        message = "Received a connection error from provider {:s} trying to get block {:s}".format(provider_key,
+                                                                                                   metablock.key)
+        logger.error(message)
+        if breakers is not None:
+            breakers.record_failure(provider_key)
+        data = None
+    if scores is not None:
+        scores.record(provider_key, time.time() - start, failed=data is None)
+    return data
+
+
+def __read_replica(provider, provider_key, metablock, pool, verifier):
+    """
+    Reads a replica of a block from a provider and checks its integrity
+    """
+    key = metablock.key
+    logger.debug("About to fetch block {:s} from {:s}".format(key, provider_key))
+    if pool is None:
+        data = provider.get(key)
+    else:
+        with pool.provider_slot(provider_key):
+            data = provider.get(key)
+    return __check_replica(provider, data, provider_key, metablock, verifier)
+
+
+def __check_replica(provider, data, provider_key, metablock, verifier):
+    """
+    Checks that a replica read from a provider exists and matches the checksum
+    of its block. Cached providers only cache the replicas that pass the check
+    and drop the cached copies that do not.
+    """
+    key = metablock.key
+    if data is None:
+        message = "Replica of block {:s} cannot be found in {:s}".format(key, provider_key)
+        logger.error(message)
+        return None
+    logger.debug("Checking block {:s}'s integrity".format(key))
+    if verifier is not None:
+        valid = verifier.verify(data, metablock)
+    else:
+        valid = pyproxy.providers.verification.compute_checksum(data) == metablock.checksum
+    if not valid:
+        message = "Block {:s} does not match its checksum".format(key)
+        logger.error(message)
+        reject = getattr(provider, "reject", None)
+        if reject is not None:
+            reject(key)
+        return None
+    admit = getattr(provider, "admit", None)
+    if admit is not None:
+        # A sampled verification may only have compared the size of the replica
+        admit(metablock, data,
+              verified=verifier is None or verifier.mode != pyproxy.providers.verification.VerificationMode.SAMPLED)
+    return data
+
+
+def read_replicas(provider, provider_key, metablocks, pool=None, scores=None, breakers=None, verifier=None):
+    """
+    Reads the replicas of several blocks from a provider in a single batch and
+    checks their integrity.
+    Args:
+        provider(Provider): The provider hosting the replicas
+        provider_key(str): Name of the provider
+        metablocks(list(MetaBlock)): The metablocks describing the blocks to
+                                     fetch
+        pool(IOPool, optional): Pool whose concurrency limits apply to the read
+        scores(ProviderScores, optional): Scores updated with the latency and
+                                          the outcome of the read of each block
+        breakers(ProviderBreakers, optional): Circuit breakers of the providers,
+                                              the read is skipped if the
+                                              circuit of the provider is open
+        verifier(BlockVerifier, optional): Checks made on the replicas read,
+                                           None to check the SHA256 digest of
+                                           every replica
+    Returns:
+        list(bytes): The data of the blocks in the order of the metablocks,
+                     None for the replicas that could not be read or do not
+                     match the checksum of their block
+    """
+    if breakers is not None and breakers.is_open(provider_key):
+        logger.debug("Skipping provider {:s} whose circuit is open".format(provider_key))
+        return [None] * len(metablocks)
+    keys = [metablock.key for metablock in metablocks]
+    logger.debug("About to fetch {:d} blocks from {:s}".format(len(keys), provider_key))
+    start = time.time()
+    try:
+        if pool is None:
+            values = __get_many(provider, keys)
+        else:
+            with pool.provider_slot(provider_key):
+                values = __get_many(provider, keys)
+        if breakers is not None:
+            breakers.record_success(provider_key)
+        replicas = [__check_replica(provider, data, provider_key, metablock, verifier)
+                    for data, metablock in zip(values, metablocks)]
+    except CONNECTION_ERRORS:
+        message = "Received a connection error from provider {:s} trying to get {:d} blocks".format(provider_key,
+                                                                                                     len(keys))
+        logger.error(message)
+        if breakers is not None:
+            breakers.record_failure(provider_key)
+        replicas = [None] * len(metablocks)
+    if scores is not None:
+        # Each read of the batch is accounted for its share of the batch
+        latency = (time.time() - start) / max(len(metablocks), 1)
+        for data in replicas:
+            scores.record(provider_key, latency, failed=data is None)
+    return replicas
+
+
+def __get_many(provider, keys):
+    """
+    Fetches several keys from a provider, one after another if the provider
+    cannot fetch them at once
+    """
+    get_many = getattr(provider, "get_many", None)
+    if get_many is not None:
+        return get_many(keys)
+    return [provider.get(key) for key in keys]
+
+
+def order_replicas(metablock, scores=None, breakers=None):
+    """
+    Orders the providers hosting the replicas of a block
+    Args:
+        metablock(MetaBlock): The metablock describing the block
+        scores(ProviderScores, optional): Scores of the providers, None to
+                                          order the replicas randomly
+        breakers(ProviderBreakers, optional): Circuit breakers of the
+                                              providers, the providers whose
+                                              circuit is open come last
+    Returns:
+        list(str): The providers in the order they should be read from
+    """
+    if scores is not None:
+        replica_providers = scores.order(metablock.providers)
+    else:
+        replica_providers = metablock.providers[:]
+        random.shuffle(replica_providers)
+    if breakers is not None:
+        replica_providers.sort(key=breakers.is_open)
+    return replica_providers
+
+
+def get_block(providers, metablock, queue, pool=None, scores=None, breakers=None, verifier=None):
     """
     Fetches a single block, randomly choosing a replica to return.
     If the replica cannot be found, it moves on to the next one and so on until a replica is found and added to the queue or no replica can be found and a NoReplicaException is added to the queue.
@@ -245,30 +474,23 @@ def get_block(providers, metablock, queue):
         providers(dict(str, Provider)): List of providers that host a copy of the block
         metablock(MetaBlock): The metablock describing the block to fetch
         queue(dict(str, bytes)): The dictionary where the data should be pushed under the block's key
+        pool(IOPool, optional): Pool whose concurrency limits apply to the reads
+        scores(ProviderScores, optional): Scores used to try the replicas by
+                                          increasing expected latency instead
+                                          of randomly and updated by the reads
+        breakers(ProviderBreakers, optional): Circuit breakers of the providers
+                                              whose circuit is open are skipped
+        verifier(BlockVerifier, optional): Checks made on the replicas read,
+                                           None to check the SHA256 digest of
+                                           every replica
     """
     #TODO Push the errors (connection, integrity, not found, ...) into a proper
     # to apply the required fix
     key = metablock.key
-    replica_providers = metablock.providers[:]
-    random.shuffle(replica_providers)
-    for provider_key in replica_providers:
-        provider = providers[provider_key]
-        logger.debug("About to fetch block {:s} from {:s}".format(key, provider_key))
-        try:
-            data = provider.get(key)
-        except redis.ConnectionError:
-            message = "Received a connection error from provider {:s} trying to get block {:s}".format(provider_key, key)
-            logger.error(message)
-            continue
+    for provider_key in order_replicas(metablock, scores, breakers):
+        data = read_replica(providers[provider_key], provider_key, metablock, pool=pool, scores=scores,
+                            breakers=breakers, verifier=verifier)
         if data is None:
-            message = "Replica of block {:s} cannot be found in {:s}".format(key, provider_key)
-            logger.error(message)
-            continue
-        logger.debug("Checking block {:s}'s integrity".format(key))
-        computed_checksum = hashlib.sha256(data).digest()
-        if metablock.checksum != computed_checksum:
-            message = "Block {:s} does not match its checksum".format(key)
-            logger.error(message)
             continue
         logger.debug("Storing block {:s} in synchronization queue".format(key))
         queue[key] = data
@@ -291,28 +513,303 @@ class BlockFetcher(threading.Thread):
         get_block(self.providers, self.metablock, self.queue)
 
 
+def fetch_blocks(providers, metablocks, pool, hedging=None, scores=None, breakers=None, verifier=None):
+    """
+    Fetches blocks from the providers hosting their replicas using the workers
+    of a pool and collects them in memory. A single block is fetched by the
+    calling thread unless the reads are hedged.
+    Args:
+        providers(dict(str, Provider)): The providers indexed by name
+        metablocks(list(MetaBlock)): The metablocks describing the blocks to fetch
+        pool(IOPool): The pool running the reads
+        hedging(HedgingPolicy, optional): Policy deciding when a read that has
+                                          not been answered is also sent to
+                                          another replica, None to read the
+                                          replicas one after another
+        scores(ProviderScores, optional): Scores used to order the replicas
+                                          and updated by the reads
+        breakers(ProviderBreakers, optional): Circuit breakers of the providers
+                                              whose circuit is open are skipped
+        verifier(BlockVerifier, optional): Checks made on the replicas read,
+                                           None to check the SHA256 digest of
+                                           every replica
+    Returns:
+        dict(str, bytes): The blocks indexed by key, a NoReplicaException in
+                          place of the data of the blocks that could not be
+                          fetched
+    """
+    if hedging is not None:
+        return fetch_blocks_with_hedging(providers, metablocks, pool, hedging, scores=scores, breakers=breakers,
+                                         verifier=verifier)
+    def fetch(metablock):
+        fetched = {}
+        get_block({key: providers[key] for key in metablock.providers}, metablock, fetched,
+                  pool=pool, scores=scores, breakers=breakers, verifier=verifier)
+        return fetched
+    blocks = {}
+    for fetched in pool.map(fetch, metablocks):
+        blocks.update(fetched)
+    return blocks
+
+
+def fetch_blocks_async(providers, metablocks, pool, scores=None, breakers=None, verifier=None):
+    """
+    Schedules the fetching of blocks from the providers hosting their replicas
+    on the workers of a pool without waiting for them. The blocks are grouped
+    by the first provider their replicas should be read from and each group is
+    fetched in batches of at most MAXIMUM_BATCH_SIZE blocks. The blocks that
+    could not be read from their first provider are then fetched one by one
+    from their other replicas.
+    Args:
+        providers(dict(str, Provider)): The providers indexed by name
+        metablocks(list(MetaBlock)): The metablocks describing the blocks to fetch
+        pool(IOPool): The pool running the reads
+        scores(ProviderScores, optional): Scores used to order the replicas
+                                          and updated by the reads
+        breakers(ProviderBreakers, optional): Circuit breakers of the providers
+                                              whose circuit is open are skipped
+        verifier(BlockVerifier, optional): Checks made on the replicas read,
+                                           None to check the SHA256 digest of
+                                           every replica
+    Returns:
+        concurrent.futures.Future: The future blocks indexed by key, a
+                                   NoReplicaException in place of the data of
+                                   the blocks that could not be fetched
+    """
+    batches = {}
+    other_replicas = {}
+    for metablock in metablocks:
+        replica_providers = order_replicas(metablock, scores, breakers)
+        if not replica_providers:
+            other_replicas[metablock.key] = metablock
+            continue
+        batches.setdefault(replica_providers[0], []).append(metablock)
+        other_replicas[metablock.key] = pyproxy.metadata.MetaBlock(metablock.key, providers=replica_providers[1:],
+                                                                   checksum=metablock.checksum,
+                                                                   size=metablock.size,
+                                                                   fast_checksum=metablock.fast_checksum)
+    reads = []
+    for provider_key, batch in batches.items():
+        for start in xrange(0, len(batch), MAXIMUM_BATCH_SIZE):
+            chunk = batch[start:start + MAXIMUM_BATCH_SIZE]
+            future = pool.submit(read_replicas, providers[provider_key], provider_key, chunk, pool, scores, breakers,
+                                 verifier)
+            reads.append((chunk, future))
+    def fetch(metablock):
+        fetched = {}
+        get_block({key: providers[key] for key in metablock.providers}, metablock, fetched,
+                  pool=pool, scores=scores, breakers=breakers, verifier=verifier)
+        return fetched
+    def fall_back(_):
+        blocks = {}
+        for chunk, future in reads:
+            for metablock, data in zip(chunk, future.result()):
+                if data is not None:
+                    blocks[metablock.key] = data
+        missing = [other_replicas[metablock.key] for metablock in metablocks if metablock.key not in blocks]
+        def merge(done):
+            for fetched in done.result():
+                blocks.update(fetched)
+            return blocks
+        return pyproxy.providers.io_pool.then(pool.map_async(fetch, missing), merge)
+    return pyproxy.providers.io_pool.then(pyproxy.providers.io_pool.gather([future for _, future in reads]),
+                                          fall_back)
+
+
+def fetch_blocks_with_hedging(providers, metablocks, pool, hedging, scores=None, breakers=None, verifier=None):
+    """
+    Fetches blocks from the providers hosting their replicas, sending the read
+    of a block to the next replica when the replicas already asked have not
+    answered after the delay given by the hedging policy. The first valid
+    replica returned wins and the answers of the other replicas are ignored.
+    The reads run on the workers of the pool while the calling thread waits
+    for their results and sends the hedges.
+    Args:
+        providers(dict(str, Provider)): The providers indexed by name
+        metablocks(list(MetaBlock)): The metablocks describing the blocks to fetch
+        pool(IOPool): The pool running the reads
+        hedging(HedgingPolicy): Policy deciding when a read is hedged
+        scores(ProviderScores, optional): Scores used to order the replicas
+                                          and updated by the reads
+        breakers(ProviderBreakers, optional): Circuit breakers of the providers
+                                              whose circuit is open are skipped
+        verifier(BlockVerifier, optional): Checks made on the replicas read,
+                                           None to check the SHA256 digest of
+                                           every replica
+    Returns:
+        dict(str, bytes): The blocks indexed by key, a NoReplicaException in
+                          place of the data of the blocks that could not be
+                          fetched
+    """
+    delay = hedging.get_delay()
+    blocks = {}
+    metablocks_by_key = {}
+    replicas = {}
+    reads = {}
+    last_read = {}
+    hedges = {}
+    first_provider = {}
+
+    def read(key):
+        provider_key = replicas[key].pop(0)
+        metablock = metablocks_by_key[key]
+        future = pool.submit(read_replica, providers[provider_key], provider_key, metablock, pool, scores, breakers,
+                             verifier)
+        last_read[key] = time.time()
+        reads[future] = (key, provider_key, last_read[key])
+
+    def in_flight(key):
+        return any(read_key == key for read_key, _, _ in reads.values())
+
+    def finish(key, data, provider_key=None):
+        blocks[key] = data
+        for future in [future for future, (read_key, _, _) in reads.items() if read_key == key]:
+            del reads[future]
+        hedging.count_read(hedges[key], provider_key is not None and provider_key != first_provider[key])
+
+    for metablock in metablocks:
+        key = metablock.key
+        metablocks_by_key[key] = metablock
+        replicas[key] = order_replicas(metablock, scores, breakers)
+        hedges[key] = 0
+        if not replicas[key]:
+            blocks[key] = NoReplicaException("Could not found any (valid) replica of block {:s}".format(key))
+            continue
+        first_provider[key] = replicas[key][0]
+        read(key)
+
+    while reads:
+        deadlines = [last_read[key] + delay for key, _, _ in reads.values() if replicas[key]]
+        timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+        done, _ = concurrent.futures.wait(list(reads), timeout=timeout,
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future not in reads:
+                continue
+            key, provider_key, started = reads.pop(future)
+            data = future.result()
+            if data is not None:
+                hedging.record(time.time() - started)
+                finish(key, data, provider_key)
+            elif not in_flight(key):
+                if replicas[key]:
+                    read(key)
+                else:
+                    finish(key, NoReplicaException("Could not found any (valid) replica of block {:s}".format(key)))
+        now = time.time()
+        for key in set(key for key, _, _ in reads.values()):
+            if replicas[key] and now >= last_read[key] + delay:
+                logger.debug("Hedging the read of block {:s}".format(key))
+                hedges[key] += 1
+                read(key)
+    return blocks
+
+
 class Dispatcher(object):
     """
     A class that decices where to store data blocks and keeps track of how to
     retrieve them
     """
 
-    def __init__(self, configuration=None):
+    def __init__(self, configuration=None, cached=True):
         """
         Dispatcher constructor
         Args:
             configuration (dict, optional): A dictionary with the configuration
                 values of the dispatcher
+            cached (bool, optional): Whether the providers flagged as cached
+                read through the block cache, tools auditing the replicas
+                stored by the providers must not
         """
         if configuration is None:
             configuration = {}
+        io_configuration = configuration.get("io", {})
         self.providers = {}
         providers_configuration = configuration.get("providers", {})
         factory = ProviderFactory()
+        # The providers flagged as cached share a single block cache
+        self.block_cache = None
         for name, config in providers_configuration.items():
-            self.providers[name] = factory.get_provider(config)
-        self.files = pyproxy.metadata.Files(host="metadata", port=6379)
+            config = dict(config)
+            cache_provider = config.pop("cached", False) and cached
+            provider = factory.get_provider(config)
+            if cache_provider:
+                if self.block_cache is None:
+                    cache_configuration = io_configuration.get("block_cache", {})
+                    self.block_cache = pyproxy.providers.block_cache.BlockCache(
+                        memory_size=cache_configuration.get("memory_size",
+                                                            pyproxy.providers.block_cache.BlockCache.MEMORY_SIZE),
+                        disk_folder=cache_configuration.get("disk_folder"),
+                        disk_size=cache_configuration.get("disk_size", 0),
+                        pointer_weight=cache_configuration.get("pointer_weight",
+                                                               pyproxy.providers.block_cache.BlockCache.POINTER_WEIGHT))
+                provider = pyproxy.providers.block_cache.CachingProvider(name, provider, self.block_cache)
+            self.providers[name] = provider
+        self.files = pyproxy.metadata_sharding.create_files(configuration.get("metadata", {}))
         self.replication_factor = configuration.get("replication_factor", 3)
+        self.write_quorum = configuration.get("write_quorum",
+                                              max(min(self.replication_factor, len(self.providers)), 1))
+        if not isinstance(self.write_quorum, int) or not 0 < self.write_quorum <= max(self.replication_factor, 1):
+            raise ValueError("write_quorum argument must be an integer between 1 and the replication factor")
+        self.write_statistics = pyproxy.providers.write_quorum.WriteStatistics()
+        self.pool = pyproxy.providers.io_pool.IOPool(
+            workers=io_configuration.get("workers", pyproxy.providers.io_pool.IOPool.WORKERS),
+            provider_concurrency=io_configuration.get("provider_concurrency", 0))
+        self.write_retries = io_configuration.get("write_retries", pyproxy.providers.write_quorum.QuorumWrite.RETRIES)
+        hedging_configuration = io_configuration.get("hedging", {})
+        self.hedging = None
+        if hedging_configuration.get("enabled", False):
+            self.hedging = pyproxy.providers.hedging.HedgingPolicy(
+                percentile=hedging_configuration.get("percentile", pyproxy.providers.hedging.HedgingPolicy.PERCENTILE),
+                window=hedging_configuration.get("window", pyproxy.providers.hedging.HedgingPolicy.WINDOW),
+                delay=hedging_configuration.get("delay", pyproxy.providers.hedging.HedgingPolicy.DELAY))
+        breaker_configuration = io_configuration.get("circuit_breaker", {})
+        self.breakers = pyproxy.providers.circuit_breaker.ProviderBreakers(
+            lambda name: probe_provider(self.providers[name]),
+            failure_threshold=breaker_configuration.get("failure_threshold",
+                                                        pyproxy.providers.circuit_breaker.CircuitBreaker.FAILURE_THRESHOLD),
+            reset_timeout=breaker_configuration.get("reset_timeout",
+                                                    pyproxy.providers.circuit_breaker.CircuitBreaker.RESET_TIMEOUT),
+            probe_interval=breaker_configuration.get("probe_interval",
+                                                     pyproxy.providers.circuit_breaker.ProviderBreakers.PROBE_INTERVAL))
+        # Runs the calls waiting on the reads of the pool, such as the hedged
+        # reads or the requests to the coder, so that no worker of the pool
+        # ever waits on another
+        self.drivers = concurrent.futures.ThreadPoolExecutor(max_workers=self.pool.workers)
+        self.async_providers = {name: pyproxy.providers.io_pool.AsyncProvider(name, provider, self.pool)
+                                for name, provider in self.providers.items()}
+        degraded_reads_configuration = io_configuration.get("degraded_reads", {})
+        self.fallback_waves = degraded_reads_configuration.get("fallback_waves",
+                                                               pyproxy.providers.degraded_read.ReadPlan.FALLBACK_WAVES)
+        verification_configuration = io_configuration.get("verification", {})
+        mode = verification_configuration.get("mode", pyproxy.providers.verification.VerificationMode.ALWAYS.name)
+        if mode.upper() not in pyproxy.providers.verification.VerificationMode.__members__:
+            raise ValueError("verification mode must be one of always, sampled or fast")
+        self.verifier = pyproxy.providers.verification.BlockVerifier(
+            mode=pyproxy.providers.verification.VerificationMode[mode.upper()],
+            sample_rate=verification_configuration.get("sample_rate",
+                                                       pyproxy.providers.verification.BlockVerifier.SAMPLE_RATE))
+        # A single client, and thus a single channel, is shared by all the
+        # requests to the coder
+        self.coder = None
+        self.coder_lock = threading.Lock()
+        selection_configuration = io_configuration.get("replica_selection", {})
+        self.scores = pyproxy.providers.replica_selection.ProviderScores(
+            alpha=selection_configuration.get("alpha", pyproxy.providers.replica_selection.ProviderScores.ALPHA),
+            half_life=selection_configuration.get("half_life",
+                                                  pyproxy.providers.replica_selection.ProviderScores.HALF_LIFE),
+            exploration=selection_configuration.get("exploration",
+                                                    pyproxy.providers.replica_selection.ProviderScores.EXPLORATION))
+
+    def __get_coder(self):
+        """
+        Returns:
+            CoderClient: The client of the coder, created on first use
+        """
+        with self.coder_lock:
+            if self.coder is None:
+                self.coder = pyproxy.coder_client.CoderClient()
+            return self.coder
 
     def list(self):
         """
@@ -332,17 +829,35 @@ class Dispatcher(object):
         Returns:
             A metadata object describing how the blocks have been stored
         """
-        start = time.clock()
+        return self.put_async(path, encoded_file).result()
+
+    def put_async(self, path, encoded_file):
+        """
+        Distribute blocks of a file among different providers without waiting
+        for the blocks to be stored.
+        Args:
+            path (str): Key under which the data is stored
+            encoded_file (File): A File object with blocks to store
+        Returns:
+            concurrent.futures.Future: The future metadata object describing how
+                                       the blocks have been stored
+        """
+        start = time.time()
         metadata = pyproxy.metadata.MetaDocument(path, original_size=long(encoded_file.original_size))
-        provider_keys = self.providers.keys()
+        provider_keys = self.breakers.get_healthy(self.providers.keys())
+        if encoded_file.strips and len(provider_keys) < self.write_quorum:
+            message = "Could not store {:s}: only {:d} healthy providers for a write quorum of {:d}".format(
+                path, len(provider_keys), self.write_quorum)
+            self.write_statistics.count("writes")
+            self.write_statistics.fail("failed_writes", message)
+            future = concurrent.futures.Future()
+            future.set_exception(RuntimeError(message))
+            return future
         blocks = [strip.data for strip in encoded_file.strips]
         arrangement = place(len(blocks), provider_keys, self.replication_factor)
-        metablock_queue = {}
-        pushers = []
         metablocks = {}
+        replicas = {}
         for provider_key in arrangement:
-            provider = self.providers[provider_key]
-            blocks_for_provider = {}
             for index in arrangement[provider_key]:
                 index = index % len(encoded_file.strips)
                 strip = encoded_file.strips[index]
@@ -350,52 +865,91 @@ class Dispatcher(object):
                 block_type = pyproxy.metadata.BlockType.PARITY
                 if strip.type == pyproxy.playcloud_pb2.Strip.DATA:
                     block_type = pyproxy.metadata.BlockType.DATA
-                metablock = metablocks.get(index,
-                                           pyproxy.metadata.MetaBlock(key,
-                                                                      providers=[],
-                                                                      checksum=strip.checksum,
-                                                                      block_type=block_type,
-                                                                      size=len(strip.data)))
-                metablock.providers.append(provider_key)
-                metablocks[index] = metablock
-                blocks_for_provider[metablock] = strip.data
-            pusher = BlockPusher(provider, blocks_for_provider, metablock_queue)
-            pusher.start()
-            pushers.append(pusher)
-        for pusher in pushers:
-            pusher.join()
-        for index in metablocks:
-            metablock = metablocks[index]
-            if isinstance(metablock, CouldNotPushException):
-                error_message = "Could not push block {:d} to provider {}".format(index, metablock.provider)
-                raise RuntimeError(error_message)
-        for index, metablock in metablocks.items():
-            metadata.blocks.append(metablock)
-        end = time.clock()
-        elapsed = end - start
-        logger.debug("Storing blocks for {:s} was done in {:f} s".format(path, elapsed))
-        return metadata
-
-    def __get_blocks(self, metablocks):
+                if index not in metablocks:
+                    fast_checksum = pyproxy.providers.verification.compute_fast_checksum(strip.data)
+                    metablocks[index] = pyproxy.metadata.MetaBlock(key,
+                                                                   providers=[],
+                                                                   checksum=strip.checksum,
+                                                                   block_type=block_type,
+                                                                   size=len(strip.data),
+                                                                   fast_checksum=fast_checksum)
+                replicas.setdefault(index, []).append(provider_key)
+        write = pyproxy.providers.write_quorum.QuorumWrite(metadata, metablocks, replicas, self.write_quorum,
+                                                           self.files, self.write_statistics, self.__schedule)
+        if write.future.done():
+            return write.future
+        for provider_key in arrangement:
+            indices = sorted(set(index % len(encoded_file.strips) for index in arrangement[provider_key]))
+            batch = {metablocks[index].key: blocks[index] for index in indices}
+            future = self.__push_async(provider_key, batch)
+            for index in indices:
+                future.add_done_callback(functools.partial(write.confirm, index, provider_key))
+        def log(_):
+            logger.debug("Storing a quorum of the blocks for {:s} was done in {:f} s".format(path,
+                                                                                          time.time() - start))
+        write.future.add_done_callback(log)
+        return write.future
+
+    def __schedule(self, delay, function):
+        """
+        Runs a function after a delay without holding a worker of the pool
+        Args:
+            delay(float): Delay in seconds
+            function(function): The function to run
+        """
+        self.drivers.submit(time.sleep, delay).add_done_callback(lambda _: function())
+
+    def __push_async(self, provider_key, batch, attempt=0):
+        """
+        Stores replicas of blocks on a provider in a single batch without
+        waiting for it, retrying the batch when the provider fails
+        Args:
+            provider_key(str): Name of the provider that will store the data
+            batch(dict(str, bytes)): The data of the blocks indexed by key
+            attempt(int, optional): Number of previous attempts
+        Returns:
+            concurrent.futures.Future: The future result of the provider's
+                                       put_many, holding the error of the last
+                                       attempt if all of them failed
+        """
+        keys = ",".join(sorted(batch))
+        logger.debug("Going to put blocks with keys {:s} in provider {:s}".format(keys, provider_key))
+        def retry(done):
+            if isinstance(done.exception(), CONNECTION_ERRORS):
+                self.breakers.record_failure(provider_key)
+            elif done.exception() is None:
+                self.breakers.record_success(provider_key)
+            if done.exception() is None or attempt >= self.write_retries:
+                return done
+            self.write_statistics.count("retries")
+            logger.warning("Retrying to put blocks with keys {:s} in provider {:s} after {}".format(
+                keys, provider_key, done.exception()))
+            retried = concurrent.futures.Future()
+            def push():
+                self.__push_async(provider_key, batch, attempt + 1).add_done_callback(
+                    lambda pushed: pyproxy.providers.io_pool.forward(pushed, retried))
+            self.__schedule(pyproxy.providers.write_quorum.QuorumWrite.BACKOFF * 2 ** attempt, push)
+            return retried
+        future = self.async_providers[provider_key].put_many_async(batch)
+        return pyproxy.providers.io_pool.then(future, retry)
+
+    def __get_blocks_async(self, metablocks):
         """
         Args:
             metablocks(list): The list of metablocks describing the blocks to get
                               from the data stores
         Returns:
-            dict(metablock, bytes): The blocks fetched from the data stores
-        """
-        manager = multiprocessing.Manager()
-        blocks = manager.dict()
-        fetchers = []
-        for metablock in metablocks:
-            possible_providers = {key: self.providers[key] for key in metablock.providers}
-            fetcher = BlockFetcher(possible_providers, metablock)
-            fetcher.start()
-            fetchers.append(fetcher)
-        for fetcher in fetchers:
-            fetcher.join()
-            blocks.update(fetcher.queue)
-        return blocks
+            concurrent.futures.Future: The future blocks fetched from the data
+                                       stores indexed by key
+        """
+        if self.block_cache is not None:
+            self.block_cache.record_pointers(metablocks)
+        if self.hedging is not None:
+            return self.drivers.submit(fetch_blocks_with_hedging, self.providers, metablocks, self.pool,
+                                       self.hedging, scores=self.scores, breakers=self.breakers,
+                                       verifier=self.verifier)
+        return fetch_blocks_async(self.providers, metablocks, self.pool, scores=self.scores, breakers=self.breakers,
+                                  verifier=self.verifier)
 
     def get_block(self, path, index, reconstruct_if_missing=True):
         """
@@ -415,6 +969,26 @@ class Dispatcher(object):
             LookupError: if the path does not match any file or the index does not
                          match an existing block
         """
+        return self.get_block_async(path, index, reconstruct_if_missing=reconstruct_if_missing).result()
+
+    def get_block_async(self, path, index, reconstruct_if_missing=True):
+        """
+        Returns a single block for the data store without waiting for it.
+        Args:
+            path(str): Key under which the file is stored
+            index(int): Index of the block
+            reconstruct_if_missing(bool, optional): If the dispatcher should try
+                                                    to reconstruct the block if
+                                                    it cannot be fetched from
+                                                    the storage nodes. Defaults
+                                                    to True
+        Returns:
+            concurrent.futures.Future: The future block of data
+        Raises:
+            ValueError: if the path is empty or the index is negative
+            LookupError: if the path does not match any file or the index does not
+                         match an existing block
+        """
         path = path.strip()
         if not path:
             raise ValueError("argument path cannot be empty")
@@ -427,11 +1001,14 @@ class Dispatcher(object):
             raise LookupError("could not find block for index {:d}".format(index))
 
         metablock = metadata.blocks[index]
-        data = self.__get_blocks([metablock])[metablock.key]
-        if isinstance(data, NoReplicaException) and reconstruct_if_missing:
-            coder_client = pyproxy.coder_client.CoderClient()
-            data = coder_client.reconstruct(path, [index])[index].data
-        return data
+        def reconstruct():
+            return self.__get_coder().reconstruct(path, [index])[index].data
+        def complete(done):
+            data = done.result()[metablock.key]
+            if isinstance(data, NoReplicaException) and reconstruct_if_missing:
+                return self.drivers.submit(reconstruct)
+            return data
+        return pyproxy.providers.io_pool.then(self.__get_blocks_async([metablock]), complete)
 
     def get(self, path):
         """
@@ -441,41 +1018,46 @@ class Dispatcher(object):
         Returns:
             A list of blocks if the file was stored in the system, None otherwise
         """
+        return self.get_async(path).result()
+
+    def get_async(self, path):
+        """
+        Recovers and orders blocks stored among the providers without waiting
+        for them
+        Args:
+            path: Key under which the data is stored
+        Returns:
+            concurrent.futures.Future: The future list of blocks if the file was
+                                       stored in the system, None otherwise
+        """
         try:
             metadata = self.files.get(path)
         except KeyError:
-            return None
-        metablocks = [b for b in metadata.blocks if b.block_type == pyproxy.metadata.BlockType.DATA]
-
-        block_queue = self.__get_blocks(metablocks)
-        missing_indices = []
-        for key in sorted(block_queue.keys()):
-            block = block_queue[key]
-            if isinstance(block, NoReplicaException):
-                missing_index = extract_index_from_key(key)
-                missing_indices.append(missing_index)
-                del block_queue[key]
-                continue
+            return pyproxy.providers.io_pool.resolved(None)
+        plan = pyproxy.providers.degraded_read.ReadPlan(
+            {extract_index_from_key(metablock.key): metablock for metablock in metadata.blocks},
+            self.__get_coder,
+            is_available=lambda provider: not self.breakers.is_open(provider),
+            fallback_waves=self.fallback_waves)
 
-        while len(block_queue) < len(metablocks):
-            coder = pyproxy.coder_client.CoderClient()
-            indices_needed = coder.fragments_needed(missing_indices)
-            indices_secured = [extract_index_from_key(m) for m in block_queue.keys()]
-            indices_to_compensate = list(set(indices_needed).difference(set(indices_secured)))
-            metablocks_to_compensate = [m for m in metadata.blocks if extract_index_from_key(m.key) in indices_to_compensate]
-            blocks_to_compensate = self.__get_blocks(metablocks_to_compensate)
-            for key in sorted(blocks_to_compensate.keys()):
-                block = blocks_to_compensate[key]
-                index = extract_index_from_key(key)
-                if isinstance(block, NoReplicaException):
-                    missing_indices.append(index)
-                    continue
-                if index in missing_indices:
-                    missing_indices.remove(index)
-                block_queue[key] = block
-            missing_indices = list(set(missing_indices))
+        def read():
+            metablocks = plan.next_wave()
+            if not metablocks:
+                if plan.is_complete():
+                    return plan.get_blocks()
+                raise NoReplicaException("Could not fetch enough blocks to decode {:s}".format(path))
+            return pyproxy.providers.io_pool.then(self.__get_blocks_async(metablocks), collect)
+
+        def collect(done):
+            plan.add(done.result(), extract_index_from_key)
+            if plan.is_complete():
+                return plan.get_blocks()
+            return self.drivers.submit(read)
 
-        return [block_queue[key] for key in sorted(block_queue.keys())]
+        if plan.is_degraded():
+            # Planning the first wave requires a call to the coder
+            return pyproxy.providers.io_pool.then(self.drivers.submit(read), lambda done: done.result())
+        return pyproxy.providers.io_pool.then(pyproxy.providers.io_pool.resolved(None), lambda _: read())
 
     def get_random_blocks(self, blocks_desired):
         """
@@ -488,20 +1070,32 @@ class Dispatcher(object):
             A list of tuples where the first element is a metablock and the
             second one is the block data itself
         """
-        full_start = time.clock()
-        start = time.clock()
+        return self.get_random_blocks_async(blocks_desired).result()
+
+    def get_random_blocks_async(self, blocks_desired):
+        """
+        Tries to randomly select a number blocks from the storage providers
+        without waiting for them.
+        It may return between 0 and "blocks_desired" numbers depending on the
+        number of blocks already present in the system.
+        Args:
+            blocks_desired -- The number of random blocks to select (int)
+        Returns:
+            concurrent.futures.Future: The future list of tuples where the first
+                                       element is a metablock and the second one
+                                       is the block data itself
+        """
+        start = time.time()
         random_metablocks = self.files.select_random_blocks(blocks_desired)
-        block_queue = self.__get_blocks(random_metablocks)
-        end = time.clock()
-        logger.debug("Took {:f} seconds to fetch {:d} random blocks".format(end - start, len(block_queue)))
-        start = time.clock()
-        random_blocks = []
-        for key in block_queue.keys():
-            block = block_queue.get(key)
-            if  isinstance(block, NoReplicaException):
-                continue
-            random_blocks.append((key, block))
-        end = time.clock()
-        logger.debug("Took {:f} seconds to filter and sort {:d} random blocks".format(end - start, len(random_blocks)))
-        logger.debug("Took {:f} seconds to fetch and order {:d} random blocks".format(end - full_start, len(random_blocks)))
-        return random_blocks
+        def complete(done):
+            block_queue = done.result()
+            random_blocks = []
+            for key in block_queue.keys():
+                block = block_queue.get(key)
+                if  isinstance(block, NoReplicaException):
+                    continue
+                random_blocks.append((key, block))
+            logger.debug("Took {:f} seconds to fetch {:d} random blocks".format(time.time() - start,
+                                                                                 len(random_blocks)))
+            return random_blocks
+        return pyproxy.providers.io_pool.then(self.__get_blocks_async(random_metablocks), complete)
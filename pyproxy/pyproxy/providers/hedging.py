@@ -0,0 +1,102 @@
+"""
+Keeps track of the latency of recent block reads to decide when a read should
+be hedged, i.e. when the same block should also be requested from another
+replica
+"""
+import collections
+import threading
+
+
+class HedgingPolicy(object):
+    """
+    Computes the delay after which a read that has not been answered is
+    hedged from a percentile of the latencies of the recent reads and counts
+    the hedges made.
+    """
+    PERCENTILE = 95
+    WINDOW = 1000
+    DELAY = 0.05
+    MINIMUM_SAMPLES = 20
+
+    def __init__(self, percentile=PERCENTILE, window=WINDOW, delay=DELAY):
+        """
+        HedgingPolicy constructor
+        Args:
+            percentile(int, optional): Percentile of the recent latencies after
+                                       which a read is hedged
+            window(int, optional): Number of recent latencies kept
+            delay(float, optional): Delay in seconds used until enough
+                                    latencies have been recorded
+        Raises:
+            ValueError: If percentile is not an integer between 1 and 100,
+                        window is not an integer greater than 0 or delay is
+                        negative
+        """
+        if not isinstance(percentile, int) or not 1 <= percentile <= 100:
+            raise ValueError("percentile argument must be an integer between 1 and 100")
+        if not isinstance(window, int) or window <= 0:
+            raise ValueError("window argument must be an integer greater than 0")
+        if not isinstance(delay, (int, float)) or delay < 0:
+            raise ValueError("delay argument must be a number greater or equal to 0")
+        self.percentile = percentile
+        self.delay = float(delay)
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def record(self, latency):
+        """
+        Records the latency of a successful read
+        Args:
+            latency(float): Latency of the read in seconds
+        """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_delay(self):
+        """
+        Returns the delay after which a read should be hedged
+        Returns:
+            float: The delay in seconds
+        """
+        with self.lock:
+            if len(self.latencies) < HedgingPolicy.MINIMUM_SAMPLES:
+                return self.delay
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+        return latencies[index]
+
+    def count_read(self, hedges, won_by_hedge):
+        """
+        Counts a block read
+        Args:
+            hedges(int): Number of extra requests sent to other replicas
+            won_by_hedge(bool): Whether the block was returned by one of the
+                                extra requests
+        """
+        with self.lock:
+            self.reads += 1
+            self.hedges += hedges
+            if won_by_hedge:
+                self.hedges_won += 1
+
+    def statistics(self):
+        """
+        Returns the usage statistics of the policy
+        Returns:
+            dict: The current delay, the number of latencies recorded, the number
+                  of reads, the number of hedges sent and the number of reads
+                  answered by a hedge
+        """
+        delay = self.get_delay()
+        with self.lock:
+            return {
+                "percentile": self.percentile,
+                "delay": delay,
+                "samples": len(self.latencies),
+                "reads": self.reads,
+                "hedges": self.hedges,
+                "hedges_won": self.hedges_won
+            }
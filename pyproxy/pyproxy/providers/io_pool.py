@@ -0,0 +1,376 @@
+"""
+A long-lived pool of threads running the reads and writes made by the
+dispatcher on the storage providers and helpers composing the futures they
+return without blocking
+"""
+import contextlib
+import threading
+
+import concurrent.futures
+
+
+def resolved(value):
+    """
+    Returns a future that already holds a result
+    Args:
+        value(object): The result of the future
+    Returns:
+        concurrent.futures.Future: The completed future
+    """
+    future = concurrent.futures.Future()
+    future.set_result(value)
+    return future
+
+
+def forward(source, destination):
+    """
+    Copies the result or the exception of a completed future to another future,
+    waiting for the result if it is itself a future
+    Args:
+        source(concurrent.futures.Future): The completed future
+        destination(concurrent.futures.Future): The future to complete
+    """
+    error = source.exception()
+    if error is not None:
+        destination.set_exception(error)
+    elif isinstance(source.result(), concurrent.futures.Future):
+        source.result().add_done_callback(lambda chained: forward(chained, destination))
+    else:
+        destination.set_result(source.result())
+
+
+def then(future, function):
+    """
+    Schedules a function to run on a future once it completes, without
+    waiting for it. The function runs in the thread that completes the future
+    and can itself return a future whose result is then awaited.
+    Args:
+        future(concurrent.futures.Future): The future to wait for
+        function(function): The function called with the completed future
+    Returns:
+        concurrent.futures.Future: The future result of the function, holding
+                                   the exception it raised if any
+    """
+    result = concurrent.futures.Future()
+    def run(completed):
+        try:
+            value = function(completed)
+        except Exception as error:
+            result.set_exception(error)
+            return
+        forward(resolved(value), result)
+    future.add_done_callback(run)
+    return result
+
+
+def gather(futures):
+    """
+    Combines futures into a single one, without waiting for them
+    Args:
+        futures(list(concurrent.futures.Future)): The futures to combine
+    Returns:
+        concurrent.futures.Future: A future holding the list of the results in
+                                   the order of the futures once they have all
+                                   completed, or the first exception raised
+    """
+    futures = list(futures)
+    if not futures:
+        return resolved([])
+    result = concurrent.futures.Future()
+    lock = threading.Lock()
+    remaining = [len(futures)]
+    def complete(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+        result.set_result([future.result() for future in futures])
+    for future in futures:
+        future.add_done_callback(complete)
+    return result
+
+
+class IOPool(object):
+    """
+    A bounded pool of I/O workers shared by the requests of the dispatcher.
+    The number of concurrent operations on each provider can be capped and
+    the pool keeps track of the tasks waiting for a worker or a provider.
+    """
+    WORKERS = 64
+
+    def __init__(self, workers=WORKERS, provider_concurrency=0):
+        """
+        IOPool constructor
+        Args:
+            workers(int, optional): Number of worker threads
+            provider_concurrency(int, optional): Maximum number of concurrent
+                                                 operations on a provider, 0
+                                                 for no limit (defaults to 0)
+        Raises:
+            ValueError: If workers is not an integer greater than 0 or
+                        provider_concurrency is not an integer greater or equal to 0
+        """
+        if not isinstance(workers, int) or workers <= 0:
+            raise ValueError("workers argument must be an integer greater than 0")
+        if not isinstance(provider_concurrency, int) or provider_concurrency < 0:
+            raise ValueError("provider_concurrency argument must be an integer greater or equal to 0")
+        self.workers = workers
+        self.provider_concurrency = provider_concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.provider_semaphores = {}
+        self.provider_waiting = {}
+        self.provider_in_flight = {}
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Schedules a function on a worker
+        Args:
+            function(function): The function to run
+            *args: Positional arguments of the function
+            **kwargs: Keyword arguments of the function
+        Returns:
+            concurrent.futures.Future: The future result of the function
+        """
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        return self.executor.submit(self.run, function, *args, **kwargs)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Runs a scheduled function while keeping track of the number of tasks
+        queued and running
+        """
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+    def map(self, function, iterable):
+        """
+        Runs a function on every element of an iterable using the workers.
+        A single element is processed by the calling thread.
+        Args:
+            function(function): The function to run
+            iterable(iterable): The elements to process
+        Returns:
+            list: The results in the order of the elements
+        """
+        elements = list(iterable)
+        if len(elements) == 1:
+            return [function(elements[0])]
+        futures = [self.submit(function, element) for element in elements]
+        return [future.result() for future in futures]
+
+    def map_async(self, function, iterable):
+        """
+        Schedules a function on every element of an iterable without waiting
+        for the results
+        Args:
+            function(function): The function to run
+            iterable(iterable): The elements to process
+        Returns:
+            concurrent.futures.Future: The future list of the results in the
+                                       order of the elements
+        """
+        return gather([self.submit(function, element) for element in iterable])
+
+    @contextlib.contextmanager
+    def provider_slot(self, provider):
+        """
+        Waits until an operation can be made on a provider without exceeding
+        the concurrency limit
+        Args:
+            provider(str): Name of the provider
+        """
+        with self.lock:
+            semaphore = self.provider_semaphores.get(provider)
+            if semaphore is None and self.provider_concurrency:
+                semaphore = threading.BoundedSemaphore(self.provider_concurrency)
+                self.provider_semaphores[provider] = semaphore
+            self.provider_waiting[provider] = self.provider_waiting.get(provider, 0) + 1
+        if semaphore is not None:
+            semaphore.acquire()
+        with self.lock:
+            self.provider_waiting[provider] -= 1
+            self.provider_in_flight[provider] = self.provider_in_flight.get(provider, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.provider_in_flight[provider] -= 1
+            if semaphore is not None:
+                semaphore.release()
+
+    def statistics(self):
+        """
+        Returns the usage statistics of the pool
+        Returns:
+            dict: The number of workers, the number of tasks queued, running,
+                  completed and the maximum number of tasks queued along with
+                  the number of operations waiting and in flight on each provider
+        """
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "provider_concurrency": self.provider_concurrency,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "max_queued": self.max_queued,
+                "providers": {
+                    provider: {
+                        "waiting": self.provider_waiting.get(provider, 0),
+                        "in_flight": self.provider_in_flight.get(provider, 0)
+                    } for provider in set(self.provider_waiting).union(self.provider_in_flight)
+                }
+            }
+
+
+class AsyncProvider(object):
+    """
+    A non-blocking interface to a storage provider. The operations run on the
+    workers of a pool, within the concurrency limit of the provider, and
+    return futures so that a single thread can keep many transfers in flight
+    with any of the redis, disk or S3 providers.
+    """
+    def __init__(self, name, provider, pool):
+        """
+        AsyncProvider constructor
+        Args:
+            name(str): Name of the provider
+            provider(Provider): The provider to wrap
+            pool(IOPool): The pool running the operations
+        """
+        self.name = name
+        self.provider = provider
+        self.pool = pool
+
+    def __run(self, function, *args):
+        with self.pool.provider_slot(self.name):
+            return function(*args)
+
+    def get_async(self, key):
+        """
+        Fetches a block
+        Args:
+            key(str): Key of the block
+        Returns:
+            concurrent.futures.Future: The future data of the block, None if it
+                                       does not exist
+        """
+        return self.pool.submit(self.__run, self.provider.get, key)
+
+    def put_async(self, data, key):
+        """
+        Stores a block
+        Args:
+            data(bytes): The data of the block
+            key(str): Key of the block
+        Returns:
+            concurrent.futures.Future: The future result of the provider's put
+        """
+        return self.pool.submit(self.__run, self.provider.put, data, key)
+
+    def delete_async(self, key):
+        """
+        Deletes a block
+        Args:
+            key(str): Key of the block
+        Returns:
+            concurrent.futures.Future: The future result of the provider's delete
+        """
+        return self.pool.submit(self.__run, self.provider.delete, key)
+
+    def __get_range(self, key, offset, length):
+        get_range = getattr(self.provider, "get_range", None)
+        if get_range is not None:
+            return get_range(key, offset, length)
+        data = self.provider.get(key)
+        if data is None:
+            return None
+        return data[offset:offset + length]
+
+    def __get_many(self, keys):
+        get_many = getattr(self.provider, "get_many", None)
+        if get_many is not None:
+            return get_many(keys)
+        return [self.provider.get(key) for key in keys]
+
+    def __put_many(self, blocks):
+        put_many = getattr(self.provider, "put_many", None)
+        if put_many is not None:
+            return put_many(blocks)
+        for key, data in blocks.items():
+            self.provider.put(data, key)
+        return True
+
+    def __delete_many(self, keys):
+        delete_many = getattr(self.provider, "delete_many", None)
+        if delete_many is not None:
+            return delete_many(keys)
+        return sum(1 for key in keys if self.provider.delete(key))
+
+    def get_range_async(self, key, offset, length):
+        """
+        Fetches part of a block, such as its header, reading the whole block
+        if the provider cannot read ranges
+        Args:
+            key(str): Key of the block
+            offset(int): Position of the first byte to read
+            length(int): Number of bytes to read
+        Returns:
+            concurrent.futures.Future: The future bytes read, None if the
+                                       block does not exist
+        """
+        return self.pool.submit(self.__run, self.__get_range, key, offset, length)
+
+    def get_many_async(self, keys):
+        """
+        Fetches several blocks in a single operation, or one after another if
+        the provider cannot fetch them at once
+        Args:
+            keys(list(str)): Keys of the blocks
+        Returns:
+            concurrent.futures.Future: The future list of the data of the
+                                       blocks in the order of the keys, None
+                                       for the blocks that do not exist
+        """
+        return self.pool.submit(self.__run, self.__get_many, keys)
+
+    def put_many_async(self, blocks):
+        """
+        Stores several blocks in a single operation, or one after another if
+        the provider cannot store them at once
+        Args:
+            blocks(dict(str, bytes)): The data of the blocks indexed by key
+        Returns:
+            concurrent.futures.Future: The future result of the provider's
+                                       put_many
+        """
+        return self.pool.submit(self.__run, self.__put_many, blocks)
+
+    def delete_many_async(self, keys):
+        """
+        Deletes several blocks in a single operation, or one after another if
+        the provider cannot delete them at once
+        Args:
+            keys(list(str)): Keys of the blocks
+        Returns:
+            concurrent.futures.Future: The future number of blocks deleted
+        """
+        return self.pool.submit(self.__run, self.__delete_many, keys)
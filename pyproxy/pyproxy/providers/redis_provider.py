@@ -83,6 +83,43 @@ class RedisProvider(object):
         LOGGER.debug("Provider {:s} stored {:s} in {:f} seconds".format(self.host, path, elapsed))
         return value
 
+    def get_many(self, paths):
+        """
+        Fetches the data stored under several keys in a single round trip
+        Args:
+            paths(list(str)): Keys under which the data is stored
+        Returns:
+            list: The data stored under each key in the same order, None for
+                  the keys that were not found
+        """
+        if not paths:
+            return []
+        start = time.clock()
+        values = self.redis.mget(paths)
+        end = time.clock()
+        elapsed = end - start
+        LOGGER.debug("Provider {:s} fetched {:d} blocks in {:f} seconds".format(self.host, len(paths), elapsed))
+        return values
+
+    def put_many(self, blocks):
+        """
+        Inserts data under several keys in a single round trip
+        Args:
+            blocks(dict(str, bytes)): The data to store indexed by key
+        Returns:
+            True if the insertion worked
+        Raises:
+            ConnectionError: If the client cannot connect to the server
+        """
+        if not blocks:
+            return True
+        start = time.clock()
+        value = self.redis.mset(blocks)
+        end = time.clock()
+        elapsed = end - start
+        LOGGER.debug("Provider {:s} stored {:d} blocks in {:f} seconds".format(self.host, len(blocks), elapsed))
+        return value
+
     def delete(self, path):
         """
         Delete data from the database
@@ -93,6 +130,28 @@ class RedisProvider(object):
         """
         return self.redis.delete(path)
 
+    def delete_many(self, paths):
+        """
+        Delete data stored under several keys from the database
+        Args:
+            paths(list(str)): Keys of the files to delete
+        Returns:
+            The number of keys deleted from the database
+        """
+        if not paths:
+            return 0
+        return self.redis.delete(*paths)
+
+    def ping(self):
+        """
+        Checks that the database answers
+        Returns:
+            bool: True if the database answered
+        Raises:
+            ConnectionError: If the client cannot connect to the server
+        """
+        return self.redis.ping()
+
     def clear(self):
         """
         Deletes all entries in the redis database
@@ -0,0 +1,160 @@
+"""
+Keeps track of the latency and error rate of the block reads made on each
+provider to choose the replicas to read from
+"""
+import random
+import threading
+import time
+
+
+class ProviderScores(object):
+    """
+    Maintains an exponentially weighted moving average (EWMA) of the latency
+    and of the error rate of the reads made on each provider and orders the
+    replicas of a block by the expected latency of a successful read.
+    The scores of a provider fade towards the average of the providers as time
+    passes without reads so that a provider that recovered gets traffic again,
+    and a fraction of the reads explore the replicas in a random order.
+    """
+    ALPHA = 0.2
+    HALF_LIFE = 30.0
+    EXPLORATION = 0.05
+    MAXIMUM_ERROR_RATE = 0.99
+
+    def __init__(self, alpha=ALPHA, half_life=HALF_LIFE, exploration=EXPLORATION):
+        """
+        ProviderScores constructor
+        Args:
+            alpha(float, optional): Weight of a new read in the moving averages
+            half_life(float, optional): Time in seconds without reads after
+                                        which a provider's scores are halfway
+                                        to the average of the providers
+            exploration(float, optional): Fraction of the reads for which the
+                                          replicas are tried in a random order
+        Raises:
+            ValueError: If alpha is not a number in ]0, 1], half_life is not a
+                        number greater than 0 or exploration is not a number
+                        in [0, 1]
+        """
+        if not isinstance(alpha, (int, float)) or not 0 < alpha <= 1:
+            raise ValueError("alpha argument must be a number greater than 0 and lower or equal to 1")
+        if not isinstance(half_life, (int, float)) or half_life <= 0:
+            raise ValueError("half_life argument must be a number greater than 0")
+        if not isinstance(exploration, (int, float)) or not 0 <= exploration <= 1:
+            raise ValueError("exploration argument must be a number between 0 and 1")
+        self.alpha = float(alpha)
+        self.half_life = float(half_life)
+        self.exploration = float(exploration)
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.error_rates = {}
+        self.reads = {}
+        self.errors = {}
+        self.last_updates = {}
+
+    def record(self, provider, latency, failed=False):
+        """
+        Records the outcome of a read on a provider
+        Args:
+            provider(str): Name of the provider
+            latency(float): Time taken by the read in seconds
+            failed(bool, optional): Whether the read failed or returned an
+                                    invalid replica
+        """
+        now = time.time()
+        with self.lock:
+            if provider in self.last_updates:
+                latency_score, error_rate = self.__get_scores(provider, now, self.__get_average_latency())
+            else:
+                latency_score, error_rate = latency, 0.0
+            self.latencies[provider] = (1 - self.alpha) * latency_score + self.alpha * latency
+            self.error_rates[provider] = (1 - self.alpha) * error_rate + self.alpha * (1.0 if failed else 0.0)
+            self.reads[provider] = self.reads.get(provider, 0) + 1
+            if failed:
+                self.errors[provider] = self.errors.get(provider, 0) + 1
+            self.last_updates[provider] = now
+
+    def __get_average_latency(self):
+        """
+        Returns the average of the latency scores of the providers
+        Returns:
+            float: The average latency, None if no read has been recorded
+        """
+        if not self.latencies:
+            return None
+        return sum(self.latencies.values()) / len(self.latencies)
+
+    def __get_scores(self, provider, now, average_latency=None):
+        """
+        Returns the latency score and the error rate of a provider after the
+        decay due to the time elapsed since its last read
+        Args:
+            provider(str): Name of the provider
+            now(float): The current time
+            average_latency(float, optional): The average latency of the
+                                              providers
+        Returns:
+            (float, float): The latency score, the average latency if the
+                            provider has never been read, and the error rate
+        """
+        if provider not in self.last_updates:
+            return average_latency, 0.0
+        decay = 0.5 ** ((now - self.last_updates[provider]) / self.half_life)
+        latency = self.latencies[provider]
+        if average_latency is not None:
+            latency = average_latency + (latency - average_latency) * decay
+        return latency, self.error_rates[provider] * decay
+
+    def __get_expected_latency(self, provider, now, average_latency):
+        """
+        Returns the expected time to get a valid replica from a provider
+        retrying after each error
+        """
+        latency, error_rate = self.__get_scores(provider, now, average_latency)
+        if latency is None:
+            latency = 0.0
+        return latency / (1 - min(error_rate, ProviderScores.MAXIMUM_ERROR_RATE))
+
+    def order(self, providers):
+        """
+        Orders providers by increasing expected latency, or randomly for a
+        fraction of the calls
+        Args:
+            providers(list(str)): Names of the providers
+        Returns:
+            list(str): The providers in the order they should be tried
+        """
+        ordered = list(providers)
+        random.shuffle(ordered)
+        if random.random() < self.exploration:
+            return ordered
+        now = time.time()
+        with self.lock:
+            average_latency = self.__get_average_latency()
+            expected = {provider: self.__get_expected_latency(provider, now, average_latency)
+                        for provider in ordered}
+        ordered.sort(key=lambda provider: expected[provider])
+        return ordered
+
+    def statistics(self):
+        """
+        Returns the scores of the providers
+        Returns:
+            dict(str, dict): The latency score, error rate, expected latency,
+                             number of reads and errors of each provider
+        """
+        now = time.time()
+        with self.lock:
+            average_latency = self.__get_average_latency()
+            scores = {}
+            for provider in self.last_updates:
+                latency, error_rate = self.__get_scores(provider, now, average_latency)
+                scores[provider] = {
+                    "latency": latency,
+                    "error_rate": error_rate,
+                    "expected_latency": self.__get_expected_latency(provider, now, average_latency),
+                    "reads": self.reads.get(provider, 0),
+                    "errors": self.errors.get(provider, 0),
+                    "last_read": self.last_updates[provider]
+                }
+            return scores
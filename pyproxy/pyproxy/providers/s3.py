@@ -1,51 +1,228 @@
 """
 An S3 backend for playcloud
 """
+import re
+
 import boto3
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
+
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
 
 
 class S3Provider(object):
     """
-    A playcloud backend that talks with an S3-compatible backend
+    A playcloud backend that talks with an S3-compatible backend. Large
+    blocks are uploaded in parts and downloaded by ranges, the parts and
+    ranges of a block being transferred in parallel.
     """
+    BATCH_CONCURRENCY = 16
+    MAXIMUM_KEYS_PER_DELETE = 1000
+    MAX_POOL_CONNECTIONS = 64
+    TRANSFER_CONCURRENCY = 8
+    MULTIPART_THRESHOLD = 16 * 1024 * 1024
+    PART_SIZE = 8 * 1024 * 1024
+    MINIMUM_PART_SIZE = 5 * 1024 * 1024
+    RANGE_SIZE = 8 * 1024 * 1024
+
     def __init__(self,
                  bucket="playcloud",
                  endpoint_url="http://durable:9000",
                  aws_access_key_id="playcloud",
                  aws_secret_access_key="playcloud",
-                 type="s3"):
+                 type="s3",
+                 max_pool_connections=MAX_POOL_CONNECTIONS,
+                 transfer_concurrency=TRANSFER_CONCURRENCY,
+                 multipart_threshold=MULTIPART_THRESHOLD,
+                 part_size=PART_SIZE,
+                 range_size=RANGE_SIZE):
+        """
+        S3Provider constructor
+        Args:
+            bucket(str, optional): Bucket the blocks are stored in
+            endpoint_url(str, optional): URL of the S3-compatible server
+            aws_access_key_id(str, optional): Access key
+            aws_secret_access_key(str, optional): Secret key
+            type(str, optional): Type of the provider in the configuration
+            max_pool_connections(int, optional): Maximum number of connections
+                                                 kept open to the server
+            transfer_concurrency(int, optional): Number of parts or ranges of
+                                                 the blocks transferred in
+                                                 parallel
+            multipart_threshold(int, optional): Size in bytes above which a
+                                                block is uploaded in parts
+            part_size(int, optional): Size in bytes of the parts of a
+                                      multipart upload
+            range_size(int, optional): Size in bytes of the ranges read in
+                                       parallel when downloading a block, 0 to
+                                       download each block in a single request
+        Raises:
+            ValueError: If max_pool_connections, transfer_concurrency or
+                        multipart_threshold is not an integer greater than 0,
+                        part_size is lower than the minimum part size of S3 or
+                        range_size is negative
+        """
+        if not isinstance(max_pool_connections, int) or max_pool_connections <= 0:
+            raise ValueError("max_pool_connections argument must be an integer greater than 0")
+        if not isinstance(transfer_concurrency, int) or transfer_concurrency <= 0:
+            raise ValueError("transfer_concurrency argument must be an integer greater than 0")
+        if not isinstance(multipart_threshold, int) or multipart_threshold <= 0:
+            raise ValueError("multipart_threshold argument must be an integer greater than 0")
+        if not isinstance(part_size, int) or part_size < S3Provider.MINIMUM_PART_SIZE:
+            raise ValueError("part_size argument must be an integer greater or equal to {:d}".format(
+                S3Provider.MINIMUM_PART_SIZE))
+        if not isinstance(range_size, int) or range_size < 0:
+            raise ValueError("range_size argument must be an integer greater or equal to 0")
+        # Every concurrent request needs its own connection
         self.client = boto3.client("s3",
                                    endpoint_url=endpoint_url,
                                    aws_access_key_id=aws_access_key_id,
-                                   aws_secret_access_key=aws_secret_access_key)
+                                   aws_secret_access_key=aws_secret_access_key,
+                                   config=botocore.config.Config(max_pool_connections=max_pool_connections))
         self.bucket = bucket
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.range_size = range_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=S3Provider.BATCH_CONCURRENCY)
+        # The parts of a block are transferred by a separate executor so that
+        # the blocks of a batch never wait for their own parts
+        self.transfer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=transfer_concurrency)
         available_buckets = self.client.list_buckets()["Buckets"]
         for a_bucket in available_buckets:
             if a_bucket["Name"] == self.bucket:
                 return
         self.client.create_bucket(Bucket=self.bucket)
 
+    def __get_object(self, path, start, end, etag=None):
+        """
+        Reads the bytes of an object between two positions, only if its ETag
+        matches when one is given
+        Returns:
+            (bytes, int, str): The bytes read, the total size of the object and
+                               its ETag
+        """
+        arguments = {"Bucket": self.bucket, "Key": path, "Range": "bytes={:d}-{:d}".format(start, end)}
+        if etag is not None:
+            arguments["IfMatch"] = etag
+        response = self.client.get_object(**arguments)
+        data = response["Body"].read()
+        match = CONTENT_RANGE_PATTERN.match(response.get("ContentRange") or "")
+        # A server ignoring the range returns the whole object
+        if match is None:
+            return data, len(data), response.get("ETag")
+        return data, int(match.group(3)), response.get("ETag")
+
     def get(self, path):
         """
+        Reads a block. The first range of the block is read along with its
+        size, the following ranges are then read in parallel and only if the
+        block was not overwritten in the meantime.
         Args:
             path(str): Path to the block
         Returns:
             bytes: The data to return
         """
-        response = self.client.get_object(Bucket=self.bucket, Key=path)
-        return response["Body"].read()
+        if self.range_size == 0:
+            return self.client.get_object(Bucket=self.bucket, Key=path)["Body"].read()
+        try:
+            first_range, size, etag = self.__get_object(path, 0, self.range_size - 1)
+        except botocore.exceptions.ClientError as error:
+            # Empty objects cannot satisfy any range
+            if error.response.get("Error", {}).get("Code") != "InvalidRange":
+                raise
+            return self.client.get_object(Bucket=self.bucket, Key=path)["Body"].read()
+        if len(first_range) >= size:
+            return first_range
+        starts = range(len(first_range), size, self.range_size)
+        ranges = self.transfer_executor.map(
+            lambda start: self.__get_object(path, start, min(start + self.range_size, size) - 1, etag=etag)[0],
+            starts)
+        return first_range + "".join(ranges)
+
+    def get_range(self, path, offset, length):
+        """
+        Reads part of a block, such as its header
+        Args:
+            path(str): Path to the block
+            offset(int): Position of the first byte to read
+            length(int): Number of bytes to read
+        Returns:
+            bytes: The bytes read, shorter than length if the block ends before
+        Raises:
+            ValueError: If offset is negative or length is not greater than 0
+        """
+        if not isinstance(offset, (int, long)) or offset < 0:
+            raise ValueError("offset argument must be an integer greater or equal to 0")
+        if not isinstance(length, (int, long)) or length <= 0:
+            raise ValueError("length argument must be an integer greater than 0")
+        return self.__get_object(path, offset, offset + length - 1)[0]
+
+    def __put_multipart(self, data, path):
+        """
+        Uploads a block in parts transferred in parallel, aborting the upload
+        if a part fails
+        """
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=path)["UploadId"]
+
+        def upload_part(number):
+            start = (number - 1) * self.part_size
+            response = self.client.upload_part(Bucket=self.bucket, Key=path, UploadId=upload_id,
+                                               PartNumber=number, Body=data[start:start + self.part_size])
+            return {"PartNumber": number, "ETag": response["ETag"]}
+
+        try:
+            parts = list(self.transfer_executor.map(upload_part,
+                                                    range(1, (len(data) - 1) // self.part_size + 2)))
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=path, UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=path, UploadId=upload_id)
+            raise
 
     def put(self, data, path):
         """
+        Stores a block, in parts if it is larger than the multipart threshold
         Args:
             data(bytes): Byte sequence of the file to store
             path(str): Key under which the data should be placed
         Returns:
             bool: True if the insertion worked
         """
-        self.client.put_object(Bucket=self.bucket, Key=path, Body=data)
+        if len(data) > self.multipart_threshold:
+            self.__put_multipart(data, path)
+        else:
+            self.client.put_object(Bucket=self.bucket, Key=path, Body=data)
         return True
 
+    def get_many(self, paths):
+        """
+        Fetches several blocks with concurrent requests
+        Args:
+            paths(list(str)): Paths to the blocks
+        Returns:
+            list(bytes): The data of each block in the order of the paths, None
+                         for the blocks that do not exist
+        """
+        def get_or_none(path):
+            try:
+                return self.get(path)
+            except botocore.exceptions.ClientError as error:
+                if error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                    return None
+                raise
+        return list(self.executor.map(get_or_none, paths))
+
+    def put_many(self, blocks):
+        """
+        Stores several blocks with concurrent requests
+        Args:
+            blocks(dict(str, bytes)): The data to store indexed by path
+        Returns:
+            bool: True if the insertions worked
+        """
+        return all(self.executor.map(lambda path: self.put(blocks[path], path), blocks.keys()))
+
     def delete(self, path):
         """
         Args:
@@ -56,6 +233,32 @@ class S3Provider(object):
         response = self.client.delete_object(Bucket=self.bucket, Key=path)
         return response["DeleteMarker"]
 
+    def delete_many(self, paths):
+        """
+        Deletes several blocks in a single request
+        Args:
+            paths(list(str)): Paths to the files
+        Returns:
+            int: The number of files deleted
+        """
+        deleted = 0
+        for start in xrange(0, len(paths), S3Provider.MAXIMUM_KEYS_PER_DELETE):
+            objects = [{"Key": path} for path in paths[start:start + S3Provider.MAXIMUM_KEYS_PER_DELETE]]
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": False})
+            deleted += len(response.get("Deleted", []))
+        return deleted
+
+    def ping(self):
+        """
+        Checks that the bucket can be reached
+        Returns:
+            bool: True if the bucket answered
+        Raises:
+            botocore.exceptions.ClientError: If the bucket cannot be accessed
+        """
+        self.client.head_bucket(Bucket=self.bucket)
+        return True
+
     def list(self):
         """
         Lists all objects in the bucket
@@ -0,0 +1,490 @@
+"""
+A log-structured store appending blocks to large segment files instead of
+writing each block to its own file
+"""
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+import enum
+
+LOGGER = logging.getLogger("disk")
+
+# checksum, record type, key length, data length, followed by the key and data
+RECORD = struct.Struct(">IBHQ")
+# record type, key length, record offset, data length, followed by the key
+INDEX_ENTRY = struct.Struct(">BHQQ")
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.log$")
+
+
+class RecordType(enum.Enum):
+    """
+    Type of a record of a segment. A DELETE record is a tombstone hiding the
+    previous records of its key.
+    """
+    PUT = 0
+    DELETE = 1
+
+
+def compute_record_checksum(record_type, key, data):
+    """
+    Computes the checksum protecting a record against torn writes
+    Args:
+        record_type(RecordType): Type of the record
+        key(str): Key of the block
+        data(bytes): Data of the block
+    Returns:
+        int: The CRC32 of the record as an unsigned integer
+    """
+    checksum = zlib.crc32(struct.pack(">BHQ", record_type.value, len(key), len(data)))
+    checksum = zlib.crc32(key, checksum)
+    return zlib.crc32(data, checksum) & 0xffffffff
+
+
+class SegmentStore(object):
+    """
+    Appends blocks to segment files and keeps the location of each block in
+    memory. When a segment reaches its maximum size, it is sealed by writing
+    its index next to it. On start, the locations are recovered from the
+    indices of the sealed segments and by scanning the last segment up to its
+    first torn record. Segments holding too many deleted or overwritten blocks
+    are compacted in the background by copying their live blocks to the end
+    of the log. Sealed segments never change, so they can be memory mapped
+    and their blocks returned as buffers over the mappings.
+    """
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    COMPACTION_THRESHOLD = 0.5
+
+    def __init__(self, folder, segment_size=SEGMENT_SIZE, compaction_threshold=COMPACTION_THRESHOLD,
+                 memory_map=False):
+        """
+        SegmentStore constructor
+        Args:
+            folder(str): Folder holding the segments
+            segment_size(int, optional): Size in bytes after which a segment is
+                                         sealed
+            compaction_threshold(float, optional): Fraction of dead bytes of a
+                                                   sealed segment from which it
+                                                   is compacted
+            memory_map(bool, optional): Whether the blocks of the sealed
+                                        segments are returned as buffers over
+                                        memory mapped segments
+        Raises:
+            ValueError: If segment_size is not an integer greater than 0 or
+                        compaction_threshold is not a number in ]0, 1]
+        """
+        if not isinstance(segment_size, (int, long)) or segment_size <= 0:
+            raise ValueError("segment_size argument must be an integer greater than 0")
+        if not isinstance(compaction_threshold, (int, float)) or not 0 < compaction_threshold <= 1:
+            raise ValueError("compaction_threshold argument must be a number greater than 0 and lower or equal to 1")
+        self.folder = folder
+        self.segment_size = segment_size
+        self.compaction_threshold = float(compaction_threshold)
+        self.memory_map = memory_map
+        self.lock = threading.Lock()
+        self.compactor = None
+        # Segments being compacted, claimed by a single compaction at a time
+        self.compacting = set()
+        self.recover()
+
+    def __get_segment_path(self, segment):
+        return os.path.join(self.folder, "segment-{:08d}.log".format(segment))
+
+    def __get_index_path(self, segment):
+        return os.path.join(self.folder, "segment-{:08d}.index".format(segment))
+
+    def __reset(self):
+        """
+        Forgets the segments and blocks known to the store
+        """
+        self.index = {}
+        self.sizes = {}
+        self.dead = {}
+        self.entries = {}
+        self.readers = {}
+        self.mappings = {}
+        self.writer = None
+        self.active = None
+
+    def recover(self):
+        """
+        Rebuilds the locations of the blocks from the segments on disk. The
+        indices of the sealed segments are loaded, the other segments are
+        scanned and truncated at their first torn record.
+        """
+        with self.lock:
+            self.__reset()
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            segments = []
+            for entry in os.listdir(self.folder):
+                if entry.endswith(".tmp"):
+                    os.remove(os.path.join(self.folder, entry))
+                    continue
+                match = SEGMENT_PATTERN.match(entry)
+                if match:
+                    segments.append(int(match.group(1)))
+            segments.sort()
+            for segment in segments:
+                self.sizes[segment] = os.path.getsize(self.__get_segment_path(segment))
+                self.dead[segment] = 0
+                if os.path.isfile(self.__get_index_path(segment)):
+                    entries = self.__load_index(segment)
+                else:
+                    entries = self.__scan(segment)
+                for entry in entries:
+                    self.__apply(segment, *entry)
+                if segment != segments[-1] and not os.path.isfile(self.__get_index_path(segment)):
+                    self.__write_index(segment, entries)
+            if segments and not os.path.isfile(self.__get_index_path(segments[-1])):
+                self.active = segments[-1]
+                self.entries[self.active] = entries
+                self.writer = open(self.__get_segment_path(self.active), "ab")
+            self.next_segment = segments[-1] + 1 if segments else 0
+
+    def __load_index(self, segment):
+        """
+        Reads the index of a sealed segment
+        Args:
+            segment(int): Number of the segment
+        Returns:
+            list(tuple): The type, key, offset and length of the data of each
+                         record of the segment
+        """
+        with open(self.__get_index_path(segment), "rb") as handle:
+            content = handle.read()
+        entries = []
+        position = 0
+        while position < len(content):
+            record_type, key_length, offset, length = INDEX_ENTRY.unpack_from(content, position)
+            position += INDEX_ENTRY.size
+            key = content[position:position + key_length]
+            position += key_length
+            entries.append((RecordType(record_type), key, offset, length))
+        return entries
+
+    def __scan(self, segment):
+        """
+        Reads the records of a segment, truncating it at the first record that
+        is incomplete or does not match its checksum
+        Args:
+            segment(int): Number of the segment
+        Returns:
+            list(tuple): The type, key, offset and length of the data of each
+                         valid record of the segment
+        """
+        path = self.__get_segment_path(segment)
+        entries = []
+        offset = 0
+        with open(path, "rb") as handle:
+            while True:
+                header = handle.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                checksum, record_type, key_length, length = RECORD.unpack(header)
+                key = handle.read(key_length)
+                data = handle.read(length)
+                if len(key) < key_length or len(data) < length or record_type not in (0, 1) or \
+                   compute_record_checksum(RecordType(record_type), key, data) != checksum:
+                    break
+                entries.append((RecordType(record_type), key, offset, length))
+                offset += RECORD.size + key_length + length
+        if offset < self.sizes[segment]:
+            LOGGER.warning("Truncating segment {:d} after its last valid record at offset {:d}".format(segment,
+                                                                                                      offset))
+            with open(path, "r+b") as handle:
+                handle.truncate(offset)
+            self.sizes[segment] = offset
+        return entries
+
+    def __write_index(self, segment, entries):
+        """
+        Writes the index of a segment, replacing any previous index at once
+        Args:
+            segment(int): Number of the segment
+            entries(list(tuple)): The type, key, offset and length of the data
+                                  of each record of the segment
+        """
+        path = self.__get_index_path(segment)
+        with open(path + ".tmp", "wb") as handle:
+            for record_type, key, offset, length in entries:
+                handle.write(INDEX_ENTRY.pack(record_type.value, len(key), offset, length))
+                handle.write(key)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(path + ".tmp", path)
+
+    def __apply(self, segment, record_type, key, offset, length):
+        """
+        Updates the locations of the blocks with a record, accounting for the
+        bytes that the record makes dead
+        """
+        previous = self.index.pop(key, None)
+        if previous is not None:
+            self.dead[previous[0]] += RECORD.size + len(key) + previous[2]
+            self.__check_compaction(previous[0])
+        if record_type == RecordType.PUT:
+            self.index[key] = (segment, offset, length)
+        else:
+            # A tombstone is only needed until the older segments are compacted
+            self.dead[segment] += RECORD.size + len(key) + length
+
+    def __append(self, record_type, key, data):
+        """
+        Appends a record to the active segment, sealing it first if it is full
+        Returns:
+            int: The offset of the record in the active segment
+        """
+        if self.active is not None and self.sizes[self.active] >= self.segment_size:
+            self.__seal()
+        if self.active is None:
+            self.active = self.next_segment
+            self.next_segment += 1
+            self.sizes[self.active] = 0
+            self.dead[self.active] = 0
+            self.entries[self.active] = []
+            self.writer = open(self.__get_segment_path(self.active), "ab")
+        offset = self.sizes[self.active]
+        checksum = compute_record_checksum(record_type, key, data)
+        self.writer.write(RECORD.pack(checksum, record_type.value, len(key), len(data)))
+        self.writer.write(key)
+        self.writer.write(data)
+        self.sizes[self.active] += RECORD.size + len(key) + len(data)
+        self.entries[self.active].append((record_type, key, offset, len(data)))
+        self.__apply(self.active, record_type, key, offset, len(data))
+        return offset
+
+    def __seal(self):
+        """
+        Seals the active segment by writing its index
+        """
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.__write_index(self.active, self.entries.pop(self.active))
+        sealed = self.active
+        self.writer = None
+        self.active = None
+        self.__check_compaction(sealed)
+
+    def __get_reader(self, segment):
+        """
+        Returns the handle used to read a segment, opening it if needed
+        """
+        reader = self.readers.get(segment)
+        if reader is None:
+            reader = (open(self.__get_segment_path(segment), "rb"), threading.Lock())
+            self.readers[segment] = reader
+        return reader
+
+    def __get_mapping(self, segment):
+        """
+        Returns the memory mapping of a sealed segment, mapping it if needed
+        """
+        mapping = self.mappings.get(segment)
+        if mapping is None:
+            with open(self.__get_segment_path(segment), "rb") as handle:
+                mapping = mmap.mmap(handle.fileno(), self.sizes[segment], access=mmap.ACCESS_READ)
+            self.mappings[segment] = mapping
+        return mapping
+
+    def get(self, key):
+        """
+        Reads a block
+        Args:
+            key(str): Key of the block
+        Returns:
+            bytes|buffer: The data of the block, a buffer over the memory
+                          mapped segment if memory_map is set and the segment
+                          is sealed, None if the block does not exist
+        """
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            segment, offset, length = location
+            if self.memory_map and segment != self.active and length > 0:
+                # The buffer keeps the mapping alive after compaction
+                return buffer(self.__get_mapping(segment), offset + RECORD.size + len(key), length)
+            handle, reader_lock = self.__get_reader(segment)
+        # A compacted segment is only unlinked, the handle can still read it
+        with reader_lock:
+            handle.seek(offset + RECORD.size + len(key))
+            return handle.read(length)
+
+    def put(self, data, key):
+        """
+        Appends a block to the log
+        Args:
+            data(bytes): The data of the block
+            key(str): Key of the block
+        """
+        self.put_many({key: data})
+
+    def put_many(self, blocks):
+        """
+        Appends several blocks to the log with a single flush
+        Args:
+            blocks(dict(str, bytes)): The data of the blocks indexed by key
+        """
+        if not blocks:
+            return
+        with self.lock:
+            for key in sorted(blocks):
+                self.__append(RecordType.PUT, key, blocks[key])
+            self.writer.flush()
+
+    def delete(self, key):
+        """
+        Deletes a block by appending a tombstone to the log
+        Args:
+            key(str): Key of the block
+        Returns:
+            bool: True if the block was deleted, False if it did not exist
+        """
+        with self.lock:
+            if key not in self.index:
+                return False
+            self.__append(RecordType.DELETE, key, "")
+            self.writer.flush()
+            return True
+
+    def list(self):
+        """
+        Returns:
+            list(str): The keys of the blocks in the log
+        """
+        with self.lock:
+            return list(self.index)
+
+    def clear(self):
+        """
+        Removes all the segments
+        Returns:
+            bool: True if all the data was deleted
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+            for entry in os.listdir(self.folder):
+                os.remove(os.path.join(self.folder, entry))
+            self.__reset()
+            self.next_segment = 0
+            return len(os.listdir(self.folder)) == 0
+
+    def __check_compaction(self, segment):
+        """
+        Starts the compaction if a sealed segment holds too many dead bytes
+        """
+        if segment != self.active and self.__needs_compaction(segment):
+            self.start_compacting()
+
+    def __needs_compaction(self, segment):
+        return self.sizes[segment] > 0 and \
+               self.dead[segment] >= self.compaction_threshold * self.sizes[segment]
+
+    def __can_compact(self, segment):
+        return segment != self.active and segment not in self.compacting and self.__needs_compaction(segment)
+
+    def start_compacting(self):
+        """
+        Starts the thread compacting the segments if it is not running yet.
+        Must be called with the lock held.
+        """
+        if self.compactor is not None:
+            return
+        self.compactor = threading.Thread(target=self.run_compaction, name="segment-compactor")
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def run_compaction(self):
+        """
+        Compacts the segments until none of them needs to be
+        """
+        try:
+            while True:
+                if self.compact() > 0:
+                    continue
+                with self.lock:
+                    # A segment may have reached the threshold in the meantime
+                    if any(self.__can_compact(segment) for segment in self.sizes):
+                        continue
+                    self.compactor = None
+                    return
+        except (IOError, OSError) as error:
+            LOGGER.error("Could not compact the segments: {}".format(error))
+            with self.lock:
+                self.compactor = None
+
+    def compact(self):
+        """
+        Compacts the sealed segments whose fraction of dead bytes reached the
+        compaction threshold, skipping the segments already being compacted
+        Returns:
+            int: The number of segments compacted
+        """
+        with self.lock:
+            segments = sorted(segment for segment in self.sizes if self.__can_compact(segment))
+        return sum(1 for segment in segments if self.__compact(segment))
+
+    def __compact(self, segment):
+        """
+        Copies the live blocks of a sealed segment to the end of the log and
+        removes the segment
+        Returns:
+            bool: False if the segment was removed or claimed by another
+                  compaction, True otherwise
+        """
+        with self.lock:
+            if segment not in self.sizes or segment in self.compacting:
+                return False
+            self.compacting.add(segment)
+        try:
+            self.__copy_live_records(segment)
+        finally:
+            with self.lock:
+                self.compacting.discard(segment)
+        LOGGER.debug("Compacted segment {:d}".format(segment))
+        return True
+
+    def __copy_live_records(self, segment):
+        """
+        Copies the live blocks and the needed tombstones of a claimed segment
+        to the end of the log and removes the segment. Each copy is flushed
+        before the lock is released so that the concurrent reads of the active
+        segment see it.
+        """
+        entries = self.__load_index(segment)
+        for record_type, key, offset, length in entries:
+            if record_type == RecordType.PUT:
+                with self.lock:
+                    if self.index.get(key) != (segment, offset, length):
+                        continue
+                    handle, reader_lock = self.__get_reader(segment)
+                with reader_lock:
+                    handle.seek(offset + RECORD.size + len(key))
+                    data = handle.read(length)
+                with self.lock:
+                    if self.index.get(key) == (segment, offset, length):
+                        self.__append(RecordType.PUT, key, data)
+                        self.writer.flush()
+            else:
+                with self.lock:
+                    # The tombstone still hides the block in an older segment
+                    if key not in self.index and any(other < segment for other in self.sizes):
+                        self.__append(RecordType.DELETE, key, "")
+                        self.writer.flush()
+        with self.lock:
+            if self.writer is not None:
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+            os.remove(self.__get_index_path(segment))
+            os.remove(self.__get_segment_path(segment))
+            del self.sizes[segment]
+            del self.dead[segment]
+            self.readers.pop(segment, None)
+            self.mappings.pop(segment, None)
@@ -0,0 +1,126 @@
+"""
+Checks the integrity of the replicas read from the providers against the
+checksums stored in their metablocks
+"""
+import hashlib
+import random
+import threading
+import zlib
+
+import enum
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def compute_checksum(data):
+    """
+    Computes the SHA256 digest of a block. When hashlib is backed by OpenSSL,
+    the GIL is released while hashing so that several threads can hash in
+    parallel.
+    Args:
+        data(bytes): The data of the block
+    Returns:
+        bytes: The SHA256 digest of the data
+    """
+    return hashlib.sha256(data).digest()
+
+
+def compute_fast_checksum(data):
+    """
+    Computes the CRC32 of a block. The data is hashed by chunks so that the
+    other threads can run between two chunks.
+    Args:
+        data(bytes): The data of the block
+    Returns:
+        int: The CRC32 of the data as an unsigned integer
+    """
+    checksum = 0
+    for start in xrange(0, len(data), CHUNK_SIZE):
+        checksum = zlib.crc32(buffer(data, start, CHUNK_SIZE), checksum)
+    return checksum & 0xffffffff
+
+
+class VerificationMode(enum.Enum):
+    """
+    Integrity checks made on the replicas read. ALWAYS checks the SHA256
+    digest of every replica, SAMPLED only checks the SHA256 digest of a
+    fraction of the replicas and FAST checks the CRC32 of the replicas whose
+    metablock has one and the SHA256 digest of the others.
+    """
+    ALWAYS = 0
+    SAMPLED = 1
+    FAST = 2
+
+
+class BlockVerifier(object):
+    """
+    Verifies the replicas read from the providers according to a verification
+    mode and counts the checks made. The full SHA256 digests are still checked
+    when scrubbing the providers.
+    """
+    SAMPLE_RATE = 0.1
+
+    def __init__(self, mode=VerificationMode.ALWAYS, sample_rate=SAMPLE_RATE):
+        """
+        BlockVerifier constructor
+        Args:
+            mode(VerificationMode, optional): The checks to make on the
+                                              replicas
+            sample_rate(float, optional): Fraction of the replicas checked in
+                                          SAMPLED mode
+        Raises:
+            ValueError: If mode is not a VerificationMode or sample_rate is not
+                        a number between 0 and 1
+        """
+        if not isinstance(mode, VerificationMode):
+            raise ValueError("mode argument must be a VerificationMode")
+        if not isinstance(sample_rate, (int, float)) or not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate argument must be a number between 0 and 1")
+        self.mode = mode
+        self.sample_rate = float(sample_rate)
+        self.lock = threading.Lock()
+        self.counters = {
+            "checksums": 0,
+            "fast_checksums": 0,
+            "skipped": 0,
+            "mismatches": 0
+        }
+
+    def __count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def verify(self, data, metablock):
+        """
+        Checks a replica against its metablock
+        Args:
+            data(bytes): The data of the replica
+            metablock(MetaBlock): The metablock describing the block
+        Returns:
+            bool: False if the replica does not match its metablock, True
+                  otherwise
+        """
+        if self.mode == VerificationMode.SAMPLED and random.random() >= self.sample_rate:
+            self.__count("skipped")
+            valid = not metablock.size or len(data) == metablock.size
+        elif self.mode == VerificationMode.FAST and metablock.fast_checksum is not None:
+            self.__count("fast_checksums")
+            valid = compute_fast_checksum(data) == metablock.fast_checksum
+        else:
+            self.__count("checksums")
+            valid = compute_checksum(data) == metablock.checksum
+        if not valid:
+            self.__count("mismatches")
+        return valid
+
+    def statistics(self):
+        """
+        Returns:
+            dict: The verification mode and the number of SHA256 digests and
+                  CRC32 computed, of replicas whose check was skipped and of
+                  replicas that did not match their metablock
+        """
+        with self.lock:
+            statistics = dict(self.counters)
+        statistics["mode"] = self.mode.name
+        return statistics
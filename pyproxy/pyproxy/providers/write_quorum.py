@@ -0,0 +1,209 @@
+"""
+Keeps track of the replicas written for a document so that a write can be
+acknowledged once a quorum of the replicas of every block is stored while the
+remaining replicas are completed in the background
+"""
+import collections
+import logging
+import threading
+
+import concurrent.futures
+
+LOGGER = logging.getLogger("dispatcher")
+
+
+class WriteStatistics(object):
+    """
+    Counts the replicas written before and after the acknowledgement of the
+    writes and keeps the most recent failures
+    """
+    RECENT_FAILURES = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "writes": 0,
+            "failed_writes": 0,
+            "replicas": 0,
+            "background_replicas": 0,
+            "pending_background_replicas": 0,
+            "retries": 0,
+            "failed_replicas": 0,
+            "failed_metadata_updates": 0
+        }
+        self.recent_failures = collections.deque(maxlen=WriteStatistics.RECENT_FAILURES)
+
+    def count(self, name, value=1):
+        """
+        Increments a counter
+        Args:
+            name(str): Name of the counter
+            value(int, optional): Value added to the counter
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def fail(self, name, message):
+        """
+        Records a failure
+        Args:
+            name(str): Name of the counter of the failure
+            message(str): Description of the failure
+        """
+        LOGGER.error(message)
+        with self.lock:
+            self.counters[name] += 1
+            self.recent_failures.append(message)
+
+    def statistics(self):
+        """
+        Returns the counters and the most recent failures
+        Returns:
+            dict: The counters and the list of the most recent failures
+        """
+        with self.lock:
+            statistics = dict(self.counters)
+            statistics["recent_failures"] = list(self.recent_failures)
+            return statistics
+
+
+class QuorumWrite(object):
+    """
+    Tracks the replicas of the blocks of a document being written. The future
+    of the write completes with the metadata of the document once a quorum of
+    the replicas of every block is stored, or with a RuntimeError as soon as a
+    block cannot reach its quorum. The metadata only lists the providers that
+    confirmed the replicas, the replicas confirmed after the acknowledgement
+    are added to the metadata server in the background without modifying the
+    metadata returned.
+    """
+    RETRIES = 5
+    BACKOFF = 0.1
+
+    def __init__(self, metadata, metablocks, replicas, write_quorum, files, statistics, schedule):
+        """
+        QuorumWrite constructor
+        Args:
+            metadata(MetaDocument): The metadata of the document to complete
+                                    with the blocks
+            metablocks(dict(int, MetaBlock)): The metablocks indexed by block
+                                              index, without providers
+            replicas(dict(int, list(str))): The providers the replicas of each
+                                            block are written to
+            write_quorum(int): Number of replicas of each block that must be
+                               stored before acknowledging the write
+            files(Files): The metadata server updated in the background
+            statistics(WriteStatistics): The statistics to update
+            schedule(function): Function taking a delay in seconds and a
+                                function and running the function after the
+                                delay
+        """
+        self.metadata = metadata
+        self.metablocks = metablocks
+        self.replicas = replicas
+        self.write_quorum = write_quorum
+        self.files = files
+        self.statistics = statistics
+        self.schedule = schedule
+        self.lock = threading.Lock()
+        self.failed = {index: [] for index in replicas}
+        self.late = {index: [] for index in replicas}
+        self.acknowledged = False
+        self.error = None
+        self.future = concurrent.futures.Future()
+        self.statistics.count("writes")
+        short = sorted(index for index, providers in replicas.items() if len(providers) < write_quorum)
+        if short:
+            message = "Could not store block {:s} on {:d} providers, only {:d} replicas were placed".format(
+                metablocks[short[0]].key, write_quorum, len(replicas[short[0]]))
+            self.statistics.fail("failed_writes", message)
+            self.error = RuntimeError(message)
+            self.future.set_exception(self.error)
+        elif self.__has_reached_quorum():
+            self.future.set_result(self.metadata)
+
+    def __has_reached_quorum(self):
+        """
+        Checks whether every block reached its quorum and, if so, adds the
+        blocks to the metadata of the document
+        Returns:
+            bool: Whether the write can be acknowledged
+        """
+        if self.acknowledged:
+            return False
+        for index in self.replicas:
+            if len(self.metablocks[index].providers) < self.write_quorum:
+                return False
+        for index in sorted(self.metablocks):
+            self.metadata.blocks.append(self.metablocks[index])
+        pending = sum(len(self.replicas[index]) - len(self.metablocks[index].providers) - len(self.failed[index])
+                      for index in self.replicas)
+        self.statistics.count("pending_background_replicas", pending)
+        self.acknowledged = True
+        return True
+
+    def confirm(self, index, provider, done):
+        """
+        Records the outcome of the write of a replica
+        Args:
+            index(int): Index of the block
+            provider(str): Name of the provider the replica was written to
+            done(concurrent.futures.Future): The completed future of the write
+        """
+        metablock = self.metablocks[index]
+        with self.lock:
+            if self.error is not None:
+                return
+            acknowledged = self.acknowledged
+            if acknowledged:
+                self.statistics.count("pending_background_replicas", -1)
+            if done.exception() is not None:
+                message = "Could not store block {:s} on provider {:s}: {}".format(metablock.key, provider,
+                                                                                  done.exception())
+                self.statistics.fail("failed_replicas", message)
+                self.failed[index].append(provider)
+                if acknowledged or len(self.replicas[index]) - len(self.failed[index]) >= self.write_quorum:
+                    return
+                self.statistics.count("failed_writes")
+                self.error = RuntimeError("Could not store block {:s} on {:d} providers".format(metablock.key,
+                                                                                              self.write_quorum))
+            elif acknowledged:
+                # The metablock belongs to the caller once the write is acknowledged
+                self.late[index].append(provider)
+                self.statistics.count("background_replicas")
+            else:
+                metablock.providers.append(provider)
+                self.statistics.count("replicas")
+                if not self.__has_reached_quorum():
+                    return
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        elif acknowledged:
+            self.update(index)
+        else:
+            self.future.set_result(self.metadata)
+
+    def update(self, index, attempt=0):
+        """
+        Adds the providers confirmed for a block after the acknowledgement to
+        the metadata server. The providers are kept aside by the metadata
+        server until the metadata of the document is stored.
+        Args:
+            index(int): Index of the block
+            attempt(int, optional): Number of previous attempts
+        """
+        key = self.metablocks[index].key
+        with self.lock:
+            providers = list(self.late[index])
+        try:
+            self.files.add_block_providers(key, providers)
+            return
+        except Exception as error:
+            failure = error
+        if attempt >= QuorumWrite.RETRIES:
+            message = "Could not add the replicas of block {:s} on {:s} to its metadata: {}".format(
+                key, ",".join(providers), failure)
+            self.statistics.fail("failed_metadata_updates", message)
+            return
+        self.statistics.count("retries")
+        self.schedule(QuorumWrite.BACKOFF * 2 ** attempt, lambda: self.update(index, attempt + 1))
@@ -53,7 +53,7 @@ class ProxyService(ProxyServicer):
                                     reconstruct_if_missing=reconstruct_if_missing)
         reply = Strip()
         if not isinstance(data, pyproxy.providers.dispatcher.NoReplicaException):
-            reply.data = data
+            reply.data = str(data)
         self.logger.debug("End   {:s}".format(call_signature))
         return reply
 
@@ -75,6 +75,6 @@ def get_random_blocks(blocks):
     for random_block in random_blocks:
         strip = Strip()
         strip.id = random_block[0]
-        strip.data = random_block[1]
+        strip.data = str(random_block[1])
         strips.append(strip)
     return strips
@@ -11,7 +11,7 @@ import os
 import time
 
 from pyproxy.coding_utils import reconstruct_as_pointer, reconstruct_with_RS
-from pyproxy.metadata import compute_block_key, convert_binary_to_hex_digest, Files
+from pyproxy.metadata import compute_block_key, convert_binary_to_hex_digest
 from pyproxy.pyproxy.providers import Dispatcher, extract_index_from_key, extract_path_from_key
 
 PATH_TO_DISPATCHER_CONFIGURATION = os.path.join(os.path.dirname(__file__),
@@ -58,49 +58,51 @@ def audit():
                               to be reconstructed
     """
     reconstruction_needed = []
-    dispatcher = Dispatcher(get_dispatcher_configuration())
-    files = Files(host="metadata")
+    dispatcher = Dispatcher(get_dispatcher_configuration(), cached=False)
+    files = dispatcher.files
     # List blocks
-    blocks = files.get_blocks(files.list_blocks())
+    blocks = files.scan_blocks()
     # For each block
-    for block in blocks:
-        LOGGER.debug("Looking at block {:s}".format(block.key))
+    for index in xrange(len(blocks)):
+        key = blocks.get_key(index)
+        checksum = blocks.get_checksum(index)
+        LOGGER.debug("Looking at block {:s}".format(key))
     #   For each replica of the block
-        providers = list(set(block.providers))
+        providers = list(set(blocks.get_providers(index)))
         for provider_name in providers:
-            LOGGER.debug("Looking at replica of {:s} on {:s}".format(block.key, provider_name))
+            LOGGER.debug("Looking at replica of {:s} on {:s}".format(key, provider_name))
     #       Download replica
-            replica = dispatcher.providers[provider_name].get(block.key)
+            replica = dispatcher.providers[provider_name].get(key)
             computed_checksum = None
             if replica:
                 computed_checksum = hashlib.sha256(replica).digest()
     #       If the replica does not match its checksum
-            if not replica or computed_checksum != block.checksum:
+            if not replica or computed_checksum != checksum:
                 repaired = False
                 if not replica:
-                    LOGGER.warn("Could not load replica of {:s} on {:s}".format(block.key, provider_name))
+                    LOGGER.warn("Could not load replica of {:s} on {:s}".format(key, provider_name))
                 if computed_checksum:
-                    LOGGER.warn("Replica of {:s} on {:s} does not match expected checksum (actual = {:s}, expected = {:s})".format(block.key, provider_name, convert_binary_to_hex_digest(computed_checksum), convert_binary_to_hex_digest(block.checksum)))
+                    LOGGER.warn("Replica of {:s} on {:s} does not match expected checksum (actual = {:s}, expected = {:s})".format(key, provider_name, convert_binary_to_hex_digest(computed_checksum), convert_binary_to_hex_digest(checksum)))
     #           Look for sane replicas
                 other_providers = list(set(providers).difference(set([provider_name])))
                 if other_providers:
                     for other_provider in other_providers:
-                        candidate_replica = dispatcher.providers[other_provider].get(block.key)
+                        candidate_replica = dispatcher.providers[other_provider].get(key)
                         if not candidate_replica:
                             continue
                         candidate_checksum = hashlib.sha256(candidate_replica).digest()
-                        if candidate_checksum == block.checksum:
+                        if candidate_checksum == checksum:
     #                       Copy the new valid replica
-                            dispatcher.providers[provider_name].put(candidate_replica, block.key)
+                            dispatcher.providers[provider_name].put(candidate_replica, key)
                             repaired = True
                             break
     #           Otherwise
                 if not repaired:
     #               Queue the block for reconstruction
-                    LOGGER.warn("Replica of {:s} on {:s} must be reconstructed".format(block.key, provider_name))
-                    reconstruction_needed.append(block.key)
+                    LOGGER.warn("Replica of {:s} on {:s} must be reconstructed".format(key, provider_name))
+                    reconstruction_needed.append(key)
             else:
-                LOGGER.debug("Replica of {:s} on {:s} is OK".format(block.key, provider_name))
+                LOGGER.debug("Replica of {:s} on {:s} is OK".format(key, provider_name))
     return group_blocks_by_path(reconstruction_needed)
 
 def group_blocks_by_path(block_keys):
@@ -124,6 +126,22 @@ def group_blocks_by_path(block_keys):
         groups[path] = indices
     return groups
 
+def store_reconstructed_block(dispatcher, files, key, data):
+    """
+    Writes a reconstructed block back to the providers listed in its metadata
+    and registers them in the provider index
+    Args:
+        dispatcher(Dispatcher): Dispatcher holding the storage providers
+        files(Files): Metadata server
+        key(str): Key of the reconstructed block
+        data(bytes): Reconstructed block
+    """
+    metablock = files.get_block(key)
+    providers = set(metablock.providers)
+    for provider_name in providers:
+        dispatcher.providers[provider_name].put(data, metablock.key)
+    files.set_block_providers(metablock.key, list(providers))
+
 def repair(path, indices):
     """
     Repairs one or multiple blocks of a document
@@ -142,33 +160,24 @@ def repair(path, indices):
             error_message = "indices[{:d}] is not an integer".format(index)
             raise ValueError(error_message)
     erasures_threshold = get_erasure_threshold()
-    dispatcher = Dispatcher(get_dispatcher_configuration())
-    files = Files()
+    dispatcher = Dispatcher(get_dispatcher_configuration(), cached=False)
+    files = dispatcher.files
     if len(indices) <= erasures_threshold:
         reconstructed_blocks = reconstruct_with_RS(path, indices)
         for index in reconstructed_blocks:
             reconstructed_block = reconstructed_blocks[index]
-            metablock = files.get_block(compute_block_key(path, index))
-            for provider_name in set(metablock.providers):
-                dispatcher.providers[provider_name].put(reconstructed_block,
-                                                        metablock.key)
+            store_reconstructed_block(dispatcher, files, compute_block_key(path, index), reconstructed_block)
     else:
         #FIXME order of blocks to reach e erasures than do RS reconstuction
         indices.sort()
         while len(indices) > erasures_threshold:
             index = indices.pop(0)
             reconstructed_block = reconstruct_as_pointer(path, index)
-            metablock = files.get_block(compute_block_key(path, index))
-            for provider_name in set(metablock.providers):
-                dispatcher.providers[provider_name].put(reconstructed_block,
-                                                        metablock.key)
+            store_reconstructed_block(dispatcher, files, compute_block_key(path, index), reconstructed_block)
         reconstructed_blocks = reconstruct_with_RS(path, indices)
         for index in reconstructed_blocks:
             reconstructed_block = reconstructed_blocks[index]
-            metablock = files.get_block(compute_block_key(path, index))
-            for provider_name in set(metablock.providers):
-                dispatcher.providers[provider_name].put(reconstructed_block,
-                                                        metablock.key)
+            store_reconstructed_block(dispatcher, files, compute_block_key(path, index), reconstructed_block)
 
 def run_audit_and_repair():
     """
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+"""
+A script that moves the documents, and their blocks, whose metadata server
+changes when servers are added to a sharded metadata deployment. The proxies
+should not write metadata while the documents are moved.
+"""
+import argparse
+import logging
+
+from pyproxy.metadata import Files
+from pyproxy.metadata_sharding import HashRing, parse_server
+
+LOGGER = logging.getLogger("reshard_metadata")
+LOGGER.setLevel(logging.INFO)
+CONSOLE_HANDLER = logging.StreamHandler()
+CONSOLE_HANDLER.setLevel(logging.INFO)
+LOGGER.addHandler(CONSOLE_HANDLER)
+
+
+def move_document(source, destination, path):
+    """
+    Copies a document, its blocks and their entries in the indices to another
+    metadata server before removing them from their current server
+    Args:
+        source(Files): The metadata server storing the document
+        destination(Files): The metadata server the document is moved to
+        path(str): Path of the document
+    """
+    document = source.get(path)
+    pipeline = destination.redis.pipeline(transaction=True)
+    destination.write_document(pipeline, path, document)
+    pipeline.execute()
+
+    block_keys = [block.key for block in document.blocks]
+    pipeline = source.redis.pipeline(transaction=True)
+    pipeline.delete("{:s}{:s}".format(Files.FILE_PREFIX, path))
+    pipeline.hdel(Files.ENTANGLEMENT_GRAPH, path)
+    pipeline.zrem("file_index", path)
+    for block in document.blocks:
+        pipeline.delete("{:s}{:s}".format(Files.BLOCK_PREFIX, block.key),
+                        "{:s}{:s}".format(Files.POINTED_BY_PREFIX, block.key))
+        for provider in set(block.providers):
+            pipeline.srem("{:s}{:s}".format(Files.PROVIDER_PREFIX, provider), block.key)
+    if block_keys:
+        pipeline.zrem("block_index", *block_keys)
+    pipeline.execute()
+    cache_keys = ["{:s}{:s}".format(Files.FILE_PREFIX, path)] + \
+                 ["{:s}{:s}".format(Files.BLOCK_PREFIX, key) for key in block_keys]
+    source.invalidate(cache_keys)
+    destination.invalidate(cache_keys)
+
+
+def reshard(servers, virtual_nodes=HashRing.VIRTUAL_NODES, batch_size=Files.READ_BUFFER_SIZE):
+    """
+    Moves the documents that are not stored on the server the hash ring
+    assigns them to
+    Args:
+        servers(list(str)): Addresses of all the metadata servers, including
+                            the new ones, in the host:port format
+        virtual_nodes(int, optional): Number of points of each server on the
+                                      hash ring
+        batch_size(int, optional): Number of paths read at once from the file
+                                   index of a server
+    Returns:
+        int: The number of documents moved
+    """
+    ring = HashRing(servers, virtual_nodes=virtual_nodes)
+    shards = {}
+    for server in servers:
+        host, port = parse_server(server)
+        shards[server] = Files(host=host, port=port)
+    moved = 0
+    for server, source in shards.items():
+        position = 0
+        while True:
+            paths = source.redis.zrange("file_index", position, position + batch_size - 1)
+            if not paths:
+                break
+            for path in paths:
+                owner = ring.get_node(path)
+                if owner == server:
+                    position += 1
+                    continue
+                move_document(source, shards[owner], path)
+                moved += 1
+            LOGGER.info("Moved {:d} documents, looking at {:s}".format(moved, server))
+    return moved
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(__file__, description="A script that moves metadata between sharded metadata servers")
+    PARSER.add_argument("servers", type=str, nargs="+",
+                        help="Addresses (host:port) of all the metadata servers, including the new ones")
+    PARSER.add_argument("--virtual-nodes", type=int, default=HashRing.VIRTUAL_NODES,
+                        help="Number of points of each server on the hash ring")
+    PARSER.add_argument("--batch-size", type=int, default=Files.READ_BUFFER_SIZE,
+                        help="Number of paths read at once from the file index of a server")
+    ARGS = PARSER.parse_args()
+    MOVED = reshard(ARGS.servers, virtual_nodes=ARGS.virtual_nodes, batch_size=ARGS.batch_size)
+    LOGGER.info("Moved {:d} documents".format(MOVED))
@@ -14,20 +14,41 @@ import pyproxy.metadata as mtdt
 import pyproxy.pyproxy.providers.dispatcher as dsp
 import pyproxy.utils as utils
 
+PATH_TO_DISPATCHER_CONFIGURATION = "./dispatcher.json"
+
 __PROGRAM_DESCRIPTION = ("A script that scans the database looking for ",
                          "blocks that have passed a given threshold in ",
                          "order to delete their replicas")
 LOGGER = None
 KAZOO_CLIENT = None
 
-def list_replicas_to_delete(pointers, host="metadata", port=6379):
+def get_dispatcher(path_to_configuration=PATH_TO_DISPATCHER_CONFIGURATION, server=None):
+    """
+    Creates the dispatcher whose providers and metadata backend are scrubbed.
+    Its providers do not read through the block cache.
+    Args:
+        path_to_configuration(str, optional): Path to the dispatcher's
+                                              configuration file
+        server(str, optional): A single metadata server (host:port) replacing
+                               the servers of the configuration
+    Returns:
+        Dispatcher: The dispatcher
+    """
+    with open(path_to_configuration, "r") as handle:
+        dispatcher_configuration = json.load(handle)
+    if server is not None:
+        metadata_configuration = dict(dispatcher_configuration.get("metadata", {}))
+        metadata_configuration["servers"] = [server]
+        dispatcher_configuration["metadata"] = metadata_configuration
+    return dsp.Dispatcher(configuration=dispatcher_configuration, cached=False)
+
+def list_replicas_to_delete(pointers, files):
     """
     List the blocks that match the given threshold
     Args:
         pointers(int): The minimum number of documents pointing to a block for
                        the block to be considered for scrubbing
-        host(str, optional): The host metadata server
-        port(int, optional): The port the metadata server is listening in
+        files(Files|ShardedFiles): The metadata backend
     Returns:
         list(MetaBlock): The list of blocks that have passed the threshold
     Raises:
@@ -35,15 +56,14 @@ def list_replicas_to_delete(pointers, host="metadata", port=6379):
     """
     if not isinstance(pointers, int) or pointers < 0:
         raise ValueError("pointers must be an integer greater or equal to 0")
-    LOGGER.debug("list_replicas_to_delete: pointers={:d}, host={:s}, port={:d}".format(pointers, host, port))
-    files = mtdt.Files(host=host, port=port)
-    blocks = files.get_blocks(files.list_blocks())
+    LOGGER.debug("list_replicas_to_delete: pointers={:d}".format(pointers))
+    blocks = files.scan_blocks()
     LOGGER.debug("list_replicas_to_delete: loaded {:d} blocks to inspect".format(len(blocks)))
     consider_for_scrubbing = []
-    for block in blocks:
-        if files.has_been_entangled_enough(block.key, pointers) and \
-           len(set(block.providers)) > 1:
-            consider_for_scrubbing.append(block)
+    for index in xrange(len(blocks)):
+        if blocks.get_number_of_pointers(index) >= pointers and \
+           len(set(blocks.get_providers(index))) > 1:
+            consider_for_scrubbing.append(blocks[index])
     return consider_for_scrubbing
 
 def has_replicas(block):
@@ -60,42 +80,32 @@ def has_replicas(block):
     return len(block.providers) > 1
 
 
-def list_replicas_out_of_window_to_delete(window, host="metadata", port=6379):
+def list_replicas_out_of_window_to_delete(window, files):
     """
     List the documents whose replicas can be deleted.
     Args:
         window(int): The number of most recent documents whose blocks need to be replicated
-        host(str): Host of the metadata server
-        port(int): Port number the metadata server is listening on
+        files(Files|ShardedFiles): The metadata backend
     Returns:
         list(MetaBlock): The list of blocks that are considered in the old generation and can be deleted
     Raises:
-        ValueError: if window is not a number greater or equal to 0,
-                    if host is not a valid string or
-                    if port is not a number between 0 and 65535
+        ValueError: if window is not a number greater or equal to 0
     """
     if not isinstance(window, int) or window < 0:
         msg = "window must be an integer greater than 0"
         raise ValueError(msg)
-    if not host or not isinstance(host, (str, unicode)):
-        msg = "host argument must be a non-empty string"
-        raise ValueError(msg)
-    if not isinstance(port, int) or port < 0 or port > 65535:
-        msg = "port argument must be an integer between 0 and 65535"
-        raise ValueError(msg)
-    metadata = mtdt.Files(host=host, port=port)
-    blocks = metadata.get_blocks(metadata.list_blocks()[-window:])
+    blocks = files.get_blocks(files.list_blocks()[-window:])
     blocks_to_cleanup = [b for b in blocks if has_replicas(b)]
     return blocks_to_cleanup
 
 
-def delete_block(block, host="metadata", port=6379):
+def delete_block(block, dispatcher):
     """
     Removes location of replicas from metadata.
     Args:
         block(MetaBlock): The block whose replicas need to be destroyed
-        host(str, optional): The host metadata server
-        port(int, optional): The port the metadata server is listening on
+        dispatcher(Dispatcher): The dispatcher holding the providers and the
+                                metadata backend
     Returns:
         bool: Whether the block was deleted
     Raises:
@@ -103,25 +113,24 @@ def delete_block(block, host="metadata", port=6379):
     """
     if not block or not isinstance(block, mtdt.MetaBlock):
         raise ValueError("block argument must be a valid MetaBlock")
-    LOGGER.debug("delete_block: block={:s}, host={:s}, port={:d}".format(block.key, host, port))
-    files = mtdt.Files(host=host, port=port)
+    LOGGER.debug("delete_block: block={:s}".format(block.key))
+    files = dispatcher.files
     filename = dsp.extract_path_from_key(block.key)
-    with open("./dispatcher.json", "r") as handle:
-        dispatcher_configuration = json.load(handle)
-    dispatcher = dsp.Dispatcher(configuration=dispatcher_configuration)
     hostname = os.uname()[1]
     kazoo_resource = os.path.join("/", filename)
     kazoo_identifier = "repair-{:s}".format(hostname)
     with KAZOO_CLIENT.WriteLock(kazoo_resource, kazoo_identifier):
-        metadata = files.get(filename)
-        for metablock in metadata.blocks:
-            if metablock.key == block.key:
-                metablock.providers = metablock.providers[:1]
-                for provider_name in metablock.providers[1:]:
-                    dispatcher.providers[provider_name].delete(metablock.key)
-                    LOGGER.debug("delete_block: Removed replica of {:s} from {:s}".format(metablock.key, provider_name))
-                break
-        files.put(metadata.path, metadata)
+        try:
+            metablock = files.get_block(block.key)
+        except KeyError:
+            LOGGER.warning("delete_block: {:s} was removed since it was listed".format(block.key))
+            return False
+        providers_to_keep = metablock.providers[:1]
+        providers_to_trim = set(metablock.providers[1:]).difference(providers_to_keep)
+        files.set_block_providers(metablock.key, providers_to_keep)
+        for provider_name in providers_to_trim:
+            dispatcher.providers[provider_name].delete(metablock.key)
+            LOGGER.debug("delete_block: Removed replica of {:s} from {:s}".format(metablock.key, provider_name))
         return len(files.get_block(block.key).providers) == 1
 
 
@@ -160,13 +169,16 @@ if __name__ == "__main__":
                         "--window",
                         help="The size of the replication window",
                         type=int)
-    PARSER.add_argument("--hostname",
-                        help="The server hosting the metadata",
+    PARSER.add_argument("-c",
+                        "--configuration",
+                        help="The dispatcher configuration giving the providers and the metadata servers",
                         type=str,
-                        default="metadata")
-
+                        default=PATH_TO_DISPATCHER_CONFIGURATION)
+    PARSER.add_argument("--hostname",
+                        help="A single server hosting the metadata, overriding the configuration",
+                        type=str)
     PARSER.add_argument("--port",
-                        help="The port exposed by the metadata server",
+                        help="The port exposed by the metadata server given with --hostname",
                         type=int,
                         default=6379)
     PARSER.add_argument("-i",
@@ -177,6 +189,8 @@ if __name__ == "__main__":
     ARGS = PARSER.parse_args()
     LOGGER = init_logger()
     KAZOO_CLIENT = utils.init_zookeeper_client()
+    SERVER = "{:s}:{:d}".format(ARGS.hostname, ARGS.port) if ARGS.hostname else None
+    DISPATCHER = get_dispatcher(ARGS.configuration, server=SERVER)
     if ARGS.interval:
         LOGGER.info("Going to start scrubbing with {:d} seconds interval".format(ARGS.interval))
         while True:
@@ -185,13 +199,13 @@ if __name__ == "__main__":
                 LOGGER.info("Scrubbing database...")
                 BLOCKS = None
                 if ARGS.window:
-                    BLOCKS = list_replicas_out_of_window_to_delete(ARGS.window)
+                    BLOCKS = list_replicas_out_of_window_to_delete(ARGS.window, DISPATCHER.files)
                 else:
-                    BLOCKS = list_replicas_to_delete(ARGS.pointers)
+                    BLOCKS = list_replicas_to_delete(ARGS.pointers, DISPATCHER.files)
                 LOGGER.info("Found {:d} blocks to scrub".format(len(BLOCKS)))
                 for BLOCK in BLOCKS:
                     LOGGER.debug("Looking at {:s}".format(BLOCK.key))
-                    if delete_block(BLOCK):
+                    if delete_block(BLOCK, DISPATCHER):
                         LOGGER.info("Removed replicas of {:s}".format(BLOCK.key))
                     else:
                         LOGGER.error("Could not delete replicas of {:s}".format(BLOCK.key))
@@ -206,14 +220,14 @@ if __name__ == "__main__":
         BLOCKS = None
         if ARGS.window:
             LOGGER.info("Looking for blocks out of the {:d} documents window...".format(ARGS.window))
-            BLOCKS = list_replicas_out_of_window_to_delete(ARGS.window)
+            BLOCKS = list_replicas_out_of_window_to_delete(ARGS.window, DISPATCHER.files)
         else:
             LOGGER.info("Looking for blocks that have been pointed at at least {:d} times...".format(ARGS.pointers))
-            BLOCKS = list_replicas_to_delete(ARGS.pointers)
+            BLOCKS = list_replicas_to_delete(ARGS.pointers, DISPATCHER.files)
         LOGGER.info("Found {:d} blocks to scrub".format(len(BLOCKS)))
         for BLOCK in BLOCKS:
             LOGGER.debug("Looking at {:s}".format(BLOCK.key))
-            if delete_block(BLOCK):
+            if delete_block(BLOCK, DISPATCHER):
                 LOGGER.info("Removed replicas of {:s}".format(BLOCK.key))
             else:
                 LOGGER.error("Could not delete replicas of {:s}".format(BLOCK.key))
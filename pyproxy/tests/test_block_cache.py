@@ -0,0 +1,166 @@
+"""
+Unit tests for the block_cache module
+"""
+import hashlib
+
+import pytest
+
+from pyproxy.metadata import MetaBlock
+from pyproxy.providers.block_cache import BlockCache, CachingProvider, FrequencySketch
+
+class DictionaryProvider(object):
+    def __init__(self, blocks):
+        self.blocks = dict(blocks)
+        self.reads = 0
+    def get(self, key):
+        self.reads += 1
+        return self.blocks.get(key)
+    def put(self, data, key):
+        self.blocks[key] = data
+        return True
+    def delete(self, key):
+        return self.blocks.pop(key, None) is not None
+    def clear(self):
+        self.blocks.clear()
+        return True
+    def ping(self):
+        return True
+
+def test_frequency_sketch_halves_its_counters():
+    sketch = FrequencySketch(64)
+    for _ in xrange(5):
+        sketch.increment("popular")
+    assert sketch.estimate("popular") == 5
+    assert sketch.estimate("unknown") == 0
+    for _ in xrange(sketch.sample_size - 5):
+        sketch.increment("popular")
+    assert sketch.halved < sketch.width
+    # The counters are halved one column per increment
+    for _ in xrange(sketch.width):
+        sketch.increment("other")
+    assert sketch.halved == sketch.width
+    assert sketch.estimate("popular") == FrequencySketch.MAXIMUM_COUNT / 2
+
+def test_block_cache_raises_ValueError_if_the_sizes_are_invalid(tmpdir):
+    with pytest.raises(ValueError, match="capacity argument must be an integer greater than 0"):
+        BlockCache(memory_size=0)
+    with pytest.raises(ValueError, match="capacity argument must be an integer greater than 0"):
+        BlockCache(disk_folder=str(tmpdir), disk_size=0)
+    with pytest.raises(ValueError, match="pointer_weight argument must be a number greater or equal to 0"):
+        BlockCache(pointer_weight=-1)
+
+def get_me_a_metablock(key, data):
+    return MetaBlock(key, checksum=hashlib.sha256(data).digest(), size=len(data))
+
+def test_caching_provider_reads_through_the_cache():
+    wrapped = DictionaryProvider({"block-00": "a" * 10, "block-01": "b" * 10})
+    provider = CachingProvider("node", wrapped, BlockCache(memory_size=100))
+    assert provider.get("block-00") == "a" * 10
+    provider.admit(get_me_a_metablock("block-00", "a" * 10), "a" * 10)
+    assert provider.get_many(["block-00", "block-01", "missing"]) == ["a" * 10, "b" * 10, None]
+    provider.admit(get_me_a_metablock("block-01", "b" * 10), "b" * 10)
+    assert provider.get("block-01") == "b" * 10
+    assert wrapped.reads == 3
+    assert provider.ping()
+    assert provider.delete("block-00")
+    assert provider.get("block-00") is None
+    statistics = provider.cache.statistics()["memory"]
+    assert statistics["hits"] == 2
+    assert statistics["entries"] == 1
+    assert statistics["hit_rate"] == pytest.approx(2.0 / 6)
+
+def test_caching_provider_only_caches_verified_replicas():
+    wrapped = DictionaryProvider({"block-00": "corrupt"})
+    provider = CachingProvider("node", wrapped, BlockCache(memory_size=100))
+    provider.admit(get_me_a_metablock("block-00", "good"), provider.get("block-00"), verified=False)
+    assert not provider.cache.contains("node", "block-00")
+    wrapped.blocks["block-00"] = "good"
+    provider.admit(get_me_a_metablock("block-00", "good"), provider.get("block-00"), verified=False)
+    assert provider.cache.contains("node", "block-00")
+    provider.reject("block-00")
+    assert not provider.cache.contains("node", "block-00")
+
+def test_caching_provider_drops_the_cached_replicas_that_are_overwritten():
+    wrapped = DictionaryProvider({})
+    provider = CachingProvider("node", wrapped, BlockCache(memory_size=100))
+    for data in ["first", "second"]:
+        provider.put(data, "block-00")
+        assert provider.get("block-00") == data
+        provider.admit(get_me_a_metablock("block-00", data), data)
+    provider.put_many({"block-00": "third"})
+    assert provider.get("block-00") == "third"
+    provider.admit(get_me_a_metablock("block-00", "third"), "third")
+    assert provider.clear()
+    assert provider.get("block-00") is None
+
+def test_block_cache_only_admits_blocks_more_popular_than_their_victims():
+    cache = BlockCache(memory_size=20)
+    for _ in xrange(3):
+        cache.get("node", "popular-00")
+    cache.put("node", "popular-00", "p" * 10)
+    cache.get("node", "other-00")
+    cache.put("node", "other-00", "o" * 10)
+    cache.get("node", "one-hit-00")
+    cache.put("node", "one-hit-00", "x" * 10)
+    assert cache.get("node", "one-hit-00") is None
+    assert cache.get("node", "popular-00") == "p" * 10
+    assert cache.statistics()["memory"]["rejections"] == 1
+    # Blocks pointed to by many documents are favoured
+    cache.record_pointers([MetaBlock("pointer-00", entangled_with=["a", "b", "c", "d", "e"])])
+    cache.put("node", "pointer-00", "z" * 10)
+    assert cache.get("node", "pointer-00") == "z" * 10
+    assert cache.get("node", "other-00") is None
+
+def test_block_cache_demotes_evicted_blocks_to_disk(tmpdir):
+    cache = BlockCache(memory_size=10, disk_folder=str(tmpdir), disk_size=100, pointer_weight=0)
+    for _ in xrange(2):
+        cache.get("node", "block-01")
+    cache.put("node", "block-00", "a" * 10)
+    cache.put("node", "block-01", "b" * 10)
+    assert cache.statistics()["disk"]["entries"] == 1
+    assert cache.get("node", "block-00") == "a" * 10
+    statistics = cache.statistics()
+    assert statistics["disk"]["hits"] == 1
+    assert statistics["memory"]["entries"] == 1
+    # The blocks cached by a previous run may be stale
+    reloaded = BlockCache(memory_size=10, disk_folder=str(tmpdir), disk_size=100)
+    assert reloaded.get("node", "block-00") is None
+    assert reloaded.statistics()["disk"]["entries"] == 0
+
+def test_block_cache_reads_the_demoted_blocks_outside_of_the_lock(tmpdir):
+    cache = BlockCache(memory_size=10, disk_folder=str(tmpdir), disk_size=100, pointer_weight=0)
+    memory = cache.tiers[0][1]
+    read = memory.read
+    def read_unlocked(key):
+        assert not cache.lock.locked()
+        return read(key)
+    memory.read = read_unlocked
+    cache.get("node", "block-01")
+    cache.put("node", "block-00", "a" * 10)
+    cache.put("node", "block-01", "b" * 10)
+    assert cache.get("node", "block-00") == "a" * 10
+
+def test_block_cache_forgets_the_blocks_it_could_not_write(tmpdir):
+    cache = BlockCache(memory_size=100, disk_folder=str(tmpdir), disk_size=100)
+    memory = cache.tiers[0][1]
+    def failing_write(key, data):
+        raise IOError(36, "File name too long")
+    memory.write = failing_write
+    cache.put("node", "block-00", "a" * 10)
+    assert cache.get("node", "block-00") is None
+    statistics = cache.statistics()["memory"]
+    assert statistics["errors"] == 1
+    assert statistics["entries"] == 0
+    assert statistics["size"] == 0
+
+def test_block_cache_erases_the_blocks_discarded_while_being_written():
+    cache = BlockCache(memory_size=100)
+    memory = cache.tiers[0][1]
+    write = memory.write
+    def write_after_a_discard(key, data):
+        cache.discard("node", "block-00")
+        write(key, data)
+    memory.write = write_after_a_discard
+    cache.put("node", "block-00", "a" * 10)
+    assert memory.blocks == {}
+    assert memory.statistics()["entries"] == 0
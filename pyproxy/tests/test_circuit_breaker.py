@@ -0,0 +1,81 @@
+"""
+Unit tests for the circuit_breaker module
+"""
+import pytest
+
+import pyproxy.providers.circuit_breaker as circuit_breaker
+from pyproxy.providers.circuit_breaker import CircuitBreaker, CircuitState, ProviderBreakers
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "time", lambda: now[0])
+    return now
+
+def test_circuit_breaker_raises_ValueError_if_failure_threshold_is_lower_than_1():
+    with pytest.raises(ValueError, match="failure_threshold argument must be an integer greater than 0"):
+        CircuitBreaker(failure_threshold=0)
+
+def test_circuit_breaker_raises_ValueError_if_reset_timeout_is_negative():
+    with pytest.raises(ValueError, match="reset_timeout argument must be a number greater or equal to 0"):
+        CircuitBreaker(reset_timeout=-1)
+
+def test_provider_breakers_raises_ValueError_if_probe_interval_is_not_positive():
+    with pytest.raises(ValueError, match="probe_interval argument must be a number greater than 0"):
+        ProviderBreakers(lambda name: True, probe_interval=0)
+
+def test_circuit_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=5)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.get_state() == CircuitState.CLOSED
+    assert breaker.record_failure()
+    assert breaker.is_open()
+    assert breaker.statistics() == {"state": "OPEN", "failures": 3, "trips": 1}
+
+def test_circuit_breaker_half_opens_after_the_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    clock[0] += 4
+    assert breaker.get_state() == CircuitState.OPEN
+    clock[0] += 1
+    assert breaker.get_state() == CircuitState.HALF_OPEN
+    assert breaker.record_failure()
+    assert breaker.get_state() == CircuitState.OPEN
+    clock[0] += 5
+    assert breaker.get_state() == CircuitState.HALF_OPEN
+    breaker.record_success()
+    assert breaker.get_state() == CircuitState.CLOSED
+
+def test_provider_breakers_probe_the_providers_to_close_their_circuit(clock, monkeypatch):
+    answers = {"a": False, "b": True}
+    breakers = ProviderBreakers(lambda name: answers[name], failure_threshold=1, reset_timeout=5)
+    monkeypatch.setattr(breakers, "start_probing", lambda: None)
+    breakers.record_failure("a")
+    breakers.record_failure("b")
+    assert breakers.get_healthy(["a", "b", "c"]) == ["c"]
+    assert breakers.get_healthy(["a", "b"]) == ["a", "b"]
+    assert breakers.probe_providers() == 2
+    clock[0] += 5
+    assert breakers.probe_providers() == 1
+    assert breakers.is_open("a")
+    assert not breakers.is_open("b")
+    statistics = breakers.statistics()
+    assert statistics["a"]["state"] == "OPEN"
+    assert statistics["b"]["state"] == "CLOSED"
+
+def test_provider_breakers_stop_probing_once_all_circuits_are_closed():
+    answers = {"a": False}
+    breakers = ProviderBreakers(lambda name: answers[name], failure_threshold=1, reset_timeout=0,
+                                probe_interval=0.01)
+    breakers.record_failure("a")
+    prober = breakers.prober
+    assert prober is not None
+    answers["a"] = True
+    prober.join(timeout=1)
+    assert not prober.is_alive()
+    assert breakers.prober is None
+    assert not breakers.is_open("a")
@@ -0,0 +1,57 @@
+"""
+Unit tests for the degraded_read module
+"""
+import mock
+import pytest
+
+from pyproxy.metadata import BlockType, MetaBlock
+from pyproxy.providers.degraded_read import ReadPlan
+
+def get_me_metablocks():
+    metablocks = {index: MetaBlock("hello-{:02d}".format(index), providers=["a", "b"]) for index in xrange(4)}
+    metablocks.update({index: MetaBlock("hello-{:02d}".format(index), providers=["c"], block_type=BlockType.PARITY)
+                       for index in xrange(4, 6)})
+    return metablocks
+
+def get_index(key):
+    return int(key.split("-")[-1])
+
+def test_read_plan_raises_ValueError_if_fallback_waves_is_negative():
+    with pytest.raises(ValueError, match="fallback_waves argument must be an integer greater or equal to 0"):
+        ReadPlan({}, mock.MagicMock(), fallback_waves=-1)
+
+def test_read_plan_fetches_the_data_blocks_without_the_coder():
+    get_coder = mock.MagicMock()
+    plan = ReadPlan(get_me_metablocks(), get_coder)
+    assert not plan.is_degraded()
+    wave = plan.next_wave()
+    assert [metablock.key for metablock in wave] == ["hello-00", "hello-01", "hello-02", "hello-03"]
+    plan.add({metablock.key: metablock.key for metablock in wave}, get_index)
+    assert plan.is_complete()
+    assert plan.get_blocks() == ["hello-00", "hello-01", "hello-02", "hello-03"]
+    assert plan.next_wave() == []
+    get_coder.assert_not_called()
+
+def test_read_plan_compensates_for_the_unavailable_blocks_in_the_first_wave():
+    metablocks = get_me_metablocks()
+    metablocks[1].providers = ["down"]
+    coder = mock.MagicMock()
+    coder.fragments_needed.return_value = [4]
+    plan = ReadPlan(metablocks, lambda: coder, is_available=lambda provider: provider != "down")
+    assert plan.is_degraded()
+    assert [metablock.key for metablock in plan.next_wave()] == ["hello-00", "hello-02", "hello-03", "hello-04"]
+    coder.fragments_needed.assert_called_once_with([1])
+
+def test_read_plan_stops_after_the_fallback_waves():
+    coder = mock.MagicMock()
+    coder.fragments_needed.side_effect = lambda missing: [max(missing) + 1]
+    plan = ReadPlan(get_me_metablocks(), lambda: coder, fallback_waves=1)
+    wave = plan.next_wave()
+    blocks = {metablock.key: metablock.key for metablock in wave}
+    blocks["hello-03"] = IOError("no replica")
+    plan.add(blocks, get_index)
+    assert [metablock.key for metablock in plan.next_wave()] == ["hello-04"]
+    plan.add({"hello-04": IOError("no replica")}, get_index)
+    assert plan.next_wave() == []
+    assert not plan.is_complete()
+    assert coder.fragments_needed.call_count == 1
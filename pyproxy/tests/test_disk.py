@@ -0,0 +1,100 @@
+"""
+Unit tests for the disk module
+"""
+import os
+
+import pytest
+
+from pyproxy.providers.disk import Disk, migrate_layout
+
+def list_files(folder):
+    return sorted(os.path.relpath(os.path.join(directory, name), folder)
+                  for directory, _, files in os.walk(folder) for name in files)
+
+def test_disk_raises_ValueError_if_mode_is_not_supported(tmpdir):
+    with pytest.raises(ValueError, match="mode argument must be either files or segments"):
+        Disk(str(tmpdir), mode="tape")
+    with pytest.raises(ValueError, match="read_mode argument must be either copy or mmap"):
+        Disk(str(tmpdir), read_mode="stream")
+    with pytest.raises(ValueError, match="layout argument must be either flat or hashed"):
+        Disk(str(tmpdir), layout="nested")
+    with pytest.raises(ValueError, match="fanout_levels argument must be an integer between 1 and 16"):
+        Disk(str(tmpdir), fanout_levels=0)
+    with pytest.raises(ValueError, match="fsync argument must be one of always, batch or never"):
+        Disk(str(tmpdir), fsync="sometimes")
+
+@pytest.mark.parametrize("mode,layout", [(Disk.FILES, Disk.FLAT), (Disk.FILES, Disk.HASHED),
+                                         (Disk.SEGMENTS, Disk.FLAT)])
+@pytest.mark.parametrize("read_mode", [Disk.COPY, Disk.MMAP])
+def test_disk_stores_and_deletes_blocks(tmpdir, mode, layout, read_mode):
+    disk = Disk(str(tmpdir), mode=mode, read_mode=read_mode, layout=layout)
+    disk.put("hello", "/folder/hello-00")
+    disk.put_many({"folder/hello-01": "world", "other-00": "!"})
+    assert sorted(disk.list()) == ["folder/hello-00", "folder/hello-01", "other-00"]
+    assert str(disk.get("folder/hello-00")) == "hello"
+    assert [value if value is None else str(value)
+            for value in disk.get_many(["folder/hello-01", "missing", "/other-00"])] == ["world", None, "!"]
+    assert disk.delete("folder/hello-00")
+    assert not disk.delete("folder/hello-00")
+    assert disk.get("folder/hello-00") is None
+    assert disk.delete_many(["folder/hello-01", "missing"]) == 1
+    assert disk.ping()
+    assert disk.clear()
+    assert disk.get("other-00") is None
+
+def test_disk_mmap_reads_survive_overwrites(tmpdir):
+    disk = Disk(str(tmpdir), read_mode=Disk.MMAP)
+    disk.put("first version", "hello-00")
+    disk.put("", "empty-00")
+    data = disk.get("hello-00")
+    assert isinstance(data, buffer)
+    disk.put("second", "hello-00")
+    assert str(data) == "first version"
+    assert str(disk.get("hello-00")) == "second"
+    assert disk.get("empty-00") == ""
+
+@pytest.mark.parametrize("fsync", [Disk.FSYNC_ALWAYS, Disk.FSYNC_BATCH, Disk.FSYNC_NEVER])
+def test_disk_writes_blocks_through_temporary_files(tmpdir, fsync):
+    disk = Disk(str(tmpdir), layout=Disk.HASHED, fanout_levels=1, fsync=fsync)
+    disk.put_many({"folder/hello-00": "hello", "folder/hello-01": "world"})
+    disk.put("again", "folder/hello-00")
+    files = [path.split(os.sep) for path in list_files(str(tmpdir))]
+    assert sorted(parts[-1] for parts in files if len(parts) == 2) == ["folder%2Fhello-00", "folder%2Fhello-01"]
+    assert disk.get("folder/hello-00") == "again"
+
+def test_migrate_layout_moves_the_blocks_back_and_forth(tmpdir):
+    folder = str(tmpdir)
+    flat = Disk(folder)
+    flat.put_many({"folder/hello-00": "hello", "folder/hello-01": "world", "other-00": "!"})
+    tmpdir.join("other-00.1.2.tmp").write("torn")
+    assert migrate_layout(folder, Disk.FLAT, Disk.HASHED) == 3
+    hashed = Disk(folder, layout=Disk.HASHED)
+    assert sorted(hashed.list()) == ["folder/hello-00", "folder/hello-01", "other-00"]
+    assert hashed.get("folder/hello-01") == "world"
+    assert not tmpdir.join("folder").check()
+    assert migrate_layout(folder, Disk.FLAT, Disk.HASHED) == 0
+    assert migrate_layout(folder, Disk.HASHED, Disk.FLAT) == 3
+    assert list_files(folder) == ["folder/hello-00", "folder/hello-01", "other-00"]
+
+def test_disk_stores_the_blocks_with_long_keys_in_the_hashed_layout(tmpdir):
+    folder = str(tmpdir)
+    long_key = "/".join("level-{:02d}".format(level) for level in xrange(40)) + "/hello-00"
+    flat = Disk(folder)
+    flat.put_many({long_key: "hello", "other-00": "!"})
+    assert migrate_layout(folder, Disk.FLAT, Disk.HASHED) == 2
+    hashed = Disk(folder, layout=Disk.HASHED)
+    assert sorted(hashed.list()) == sorted([long_key, "other-00"])
+    assert hashed.get(long_key) == "hello"
+    assert all(len(os.path.basename(path)) <= Disk.MAXIMUM_NAME_LENGTH + len(Disk.KEY_SUFFIX)
+               for path in list_files(folder))
+    hashed.put("again", long_key)
+    assert hashed.get(long_key) == "again"
+    assert migrate_layout(folder, Disk.FLAT, Disk.HASHED) == 0
+    assert migrate_layout(folder, Disk.HASHED, Disk.FLAT) == 2
+    assert list_files(folder) == sorted([long_key, "other-00"])
+    # The key file is removed along with the block
+    hashed.put("world", long_key)
+    assert hashed.delete(long_key)
+    assert hashed.get(long_key) is None
+    assert list_files(folder) == sorted([long_key, "other-00"])
+
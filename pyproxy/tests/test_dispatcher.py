@@ -1,5 +1,7 @@
 import copy
+import hashlib
 import os
+import time
 
 import mock
 import pytest
@@ -7,6 +9,12 @@ import pytest
 import pyproxy.metadata as metadata
 import pyproxy.playcloud_pb2 as playcloud_pb2
 import pyproxy.pyproxy.providers.dispatcher as dsp
+from pyproxy.pyproxy.providers.block_cache import BlockCache, CachingProvider
+from pyproxy.pyproxy.providers.circuit_breaker import ProviderBreakers
+from pyproxy.pyproxy.providers.hedging import HedgingPolicy
+from pyproxy.pyproxy.providers.io_pool import AsyncProvider, IOPool
+from pyproxy.pyproxy.providers.replica_selection import ProviderScores
+from pyproxy.pyproxy.providers.verification import BlockVerifier, VerificationMode
 import pyproxy.pyproxy.providers.redis_provider as redis
 
 DEFAULT_PATH = "hello"
@@ -106,3 +114,371 @@ def test_place_raises():
     with pytest.raises(ValueError):
         dsp.place(2, ["a"], -1)
 
+def test_place_stores_the_replicas_of_an_element_on_different_providers():
+    providers = ["a", "b", "c", "d"]
+    for elements in [2, 4, 8]:
+        for replication_factor in [2, 3]:
+            placement = dsp.place(elements, providers, replication_factor)
+            for element in xrange(elements):
+                assert sum(element in placement[provider] for provider in placement) == replication_factor
+
+
+## fetch_blocks tests
+class InMemoryProvider(object):
+    def __init__(self, blocks, latency=0.0):
+        self.blocks = blocks
+        self.latency = latency
+
+    def get(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.blocks.get(key)
+
+    def put(self, data, key):
+        self.blocks[key] = data
+        return True
+
+def test_fetch_blocks():
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {"full": InMemoryProvider(blocks), "empty": InMemoryProvider({})}
+    metablocks = [metadata.MetaBlock(key, providers=["full", "empty"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    pool = IOPool(workers=4, provider_concurrency=2)
+    assert dsp.fetch_blocks(providers, metablocks, pool) == blocks
+    assert dsp.fetch_blocks(providers, metablocks[:1], pool) == {metablocks[0].key: blocks[metablocks[0].key]}
+
+def test_fetch_blocks_returns_NoReplicaException_if_block_cannot_be_fetched():
+    providers = {"empty": InMemoryProvider({})}
+    metablocks = [metadata.MetaBlock("hello-00", providers=["empty"]),
+                  metadata.MetaBlock("hello-01", providers=["empty"])]
+    pool = IOPool(workers=4)
+    for fetched in [dsp.fetch_blocks(providers, metablocks, pool), dsp.fetch_blocks(providers, metablocks[:1], pool)]:
+        assert all(isinstance(block, dsp.NoReplicaException) for block in fetched.values())
+
+def test_fetch_blocks_only_caches_the_replicas_matching_their_checksum():
+    cache = BlockCache(memory_size=1024)
+    wrapped = InMemoryProvider({"hello-00": BLOCKS[1]})
+    providers = {"cached": CachingProvider("cached", wrapped, cache)}
+    metablocks = [metadata.MetaBlock("hello-00", providers=["cached"], checksum=hashlib.sha256(BLOCKS[0]).digest())]
+    pool = IOPool(workers=4)
+    assert isinstance(dsp.fetch_blocks(providers, metablocks, pool)["hello-00"], dsp.NoReplicaException)
+    assert not cache.contains("cached", "hello-00")
+    wrapped.blocks["hello-00"] = BLOCKS[0]
+    assert dsp.fetch_blocks(providers, metablocks, pool) == {"hello-00": BLOCKS[0]}
+    assert cache.contains("cached", "hello-00")
+
+def test_fetch_blocks_with_hedging_reads_from_the_next_replica_if_the_first_is_slow(monkeypatch):
+    monkeypatch.setattr(dsp.random, "shuffle", lambda replicas: None)
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {"slow": InMemoryProvider(blocks, latency=1.0), "fast": InMemoryProvider(blocks)}
+    metablocks = [metadata.MetaBlock(key, providers=["slow", "fast"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    hedging = HedgingPolicy(delay=0.01)
+    start = time.time()
+    assert dsp.fetch_blocks(providers, metablocks, IOPool(workers=32), hedging=hedging) == blocks
+    assert time.time() - start < 0.5
+    statistics = hedging.statistics()
+    assert statistics["reads"] == len(blocks)
+    assert statistics["hedges"] == len(blocks)
+    assert statistics["hedges_won"] == len(blocks)
+
+def test_fetch_blocks_with_hedging_does_not_count_a_failover_as_a_hedge(monkeypatch):
+    monkeypatch.setattr(dsp.random, "shuffle", lambda replicas: None)
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {"empty": InMemoryProvider({}), "full": InMemoryProvider(blocks)}
+    metablocks = [metadata.MetaBlock(key, providers=["empty", "full"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    hedging = HedgingPolicy(delay=10)
+    assert dsp.fetch_blocks(providers, metablocks, IOPool(workers=4), hedging=hedging) == blocks
+    assert hedging.statistics()["hedges"] == 0
+    missing = [metadata.MetaBlock("hello-00", providers=["empty"])]
+    fetched = dsp.fetch_blocks(providers, missing, IOPool(workers=4), hedging=hedging)
+    assert isinstance(fetched["hello-00"], dsp.NoReplicaException)
+
+def test_get_block_tries_the_replica_with_the_lowest_expected_latency_first():
+    blocks = {"hello-00": BLOCKS[0]}
+    providers = {"slow": InMemoryProvider(blocks, latency=0.05), "fast": InMemoryProvider(blocks)}
+    metablock = metadata.MetaBlock("hello-00", providers=["slow", "fast"], checksum=hashlib.sha256(BLOCKS[0]).digest())
+    scores = ProviderScores(exploration=0)
+    scores.record("slow", 0.05)
+    scores.record("fast", 0.001)
+    for _ in xrange(5):
+        queue = {}
+        dsp.get_block(providers, metablock, queue, scores=scores)
+        assert queue == blocks
+    statistics = scores.statistics()
+    assert statistics["fast"]["reads"] == 6
+    assert statistics["slow"]["reads"] == 1
+
+def test_fetch_blocks_records_failed_reads_in_the_scores():
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {"full": InMemoryProvider(blocks), "empty": InMemoryProvider({})}
+    metablocks = [metadata.MetaBlock(key, providers=["empty", "full"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    scores = ProviderScores(exploration=0)
+    scores.record("empty", 0.001, failed=True)
+    scores.record("full", 0.001)
+    for hedging in [None, HedgingPolicy()]:
+        assert dsp.fetch_blocks(providers, metablocks, IOPool(workers=4), hedging=hedging, scores=scores) == blocks
+    statistics = scores.statistics()
+    assert statistics["full"]["reads"] == 2 * len(blocks) + 1
+    assert statistics["empty"]["reads"] == 1
+
+def get_me_a_dispatcher_with_in_memory_providers(names, write_quorum=3, providers=None):
+    conf = copy.deepcopy(VALID_DISPATCHER_CONF)
+    del conf["providers"]["redis"]
+    conf["write_quorum"] = write_quorum
+    conf["io"] = {"write_retries": 1}
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        dispatcher = dsp.Dispatcher(conf)
+    dispatcher.providers = providers or {name: InMemoryProvider({}) for name in names}
+    dispatcher.async_providers = {name: AsyncProvider(name, provider, dispatcher.pool)
+                                  for name, provider in dispatcher.providers.items()}
+    return dispatcher
+
+def test_Dispatcher_put_async_and_get_async(monkeypatch):
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(["a", "b", "c"])
+    encoded_file = playcloud_pb2.File()
+    encoded_file.original_size = LENGTH
+    for block in BLOCKS:
+        strip = encoded_file.strips.add()
+        strip.data = block
+        strip.checksum = hashlib.sha256(block).digest()
+        strip.type = playcloud_pb2.Strip.DATA
+    future = dispatcher.put_async(DEFAULT_PATH, encoded_file)
+    document = future.result(timeout=5)
+    assert len(document.blocks) == len(BLOCKS)
+    for metablock in document.blocks:
+        assert len(metablock.providers) == dispatcher.replication_factor
+        for provider in metablock.providers:
+            assert metablock.key in dispatcher.providers[provider].blocks
+    document.blocks.sort(key=lambda metablock: metablock.key)
+    monkeypatch.setattr(dispatcher.files, "get", lambda path: document)
+    assert dispatcher.get_async(DEFAULT_PATH).result(timeout=5) == BLOCKS
+    assert dispatcher.get(DEFAULT_PATH) == BLOCKS
+    assert dispatcher.get_block_async(DEFAULT_PATH, 2).result(timeout=5) == BLOCKS[2]
+
+def test_Dispatcher_get_block_async_reconstructs_missing_blocks(monkeypatch):
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(["a"])
+    document = metadata.MetaDocument(DEFAULT_PATH)
+    document.blocks = [metadata.MetaBlock("hello-00", providers=["a"])]
+    monkeypatch.setattr(dispatcher.files, "get", lambda path: document)
+    reconstructed = playcloud_pb2.Strip()
+    reconstructed.data = BLOCKS[0]
+    coder_client = mock.MagicMock()
+    coder_client.reconstruct.return_value = {0: reconstructed}
+    monkeypatch.setattr(dsp.pyproxy.coder_client, "CoderClient", lambda: coder_client, raising=False)
+    assert dispatcher.get_block_async(DEFAULT_PATH, 0).result(timeout=5) == BLOCKS[0]
+    coder_client.reconstruct.assert_called_once_with(DEFAULT_PATH, [0])
+
+def test_Dispatcher_get_plans_the_compensating_blocks_with_a_single_coder_client(monkeypatch):
+    parity = os.urandom(STEP)
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS + [parity])}
+    providers = {"a": InMemoryProvider(blocks), "down": UnreachableProvider(blocks)}
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(None, providers=providers)
+    for _ in xrange(dispatcher.breakers.failure_threshold):
+        dispatcher.breakers.record_failure("down")
+    document = metadata.MetaDocument(DEFAULT_PATH)
+    for key in sorted(blocks):
+        document.blocks.append(metadata.MetaBlock(key, providers=["a"], checksum=hashlib.sha256(blocks[key]).digest()))
+    document.blocks[1].providers = ["down"]
+    document.blocks[-1].block_type = metadata.BlockType.PARITY
+    monkeypatch.setattr(dispatcher.files, "get", lambda path: document)
+    coder_client = mock.MagicMock()
+    coder_client.fragments_needed.return_value = [len(BLOCKS)]
+    coder_clients = []
+    def create_coder_client():
+        coder_clients.append(coder_client)
+        return coder_client
+    monkeypatch.setattr(dsp.pyproxy.coder_client, "CoderClient", create_coder_client, raising=False)
+    expected = BLOCKS[:1] + BLOCKS[2:] + [parity]
+    assert dispatcher.get(DEFAULT_PATH) == expected
+    assert dispatcher.get_async(DEFAULT_PATH).result(timeout=5) == expected
+    assert len(coder_clients) == 1
+    assert coder_client.fragments_needed.call_args_list == [mock.call([1]), mock.call([1])]
+    assert providers["down"].calls == 0
+
+def test_Dispatcher_get_raises_NoReplicaException_after_the_fallback_waves(monkeypatch):
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(None, providers={"a": InMemoryProvider(blocks)})
+    document = metadata.MetaDocument(DEFAULT_PATH)
+    document.blocks = [metadata.MetaBlock(key, providers=["a"], checksum=hashlib.sha256(blocks[key]).digest())
+                       for key in sorted(blocks)]
+    document.blocks.append(metadata.MetaBlock("hello-{:02d}".format(len(BLOCKS)), providers=["a"],
+                                              block_type=metadata.BlockType.PARITY))
+    del blocks["hello-00"]
+    monkeypatch.setattr(dispatcher.files, "get", lambda path: document)
+    coder_client = mock.MagicMock()
+    coder_client.fragments_needed.side_effect = lambda missing: [len(BLOCKS)]
+    monkeypatch.setattr(dsp.pyproxy.coder_client, "CoderClient", lambda: coder_client, raising=False)
+    with pytest.raises(dsp.NoReplicaException, match="Could not fetch enough blocks to decode hello"):
+        dispatcher.get(DEFAULT_PATH)
+    assert coder_client.fragments_needed.call_args_list == [mock.call([0]), mock.call([0, len(BLOCKS)])]
+
+def get_me_an_encoded_file():
+    encoded_file = playcloud_pb2.File()
+    encoded_file.original_size = LENGTH
+    for block in BLOCKS:
+        strip = encoded_file.strips.add()
+        strip.data = block
+        strip.checksum = hashlib.sha256(block).digest()
+        strip.type = playcloud_pb2.Strip.DATA
+    return encoded_file
+
+def test_Dispatcher_raises_ValueError_if_verification_mode_is_not_supported():
+    conf = copy.deepcopy(VALID_DISPATCHER_CONF)
+    conf["io"] = {"verification": {"mode": "never"}}
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        with pytest.raises(ValueError, match="verification mode must be one of always, sampled or fast"):
+            dsp.Dispatcher(conf)
+
+def test_Dispatcher_get_checks_the_fast_checksums_in_fast_verification_mode(monkeypatch):
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(["a", "b", "c"])
+    dispatcher.verifier = BlockVerifier(mode=VerificationMode.FAST)
+    document = dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+    document.blocks.sort(key=lambda metablock: metablock.key)
+    assert all(metablock.fast_checksum is not None for metablock in document.blocks)
+    # The replicas are read in a fixed order so that the corrupted ones are read first
+    monkeypatch.setattr(dispatcher.scores, "order", lambda providers: sorted(providers))
+    corrupted = document.blocks[0]
+    for provider in sorted(corrupted.providers)[:-1]:
+        dispatcher.providers[provider].blocks[corrupted.key] = "\x00" * corrupted.size
+    monkeypatch.setattr(dispatcher.files, "get", lambda path: document)
+    assert dispatcher.get(DEFAULT_PATH) == BLOCKS
+    statistics = dispatcher.verifier.statistics()
+    assert statistics["checksums"] == 0
+    assert statistics["fast_checksums"] >= len(BLOCKS)
+    assert statistics["mismatches"] >= 1
+
+class FailingProvider(InMemoryProvider):
+    def put(self, data, key):
+        raise IOError("provider is down")
+
+def test_Dispatcher_raises_ValueError_if_write_quorum_is_greater_than_the_replication_factor():
+    with pytest.raises(ValueError, match="write_quorum argument must be an integer between 1 and the replication factor"):
+        get_me_a_dispatcher_with_in_memory_providers(["a"], write_quorum=4)
+
+def test_Dispatcher_put_returns_once_the_write_quorum_is_reached(monkeypatch):
+    providers = {"a": InMemoryProvider({}), "b": InMemoryProvider({}), "slow": InMemoryProvider({})}
+    slow_put = providers["slow"].put
+    def put_slowly(data, key):
+        time.sleep(0.3)
+        return slow_put(data, key)
+    providers["slow"].put = put_slowly
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(None, write_quorum=2, providers=providers)
+    updates = []
+    monkeypatch.setattr(dispatcher.files, "add_block_providers", lambda key, names: updates.append((key, names)))
+    start = time.time()
+    document = dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+    assert time.time() - start < 0.3
+    assert all(sorted(block.providers) == ["a", "b"] for block in document.blocks)
+    dispatcher.pool.executor.shutdown(wait=True)
+    assert sorted(key for key, _ in updates) == sorted(block.key for block in document.blocks)
+    assert all(names == ["slow"] for _, names in updates)
+    assert all(sorted(block.providers) == ["a", "b"] for block in document.blocks)
+    assert dispatcher.write_statistics.statistics()["background_replicas"] == len(BLOCKS)
+
+def test_Dispatcher_put_retries_and_fails_if_the_write_quorum_cannot_be_reached():
+    providers = {"a": InMemoryProvider({}), "b": InMemoryProvider({}), "down": FailingProvider({})}
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(None, write_quorum=2, providers=providers)
+    document = dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+    assert all(sorted(block.providers) == ["a", "b"] for block in document.blocks)
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(None, write_quorum=3, providers=providers)
+    with pytest.raises(RuntimeError, match="Could not store block"):
+        dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+    statistics = dispatcher.write_statistics.statistics()
+    assert statistics["retries"] >= 1
+    assert statistics["failed_writes"] == 1
+
+class UnreachableProvider(InMemoryProvider):
+    def __init__(self, blocks):
+        super(UnreachableProvider, self).__init__(blocks)
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        raise dsp.redis.ConnectionError("provider is down")
+
+def test_fetch_blocks_skips_the_providers_whose_circuit_is_open(monkeypatch):
+    monkeypatch.setattr(dsp.random, "shuffle", lambda replicas: None)
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {"down": UnreachableProvider(blocks), "full": InMemoryProvider(blocks)}
+    metablocks = [metadata.MetaBlock(key, providers=["down", "full"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    breakers = ProviderBreakers(lambda name: False, failure_threshold=2, reset_timeout=60)
+    for metablock in metablocks:
+        queue = {}
+        dsp.get_block(providers, metablock, queue, breakers=breakers)
+        assert queue == {metablock.key: blocks[metablock.key]}
+    assert providers["down"].calls == 2
+    assert breakers.is_open("down")
+    for hedging in [None, HedgingPolicy()]:
+        assert dsp.fetch_blocks(providers, metablocks, IOPool(workers=4), hedging=hedging, breakers=breakers) == blocks
+    assert providers["down"].calls == 2
+
+class BatchingProvider(InMemoryProvider):
+    def __init__(self, blocks):
+        super(BatchingProvider, self).__init__(blocks)
+        self.gets = []
+        self.puts = []
+
+    def get(self, key):
+        raise AssertionError("blocks should be fetched in batches")
+
+    def get_many(self, keys):
+        self.gets.append(keys)
+        return [self.blocks.get(key) for key in keys]
+
+    def put(self, data, key):
+        raise AssertionError("blocks should be stored in batches")
+
+    def put_many(self, blocks):
+        self.puts.append(sorted(blocks))
+        self.blocks.update(blocks)
+        return True
+
+def test_fetch_blocks_async_sends_a_single_batch_per_provider():
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {name: BatchingProvider(blocks) for name in ["a", "b", "c"]}
+    metablocks = [metadata.MetaBlock(key, providers=["a", "b", "c"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    assert dsp.fetch_blocks_async(providers, metablocks, IOPool(workers=4)).result(timeout=5) == blocks
+    batches = [keys for provider in providers.values() for keys in provider.gets]
+    assert len(batches) == len(set(frozenset(keys) for keys in batches)) <= len(providers)
+    assert sorted(key for keys in batches for key in keys) == sorted(blocks)
+
+def test_fetch_blocks_async_reads_the_blocks_missing_from_a_batch_from_the_other_replicas(monkeypatch):
+    monkeypatch.setattr(dsp.random, "shuffle", lambda replicas: None)
+    blocks = {"hello-{:02d}".format(index): block for index, block in enumerate(BLOCKS)}
+    providers = {"partial": BatchingProvider({"hello-00": blocks["hello-00"]}), "full": InMemoryProvider(blocks)}
+    metablocks = [metadata.MetaBlock(key, providers=["partial", "full"], checksum=hashlib.sha256(data).digest())
+                  for key, data in blocks.items()]
+    assert dsp.fetch_blocks_async(providers, metablocks, IOPool(workers=4)).result(timeout=5) == blocks
+    assert providers["partial"].gets == [[metablock.key for metablock in metablocks]]
+
+def test_Dispatcher_put_sends_a_single_batch_per_provider():
+    providers = {name: BatchingProvider({}) for name in ["a", "b", "c"]}
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(None, providers=providers)
+    document = dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+    for name, provider in providers.items():
+        assert provider.puts == [sorted(block.key for block in document.blocks if name in block.providers)]
+
+def test_Dispatcher_put_fails_if_fewer_providers_than_the_write_quorum_are_healthy():
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(["a", "down", "unreachable"], write_quorum=2)
+    for name in ["down", "unreachable"]:
+        for _ in xrange(dispatcher.breakers.failure_threshold):
+            dispatcher.breakers.record_failure(name)
+    with pytest.raises(RuntimeError, match="only 1 healthy providers for a write quorum of 2"):
+        dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+    assert not dispatcher.providers["a"].blocks
+    assert dispatcher.write_statistics.statistics()["failed_writes"] == 1
+
+def test_Dispatcher_put_avoids_the_providers_whose_circuit_is_open():
+    dispatcher = get_me_a_dispatcher_with_in_memory_providers(["a", "b", "c", "down"], write_quorum=2)
+    dispatcher.replication_factor = 2
+    for _ in xrange(dispatcher.breakers.failure_threshold):
+        dispatcher.breakers.record_failure("down")
+    for _ in xrange(5):
+        document = dispatcher.put(DEFAULT_PATH, get_me_an_encoded_file())
+        assert all("down" not in block.providers for block in document.blocks)
+    assert not dispatcher.providers["down"].blocks
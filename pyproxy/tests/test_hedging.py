@@ -0,0 +1,42 @@
+"""
+Unit tests for the hedging module
+"""
+import pytest
+
+from pyproxy.providers.hedging import HedgingPolicy
+
+def test_hedging_policy_raises_ValueError_if_percentile_is_out_of_range():
+    with pytest.raises(ValueError, match="percentile argument must be an integer between 1 and 100"):
+        HedgingPolicy(percentile=0)
+    with pytest.raises(ValueError, match="percentile argument must be an integer between 1 and 100"):
+        HedgingPolicy(percentile=101)
+
+def test_hedging_policy_raises_ValueError_if_window_is_lower_than_1():
+    with pytest.raises(ValueError, match="window argument must be an integer greater than 0"):
+        HedgingPolicy(window=0)
+
+def test_hedging_policy_raises_ValueError_if_delay_is_negative():
+    with pytest.raises(ValueError, match="delay argument must be a number greater or equal to 0"):
+        HedgingPolicy(delay=-1)
+
+def test_hedging_policy_uses_the_default_delay_until_enough_latencies_are_recorded():
+    policy = HedgingPolicy(delay=0.5)
+    for _ in xrange(HedgingPolicy.MINIMUM_SAMPLES - 1):
+        policy.record(0.01)
+    assert policy.get_delay() == 0.5
+
+def test_hedging_policy_returns_the_percentile_of_the_recent_latencies():
+    policy = HedgingPolicy(percentile=90, window=100)
+    for latency in xrange(200):
+        policy.record(latency / 1000.0)
+    assert policy.get_delay() == 0.190
+
+def test_hedging_policy_statistics():
+    policy = HedgingPolicy()
+    policy.count_read(0, False)
+    policy.count_read(2, True)
+    statistics = policy.statistics()
+    assert statistics["reads"] == 2
+    assert statistics["hedges"] == 2
+    assert statistics["hedges_won"] == 1
+    assert statistics["delay"] == HedgingPolicy.DELAY
@@ -0,0 +1,152 @@
+"""
+Unit tests for the io_pool module
+"""
+import threading
+import time
+
+import concurrent.futures
+import pytest
+
+from pyproxy.providers.io_pool import AsyncProvider, gather, IOPool, resolved, then
+
+def test_io_pool_raises_ValueError_if_workers_is_lower_than_1():
+    with pytest.raises(ValueError, match="workers argument must be an integer greater than 0"):
+        IOPool(workers=0)
+
+def test_io_pool_raises_ValueError_if_provider_concurrency_is_negative():
+    with pytest.raises(ValueError, match="provider_concurrency argument must be an integer greater or equal to 0"):
+        IOPool(provider_concurrency=-1)
+
+def test_io_pool_map_keeps_the_order_of_the_elements():
+    pool = IOPool(workers=4)
+    assert pool.map(lambda element: element * 2, xrange(20)) == [element * 2 for element in xrange(20)]
+    assert pool.map(lambda element: element * 2, [3]) == [6]
+    assert pool.map(lambda element: element * 2, []) == []
+    assert pool.statistics()["completed"] == 20
+
+def test_io_pool_map_runs_a_single_element_in_the_calling_thread():
+    pool = IOPool(workers=4)
+    assert pool.map(lambda _: threading.current_thread(), [0]) == [threading.current_thread()]
+
+def test_io_pool_map_raises_the_exceptions_of_the_function():
+    pool = IOPool(workers=4)
+    def fail(element):
+        raise RuntimeError("failed on {:d}".format(element))
+    with pytest.raises(RuntimeError, match="failed on 0"):
+        pool.map(fail, xrange(3))
+
+def test_io_pool_limits_the_concurrency_on_a_provider():
+    pool = IOPool(workers=8, provider_concurrency=2)
+    lock = threading.Lock()
+    in_flight = {"provider": 0, "max": 0}
+    def operation(_):
+        with pool.provider_slot("provider"):
+            with lock:
+                in_flight["provider"] += 1
+                in_flight["max"] = max(in_flight["max"], in_flight["provider"])
+            time.sleep(0.01)
+            with lock:
+                in_flight["provider"] -= 1
+    pool.map(operation, xrange(16))
+    assert in_flight["max"] == 2
+    statistics = pool.statistics()
+    assert statistics["providers"] == {"provider": {"waiting": 0, "in_flight": 0}}
+    assert statistics["queued"] == 0
+    assert statistics["running"] == 0
+    assert statistics["max_queued"] >= 8
+
+def test_then_chains_functions_and_futures_without_waiting():
+    pool = IOPool(workers=2)
+    event = threading.Event()
+    first = pool.submit(event.wait)
+    chained = then(first, lambda done: pool.submit(lambda: done.result() and "chained"))
+    assert not chained.done()
+    event.set()
+    assert chained.result(timeout=1) == "chained"
+
+def test_then_holds_the_exception_raised_by_the_function():
+    def fail(done):
+        raise RuntimeError("failed on {:d}".format(done.result()))
+    with pytest.raises(RuntimeError, match="failed on 1"):
+        then(resolved(1), fail).result(timeout=1)
+
+def test_gather_combines_futures_in_order():
+    pool = IOPool(workers=4)
+    def sleep_and_return(index):
+        time.sleep(0.01 * (5 - index))
+        return index
+    futures = [pool.submit(sleep_and_return, index) for index in xrange(5)]
+    assert gather(futures).result(timeout=1) == range(5)
+    assert gather([]).result(timeout=1) == []
+    failed = concurrent.futures.Future()
+    failed.set_exception(RuntimeError("failed"))
+    with pytest.raises(RuntimeError, match="failed"):
+        gather([resolved(0), failed]).result(timeout=1)
+
+def test_async_provider_runs_the_operations_on_the_pool():
+    class DictionaryProvider(object):
+        def __init__(self):
+            self.blocks = {}
+        def get(self, key):
+            return self.blocks.get(key)
+        def put(self, data, key):
+            self.blocks[key] = data
+            return True
+        def delete(self, key):
+            return self.blocks.pop(key, None) is not None
+    pool = IOPool(workers=4, provider_concurrency=1)
+    provider = AsyncProvider("provider", DictionaryProvider(), pool)
+    assert gather([provider.put_async(str(index), "key-{:d}".format(index)) for index in xrange(10)]).result(timeout=1) == [True] * 10
+    assert provider.get_async("key-3").result(timeout=1) == "3"
+    assert provider.delete_async("key-3").result(timeout=1)
+    assert provider.get_async("key-3").result(timeout=1) is None
+    assert pool.statistics()["providers"] == {"provider": {"waiting": 0, "in_flight": 0}}
+
+def test_async_provider_batches_the_operations_if_the_provider_supports_it():
+    class DictionaryProvider(object):
+        def __init__(self):
+            self.blocks = {}
+        def get(self, key):
+            return self.blocks.get(key)
+        def put(self, data, key):
+            self.blocks[key] = data
+            return True
+        def delete(self, key):
+            return self.blocks.pop(key, None) is not None
+    class BatchingProvider(DictionaryProvider):
+        def __init__(self):
+            super(BatchingProvider, self).__init__()
+            self.batches = 0
+        def get_many(self, keys):
+            self.batches += 1
+            return [self.blocks.get(key) for key in keys]
+        def put_many(self, blocks):
+            self.batches += 1
+            self.blocks.update(blocks)
+            return True
+        def delete_many(self, keys):
+            self.batches += 1
+            return sum(1 for key in keys if self.blocks.pop(key, None) is not None)
+    pool = IOPool(workers=4)
+    for wrapped in [DictionaryProvider(), BatchingProvider()]:
+        provider = AsyncProvider("provider", wrapped, pool)
+        blocks = {"key-{:d}".format(index): str(index) for index in xrange(10)}
+        assert provider.put_many_async(blocks).result(timeout=1)
+        assert provider.get_many_async(["key-3", "missing", "key-1"]).result(timeout=1) == ["3", None, "1"]
+        assert provider.delete_many_async(["key-3", "missing", "key-1"]).result(timeout=1) == 2
+        assert sorted(wrapped.blocks) == sorted(key for key in blocks if key not in ["key-1", "key-3"])
+    assert wrapped.batches == 3
+
+def test_async_provider_reads_ranges_from_the_whole_block_if_the_provider_cannot():
+    class DictionaryProvider(object):
+        def __init__(self):
+            self.blocks = {"key-0": "header" + chr(29) + "data"}
+        def get(self, key):
+            return self.blocks.get(key)
+    class RangeProvider(DictionaryProvider):
+        def get_range(self, key, offset, length):
+            return "ranged"
+    pool = IOPool(workers=2)
+    assert AsyncProvider("provider", DictionaryProvider(), pool).get_range_async("key-0", 0, 6).result(timeout=1) == "header"
+    assert AsyncProvider("provider", DictionaryProvider(), pool).get_range_async("missing", 0, 6).result(timeout=1) is None
+    assert AsyncProvider("provider", RangeProvider(), pool).get_range_async("key-0", 0, 6).result(timeout=1) == "ranged"
@@ -1,28 +1,43 @@
 """
 Unit tests for the files module
 """
+import json
+
 import mock
 import pytest
 
-from pyproxy.metadata import BlockType, Files, MetaBlock, MetaDocument
+import pyproxy.metadata
+from pyproxy.metadata import BlockTable, BlockType, Files, MetaBlock, MetaDocument, \
+    extract_document_size, extract_entanglement_data, find_header_delimiter, format_cursor, \
+    parse_cursor
+from pyproxy.metadata_cache import LRUCache
 
 
 ################################################################################
 # Testing helper classes and functions
 class FakeRedisPipeline(object):
     def __init__(self):
-        self.counter = 0
+        self.replies = []
 
     def exists(self, path):
-        self.counter += 1
+        self.replies.append(False)
 
     def hgetall(self, path):
-        self.counter += 1
+        self.replies.append({})
+
+    def hmget(self, path, *fields):
+        self.replies.append([None for _ in fields])
+
+    def smembers(self, path):
+        self.replies.append(set())
+
+    def scard(self, path):
+        self.replies.append(0)
 
     def execute(self):
-        data = [False for _ in xrange(self.counter)]
-        self.counter = 0
-        return data
+        replies = self.replies
+        self.replies = []
+        return replies
 
 def get_me_a_fake_redis_pipeline():
     return FakeRedisPipeline()
@@ -37,7 +52,15 @@ BLOCK_HASH = {
 }
 
 def mock_pipeline_get_block(path):
-    return [BLOCK_HASH]
+    return [BLOCK_HASH, set()]
+
+def flatten_hash(hsh):
+    return [item for pair in hsh.items() for item in pair]
+
+def get_me_a_fake_evalsha(documents):
+    def fake_evalsha(sha, numkeys, *args):
+        return documents
+    return fake_evalsha
 ################################################################################
 
 def test_files_get_raises_valueerror_when_path_is_None():
@@ -55,27 +78,43 @@ def test_files_get_raises_valueerror_when_path_is_empty():
 def test_files_get_raises_keyerror_when_path_not_in_files(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
-    monkeypatch.setattr(files.redis, "pipeline", get_me_a_fake_redis_pipeline)
+    monkeypatch.setattr(files.redis, "evalsha", get_me_a_fake_evalsha([[]]))
     with pytest.raises(KeyError, match="path NonExistingKey not found"):
         files.get("NonExistingKey")
 
+def test_files_get_raises_keyerror_when_block_not_in_files(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    document = {
+        "path": "path",
+        "original_size": "0",
+        "creation_date": "2017-01-01 00:00:00.42",
+        "blocks": "path-00,path-01",
+        "entangling_blocks": "[]"
+    }
+    block = dict(BLOCK_HASH, key="path-00")
+    documents = [[flatten_hash(document), flatten_hash(block), []]]
+    monkeypatch.setattr(files.redis, "evalsha", get_me_a_fake_evalsha(documents))
+    with pytest.raises(KeyError, match="key path-01 not found"):
+        files.get("path")
+
 def test_files_get(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
-    def mock_pipeline_get(path):
-        return [{
-            "path": "path",
-            "original_size": "0",
-            "creation_date": "2017-01-01 00:00:00.42",
-            "blocks": "",
-            "providers": "",
-            "block_type": BlockType.DATA.name,
-            "entangling_blocks": "[]"
-        }]
-    monkeypatch.setattr(FakeRedisPipeline, "execute", mock_pipeline_get)
-    monkeypatch.setattr(files.redis, "pipeline", get_me_a_fake_redis_pipeline)
+    document = {
+        "path": "path",
+        "original_size": "0",
+        "creation_date": "2017-01-01 00:00:00.42",
+        "blocks": "path-00",
+        "entangling_blocks": "[]"
+    }
+    block = dict(BLOCK_HASH, key="path-00")
+    documents = [[flatten_hash(document), flatten_hash(block)]]
+    monkeypatch.setattr(files.redis, "evalsha", get_me_a_fake_evalsha(documents))
     metadata = files.get("path")
     assert metadata.path == "path"
+    assert len(metadata.blocks) == 1
+    assert metadata.blocks[0].key == "path-00"
 
 def test_files_put_raises_ValueError_if_metadata_is_None():
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
@@ -123,12 +162,80 @@ def test_files_has_been_entangled_enough_raises_KeyError_if_block_key_does_not_m
 def test_files_has_been_entangled_enough(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
-    monkeypatch.setattr(FakeRedisPipeline, "execute", mock_pipeline_get_block)
+    monkeypatch.setattr(FakeRedisPipeline, "execute",
+                        lambda pipeline: [[BLOCK_HASH["key"], BLOCK_HASH["entangled_with"]], set()])
     monkeypatch.setattr(files.redis, "pipeline", get_me_a_fake_redis_pipeline)
     assert files.has_been_entangled_enough("path", 0) is True
     assert files.has_been_entangled_enough("path", 1) is True
     assert files.has_been_entangled_enough("path", 2) is False
 
+def test_files_has_been_entangled_enough_counts_pointing_documents(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    monkeypatch.setattr(FakeRedisPipeline, "execute", lambda pipeline: [["key", None], set(["a", "b", "c"])])
+    monkeypatch.setattr(files.redis, "pipeline", get_me_a_fake_redis_pipeline)
+    assert files.has_been_entangled_enough("path", 3) is True
+    assert files.has_been_entangled_enough("path", 4) is False
+
+def test_files_has_been_entangled_enough_counts_the_legacy_and_new_pointers(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    monkeypatch.setattr(FakeRedisPipeline, "execute", lambda pipeline: [["key", "a,b"], set(["b", "c"])])
+    monkeypatch.setattr(files.redis, "pipeline", get_me_a_fake_redis_pipeline)
+    assert files.has_been_entangled_enough("path", 3) is True
+    assert files.has_been_entangled_enough("path", 4) is False
+
+def test_files_put_does_not_read_entangling_blocks(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.provider_ids = {"a": 1}
+    pipeline = mock.MagicMock()
+    monkeypatch.setattr(files.redis, "pipeline", lambda transaction=True: pipeline)
+    document = MetaDocument("doc")
+    document.entangling_blocks = [["other", 1], ["another", 2]]
+    document.blocks = [MetaBlock("doc-00", providers=["a"])]
+    assert files.put("doc", document) == "doc"
+    pipeline.hset.assert_called_once_with(Files.ENTANGLEMENT_GRAPH, "doc", mock.ANY)
+    pipeline.sadd.assert_any_call(Files.POINTED_BY_PREFIX + "other-01", "doc")
+    pipeline.sadd.assert_any_call(Files.POINTED_BY_PREFIX + "another-02", "doc")
+    pipeline.hgetall.assert_not_called()
+    pipeline.execute.assert_called_once_with()
+
+def test_files_put_adds_the_providers_pending_for_its_blocks(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.provider_ids = {"a": 1}
+    pipeline = mock.MagicMock()
+    pipeline.execute.return_value = [True] * 8 + [set(["c", "b"]), 1, set(), 0]
+    monkeypatch.setattr(files.redis, "pipeline", lambda transaction=True: pipeline)
+    added = []
+    monkeypatch.setattr(files, "add_block_providers", lambda key, providers: added.append((key, providers)))
+    document = MetaDocument("doc")
+    document.blocks = [MetaBlock("doc-00", providers=["a"]), MetaBlock("doc-01", providers=["a"])]
+    files.put("doc", document)
+    pipeline.smembers.assert_any_call(Files.PENDING_PROVIDERS_PREFIX + "doc-00")
+    pipeline.delete.assert_any_call(Files.PENDING_PROVIDERS_PREFIX + "doc-01")
+    assert added == [("doc-00", ["b", "c"])]
+    assert [block.providers for block in document.blocks] == [["a"], ["a"]]
+
+def test_files_add_block_providers(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.provider_ids = {"b": 2}
+    calls = []
+    replies = [0, 1, 2]
+    def fake_evalsha(sha, numkeys, *args):
+        calls.append(args)
+        return replies.pop(0)
+    refreshed = []
+    monkeypatch.setattr(files.redis, "evalsha", fake_evalsha)
+    monkeypatch.setattr(files, "refresh_graph_entry", refreshed.append)
+    for _ in xrange(3):
+        files.add_block_providers("doc-00", ["b"])
+    assert calls[0] == (Files.BLOCK_PREFIX + "doc-00", Files.PENDING_PROVIDERS_PREFIX + "doc-00",
+                        Files.PROVIDER_PREFIX, "doc-00", Files.PENDING_PROVIDERS_TTL, "\x00\x02", "b")
+    assert refreshed == ["doc"]
+
 def test_files_list_blocks(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
@@ -155,22 +262,9 @@ def test_files_get_provider_with_empty_string_as_provider():
 def test_files_get_provider_returns_empty_list_if_no_blocks(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
-    def return_empty_list():
-        return []
-    monkeypatch.setattr(files, "list_blocks", return_empty_list)
-    result = files.get_blocks_from_provider("NonExistingProvider")
-    assert isinstance(result, list)
-    assert not result
-
-def test_files_get_provider_returns_empty_list_if_no_match(monkeypatch):
-    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
-        files = Files()
-    def return_block_names():
-        return ["doc-00"]
-    monkeypatch.setattr(files, "list_blocks", return_block_names)
-    def return_fake_blocks(block_list):
-        return [MetaBlock(key, providers=["FakeProvider"]) for key in block_list]
-    monkeypatch.setattr(files, "get_blocks", return_fake_blocks)
+    def return_empty_set(name):
+        return set()
+    monkeypatch.setattr(files.redis, "smembers", return_empty_set)
     result = files.get_blocks_from_provider("NonExistingProvider")
     assert isinstance(result, list)
     assert not result
@@ -178,9 +272,10 @@ def test_files_get_provider_returns_empty_list_if_no_match(monkeypatch):
 def test_files_get_provider(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
-    def return_block_names():
-        return ["doc-00"]
-    monkeypatch.setattr(files, "list_blocks", return_block_names)
+    def return_block_names(name):
+        assert name == Files.PROVIDER_PREFIX + "FakeProvider"
+        return set(["doc-00"])
+    monkeypatch.setattr(files.redis, "smembers", return_block_names)
     def return_fake_blocks(block_list):
         return [MetaBlock(key, providers=["FakeProvider"]) for key in block_list]
     monkeypatch.setattr(files, "get_blocks", return_fake_blocks)
@@ -188,6 +283,14 @@ def test_files_get_provider(monkeypatch):
     assert isinstance(result, list)
     assert len(result) == 1
 
+def test_files_set_block_providers_raises_KeyError_if_block_does_not_exist(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.provider_ids["FakeProvider"] = 1
+    monkeypatch.setattr(files.redis, "evalsha", lambda sha, numkeys, *args: 0)
+    with pytest.raises(KeyError, match="key NonExistingKey not found"):
+        files.set_block_providers("NonExistingKey", ["FakeProvider"])
+
 def test_files_exists_bad_path(monkeypatch):
     with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
         files = Files()
@@ -213,3 +316,299 @@ def test_files_exists(monkeypatch):
     monkeypatch.delattr(files.redis, "exists")
     monkeypatch.setattr(files.redis, "exists", always_true)
     assert files.exists("path") == True
+
+def get_fake_zrangebyscore(entries):
+    """
+    Returns a fake zrangebyscore reading from a list of (member, score) entries
+    sorted by score then member
+    """
+    def fake_zrangebyscore(name, minimum, maximum, start=None, num=None, withscores=False):
+        assert name == "file_index" and withscores
+        def above(score):
+            if minimum == "-inf":
+                return True
+            if str(minimum).startswith("("):
+                return score > float(minimum[1:])
+            return score >= float(minimum)
+        def below(score):
+            return maximum == "+inf" or score <= float(maximum)
+        selected = [(member, score) for member, score in entries if above(score) and below(score)]
+        if start is not None:
+            selected = selected[start:start + num]
+        return selected
+    return fake_zrangebyscore
+
+def return_fake_files(paths, skip_missing=False):
+    return sorted([MetaDocument(path) for path in paths], key=lambda doc: doc.path)
+
+def test_parse_cursor():
+    assert parse_cursor(format_cursor(1500000000.123456, "path:with:colons")) == \
+           (1500000000.123456, "path:with:colons")
+
+@pytest.mark.parametrize("cursor", ["", "10", "abc:path", "1.5:"])
+def test_parse_cursor_raises_ValueError_if_cursor_is_invalid(cursor):
+    with pytest.raises(ValueError, match="cursor argument must be a cursor returned by a previous listing"):
+        parse_cursor(cursor)
+
+def test_files_iter_values_raises_ValueError_if_cursor_is_invalid():
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    with pytest.raises(ValueError, match="cursor argument must be a cursor returned by a previous listing"):
+        list(files.iter_values(cursor="10"))
+
+def test_files_iter_values_raises_ValueError_if_limit_is_negative():
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    with pytest.raises(ValueError, match="limit argument must be an integer greater or equal to 0"):
+        list(files.iter_values(limit=-1))
+
+def test_files_iter_values(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    filenames = ["doc-{:03d}".format(index) for index in xrange(250)]
+    # Scores are shared by several documents to check that ties are not lost between pages
+    entries = [(filename, float(index // 3)) for index, filename in enumerate(filenames)]
+    monkeypatch.setattr(files.redis, "zrangebyscore", get_fake_zrangebyscore(entries))
+    monkeypatch.setattr(files, "get_files", return_fake_files)
+    assert [doc.path for doc in files.iter_values()] == filenames
+    assert not list(files.iter_values(limit=0))
+    assert [doc.path for doc in files.values()] == filenames
+    listed = []
+    cursor = None
+    while True:
+        page = list(files.iter_listing(cursor=cursor, limit=37))
+        if not page:
+            break
+        listed += [doc.path for _, doc in page]
+        cursor = page[-1][0]
+    assert listed == filenames
+    assert [doc.path for doc in files.iter_values(cursor=format_cursor(3.0, "doc-010"), limit=5)] == \
+           filenames[11:16]
+
+def test_files_iter_values_skips_documents_deleted_during_the_listing(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    filenames = ["doc-{:d}".format(index) for index in xrange(10)]
+    deleted = {"doc-3", "doc-7"}
+    entries = [(filename, float(index)) for index, filename in enumerate(filenames)]
+    def return_remaining_files(paths, skip_missing=False):
+        assert skip_missing
+        return sorted([MetaDocument(path) for path in paths if path not in deleted],
+                      key=lambda doc: doc.path)
+    monkeypatch.setattr(files.redis, "zrangebyscore", get_fake_zrangebyscore(entries))
+    monkeypatch.setattr(files, "get_files", return_remaining_files)
+    assert [doc.path for doc in files.iter_values()] == \
+           [filename for filename in filenames if filename not in deleted]
+
+def test_files_select_random_blocks(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files(pointer_selector=lambda t, n: [2, 0])
+    calls = []
+    def fake_evalsha(sha, numkeys, *args):
+        calls.append(args)
+        return [[key, flatten_hash(dict(BLOCK_HASH, key=key))] for key in ["doc-02", "doc-00"]]
+    monkeypatch.setattr(files.redis, "zcard", lambda name: 5)
+    monkeypatch.setattr(files.redis, "evalsha", fake_evalsha)
+    blocks = files.select_random_blocks(2)
+    assert len(calls) == 1
+    assert calls[0] == ("block_index", Files.BLOCK_PREFIX, Files.POINTED_BY_PREFIX, 2, 0)
+    assert [block.key for block in blocks] == ["doc-00", "doc-02"]
+
+def test_files_get_entanglement_graph(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    entry = ["2017-01-01 00:00:00.42", "[]", "[['doc-00', 'FakeProvider']]"]
+    def fake_hgetall(name):
+        assert name == Files.ENTANGLEMENT_GRAPH
+        return {"doc": json.dumps(entry)}
+    monkeypatch.setattr(files.redis, "hgetall", fake_hgetall)
+    assert files.get_entanglement_graph() == {"doc": entry}
+
+def test_files_get_entanglement_graph_since(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    entry = ["2017-01-01 00:00:00.42", "[]", "[['doc-00', 'FakeProvider']]"]
+    def fake_evalsha(sha, numkeys, *args):
+        assert args == ("file_index", Files.ENTANGLEMENT_GRAPH, 1483228800.0)
+        return ["doc", json.dumps(entry)]
+    monkeypatch.setattr(files.redis, "evalsha", fake_evalsha)
+    assert files.get_entanglement_graph(since=1483228800.0) == {"doc": entry}
+
+def test_files_format_graph_entry():
+    document = MetaDocument("doc")
+    document.entangling_blocks = [["other", 1]]
+    document.blocks = [MetaBlock("doc-01", providers=["b", "a"]), MetaBlock("doc-00", providers=["c"])]
+    entry = Files.format_graph_entry(document)
+    assert entry[0] == str(document.creation_date)
+    assert entry[1] == '[["other", 1]]'
+    assert entry[2] == "[['doc-00', 'c'], ['doc-01', 'b']]"
+
+def test_files_set_block_providers_refreshes_the_graph_entry_of_the_document(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.provider_ids["FakeProvider"] = 1
+    refreshed = []
+    monkeypatch.setattr(files.redis, "evalsha", lambda sha, numkeys, *args: 1)
+    monkeypatch.setattr(files, "refresh_graph_entry", refreshed.append)
+    files.set_block_providers("path/with-dash-01", ["FakeProvider"])
+    assert refreshed == ["path/with-dash"]
+
+def test_files_refresh_graph_entry(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    document = {
+        "path": "path",
+        "original_size": "0",
+        "creation_date": "2017-01-01 00:00:00.42",
+        "blocks": "path-00,path-01",
+        "entangling_blocks": "[]"
+    }
+    blocks = [dict(BLOCK_HASH, key="path-00", providers="b,a"),
+              dict(BLOCK_HASH, key="path-01", providers="c")]
+    documents = [[flatten_hash(document)] + [flatten_hash(block) for block in blocks]]
+    monkeypatch.setattr(files.redis, "evalsha", get_me_a_fake_evalsha(documents))
+    pipeline = mock.MagicMock()
+    pipeline.hget.return_value = document["blocks"]
+    def fake_transaction(func, *watches):
+        assert watches == (Files.FILE_PREFIX + "path",)
+        func(pipeline)
+    monkeypatch.setattr(files.redis, "transaction", fake_transaction)
+    files.refresh_graph_entry("path")
+    pipeline.watch.assert_called_once_with(Files.BLOCK_PREFIX + "path-00", Files.BLOCK_PREFIX + "path-01")
+    pipeline.multi.assert_called_once_with()
+    name, path, entry = pipeline.hset.call_args[0]
+    assert (name, path) == (Files.ENTANGLEMENT_GRAPH, "path")
+    assert json.loads(entry)[2] == "[['path-00', 'b'], ['path-01', 'c']]"
+
+def test_files_get_blocks_from_cache(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.cache = LRUCache(10)
+    monkeypatch.setattr(FakeRedisPipeline, "execute", mock_pipeline_get_block)
+    monkeypatch.setattr(files.redis, "pipeline", get_me_a_fake_redis_pipeline)
+    assert files.get_block("key").key == "key"
+    def no_pipeline():
+        raise RuntimeError("metadata server should not be queried")
+    monkeypatch.setattr(files.redis, "pipeline", no_pipeline)
+    assert files.get_block("key").key == "key"
+    assert files.get_cache_statistics()["hits"] == 1
+    files.invalidate([Files.BLOCK_PREFIX + "key"])
+    with pytest.raises(RuntimeError, match="metadata server should not be queried"):
+        files.get_block("key")
+
+def test_files_serialize_and_parse_metablock():
+    block = MetaBlock("doc-00",
+                      providers=["a", "b"],
+                      block_type=BlockType.PARITY,
+                      checksum="\x00\xca\xfe",
+                      entangled_with=["other"],
+                      size=42)
+    record = Files.serialize_metablock(block, [2, 1])
+    assert "entangled_with" not in record
+    Files.merge_pointing_documents(record, set(["other"]))
+    parsed = Files.parse_metablock(record, {1: "b", 2: "a"})
+    assert parsed.key == block.key
+    assert parsed.providers == ["a", "b"]
+    assert parsed.creation_date == block.creation_date
+    assert parsed.block_type == BlockType.PARITY
+    assert parsed.checksum == block.checksum
+    assert parsed.entangled_with == ["other"]
+    assert parsed.size == 42
+
+def test_files_merge_pointing_documents_keeps_the_legacy_pointers():
+    record = {"key": "doc-00", "entangled_with": "legacy-a,legacy-b"}
+    Files.merge_pointing_documents(record, set(["new", "legacy-a"]))
+    assert record["entangled_with"] == "legacy-a,legacy-b,new"
+    record = {"key": "doc-00", "entangled_with": "legacy-a"}
+    Files.merge_pointing_documents(record, set())
+    assert record["entangled_with"] == "legacy-a"
+
+def test_files_serialize_and_parse_metablock_with_a_fast_checksum():
+    block = MetaBlock("doc-00", providers=["a"], checksum="\x00\xca\xfe", fast_checksum=0xcafebabe)
+    parsed = Files.parse_metablock(Files.serialize_metablock(block, [1]), {1: "a"})
+    assert parsed.checksum == block.checksum
+    assert parsed.fast_checksum == 0xcafebabe
+    block.fast_checksum = None
+    assert Files.parse_metablock(Files.serialize_metablock(block, [1]), {1: "a"}).fast_checksum is None
+
+def test_files_parse_metablock_raises_KeyError_if_provider_id_is_unknown():
+    record = Files.serialize_metablock(MetaBlock("doc-00", providers=["a"]), [1])
+    with pytest.raises(KeyError):
+        Files.parse_metablock(record, {})
+
+def test_files_serialize_and_parse_metadata():
+    document = MetaDocument("doc", original_size=1024)
+    document.entangling_blocks = [[u"other", 1], ["another", 300]]
+    document.blocks = [MetaBlock("doc-00")]
+    record = Files.serialize_metadata(document)
+    assert record["blocks"] == "doc-00"
+    parsed = Files.parse_metadata(record)
+    assert parsed.path == "doc"
+    assert parsed.original_size == 1024
+    assert parsed.creation_date == document.creation_date
+    assert parsed.entangling_blocks == [["other", 1], ["another", 300]]
+
+def test_block_table():
+    table = BlockTable()
+    table.append("doc-00", ["a", "b"], 42, BlockType.PARITY.value, "\x00\xca\xfe", "one,two", 1024)
+    table.append("doc-01", ["b"], 43, BlockType.DATA.value, None, "", 0)
+    assert len(table) == 2
+    assert table.get_key(1) == "doc-01"
+    assert table.get_providers(0) == ["a", "b"]
+    assert table.get_providers(1) == ["b"]
+    assert table.get_checksum(0) == "\x00\xca\xfe"
+    assert table.get_number_of_pointers(0) == 2
+    assert table.get_number_of_pointers(1) == 0
+    block = table[0]
+    assert block.key == "doc-00"
+    assert block.block_type == BlockType.PARITY
+    assert block.entangled_with == ["one", "two"]
+    assert block.size == 1024
+    assert table[-1].entangled_with == []
+    assert [block.key for block in table] == ["doc-00", "doc-01"]
+    with pytest.raises(IndexError):
+        table[2]
+
+def test_files_scan_blocks(monkeypatch):
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        files = Files()
+    files.provider_names = {1: "a"}
+    keys = ["doc-{:03d}".format(index) for index in xrange(250)]
+    records = {}
+    pointing_documents = {}
+    for index, key in enumerate(keys):
+        if index % 2:
+            records[Files.BLOCK_PREFIX + key] = dict(BLOCK_HASH, key=key, providers="a,b")
+        else:
+            block = MetaBlock(key, providers=["a"], checksum="\xca\xfe")
+            records[Files.BLOCK_PREFIX + key] = Files.serialize_metablock(block, [1])
+            pointing_documents[Files.POINTED_BY_PREFIX + key] = set(["one"])
+    def get_block_range(name, start, end):
+        return keys[start:end + 1]
+    def fake_pipeline(transaction=True):
+        pipeline = mock.MagicMock()
+        replies = []
+        pipeline.hgetall.side_effect = lambda name: replies.append(records[name])
+        pipeline.smembers.side_effect = lambda name: replies.append(pointing_documents.get(name, set()))
+        pipeline.execute.side_effect = lambda: replies
+        return pipeline
+    monkeypatch.setattr(files.redis, "zrange", get_block_range)
+    monkeypatch.setattr(files.redis, "pipeline", fake_pipeline)
+    table = files.scan_blocks()
+    assert len(table) == 250
+    assert [table.get_key(index) for index in xrange(len(table))] == keys
+    assert table.get_providers(0) == ["a"]
+    assert table.get_checksum(0) == "\xca\xfe"
+    assert table.get_number_of_pointers(0) == 1
+    assert table.get_providers(1) == ["a", "b"]
+    assert table[1].checksum == BLOCK_HASH["checksum"]
+
+def test_header_parsing_works_on_buffers(monkeypatch):
+    monkeypatch.setattr(pyproxy.metadata, "HEADER_SEARCH_SIZE", 4)
+    block = json.dumps([["path", 1]]) + chr(29) + "1024" + chr(29) + "data"
+    data = buffer(block)
+    assert find_header_delimiter(data) == block.find(chr(29))
+    assert find_header_delimiter(data, block.find(chr(29)) + 1) == block.rfind(chr(29))
+    assert find_header_delimiter(buffer("no delimiter")) == -1
+    assert extract_entanglement_data(data) == [["path", 1]]
+    assert extract_document_size(data) == 1024
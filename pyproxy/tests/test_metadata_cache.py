@@ -0,0 +1,115 @@
+"""
+Unit tests for the metadata_cache module
+"""
+import time
+
+import mock
+import pytest
+
+from pyproxy.metadata import MetaBlock, MetaDocument
+from pyproxy.metadata_cache import KeyspaceInvalidator, LRUCache
+
+def test_lrucache_raises_ValueError_if_capacity_is_not_greater_than_0():
+    with pytest.raises(ValueError, match="capacity argument must be an integer greater than 0"):
+        LRUCache(0)
+    with pytest.raises(ValueError, match="capacity argument must be an integer greater than 0"):
+        LRUCache(None)
+
+def test_lrucache_evicts_least_recently_used_entry():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.statistics() == {"capacity": 2, "size": 2, "hits": 3, "misses": 1}
+
+def test_lrucache_returns_the_cached_value():
+    cache = LRUCache(2)
+    frozen = MetaBlock("doc-00", providers=["FakeProvider"]).freeze()
+    cache.put("blocks:doc-00", frozen)
+    assert cache.get("blocks:doc-00") is frozen
+
+def test_metablock_thaw_returns_independent_blocks():
+    block = MetaBlock("doc-00", providers=["FakeProvider"], entangled_with=["doc"], size=42)
+    frozen = block.freeze()
+    block.providers.append("Mutated")
+    thawed = MetaBlock.thaw(frozen)
+    assert thawed.key == "doc-00"
+    assert thawed.providers == ["FakeProvider"]
+    assert thawed.entangled_with == ["doc"]
+    assert thawed.size == 42
+    thawed.providers.append("Mutated")
+    assert MetaBlock.thaw(frozen).providers == ["FakeProvider"]
+
+def test_metadocument_thaw_returns_independent_documents():
+    document = MetaDocument("doc", original_size=1024)
+    document.entangling_blocks = [["other", 1]]
+    document.blocks = [MetaBlock("doc-00")]
+    frozen = document.freeze()
+    thawed, block_keys = MetaDocument.thaw(frozen)
+    assert (thawed.path, thawed.original_size) == ("doc", 1024)
+    assert thawed.creation_date == document.creation_date
+    assert thawed.entangling_blocks == [["other", 1]]
+    assert thawed.blocks == []
+    assert block_keys == ("doc-00",)
+    thawed.entangling_blocks[0][1] = 2
+    assert MetaDocument.thaw(frozen)[0].entangling_blocks == [["other", 1]]
+
+def test_lrucache_invalidate():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+def test_lrucache_put_skips_values_fetched_before_an_invalidation():
+    cache = LRUCache(2)
+    version = cache.get_version()
+    cache.invalidate("a")
+    cache.put("a", 1, version)
+    assert cache.get("a") is None
+    cache.put("a", 1, cache.get_version())
+    assert cache.get("a") == 1
+
+def test_lrucache_put_ignores_invalidations_of_other_keys():
+    cache = LRUCache(2)
+    version = cache.get_version()
+    cache.invalidate("b")
+    cache.put("a", 1, version)
+    assert cache.get("a") == 1
+
+def test_lrucache_put_skips_values_fetched_before_a_clear():
+    cache = LRUCache(2)
+    version = cache.get_version()
+    cache.clear()
+    cache.put("a", 1, version)
+    assert cache.get("a") is None
+
+def test_lrucache_put_skips_values_older_than_forgotten_versions():
+    cache = LRUCache(2)
+    version = cache.get_version()
+    for key in ["b", "c", "d"]:
+        cache.invalidate(key)
+    assert len(cache.versions) <= cache.capacity
+    cache.put("a", 1, version)
+    assert cache.get("a") is None
+
+class StopListening(BaseException):
+    pass
+
+def test_keyspace_invalidator_clears_the_cache_and_resubscribes_on_any_error(monkeypatch):
+    cache = LRUCache(2)
+    cache.put("files:doc", 1)
+    client = mock.MagicMock()
+    client.config_get.return_value = {"notify-keyspace-events": "AKE"}
+    pubsub = client.pubsub.return_value
+    pubsub.listen.side_effect = [ValueError("unexpected message"), StopListening()]
+    monkeypatch.setattr(time, "sleep", lambda seconds: cache.put("files:doc", 1))
+    invalidator = KeyspaceInvalidator(client, cache, ["files:"])
+    with pytest.raises(StopListening):
+        invalidator.run()
+    assert pubsub.psubscribe.call_count == 2
+    assert pubsub.close.call_count == 2
+    assert cache.get("files:doc") is None
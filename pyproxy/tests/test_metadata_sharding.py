@@ -0,0 +1,125 @@
+"""
+Unit tests for the metadata_sharding module
+"""
+import mock
+import pytest
+
+from pyproxy.metadata import Files, MetaBlock, MetaDocument
+from pyproxy.metadata_sharding import create_files, extract_path_from_block_key, \
+                                      HashRing, parse_server, ShardedFiles
+
+SERVERS = ["metadata-0:6379", "metadata-1:6379", "metadata-2:6379"]
+
+def get_me_sharded_files():
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        return ShardedFiles(SERVERS)
+
+def test_parse_server():
+    assert parse_server("metadata:6380") == ("metadata", 6380)
+    assert parse_server("metadata") == ("metadata", 6379)
+
+def test_extract_path_from_block_key():
+    assert extract_path_from_block_key("path/with-dash-01") == "path/with-dash"
+
+def test_hash_ring_raises_ValueError_if_nodes_is_empty():
+    with pytest.raises(ValueError, match="nodes argument must be a non-empty list"):
+        HashRing([])
+
+def test_hash_ring_raises_ValueError_if_virtual_nodes_is_lower_than_1():
+    with pytest.raises(ValueError, match="virtual_nodes argument must be an integer greater than 0"):
+        HashRing(SERVERS, virtual_nodes=0)
+
+def test_hash_ring_spreads_keys():
+    ring = HashRing(SERVERS)
+    keys = ["document-{:d}".format(index) for index in xrange(3000)]
+    counts = {}
+    for key in keys:
+        node = ring.get_node(key)
+        counts[node] = counts.get(node, 0) + 1
+    assert sorted(counts) == sorted(SERVERS)
+    assert min(counts.values()) > 700
+
+def test_hash_ring_only_moves_keys_to_the_added_node():
+    ring = HashRing(SERVERS)
+    bigger_ring = HashRing(SERVERS + ["metadata-3:6379"])
+    keys = ["document-{:d}".format(index) for index in xrange(3000)]
+    moved = [key for key in keys if ring.get_node(key) != bigger_ring.get_node(key)]
+    assert all(bigger_ring.get_node(key) == "metadata-3:6379" for key in moved)
+    assert 500 < len(moved) < 1000
+
+def test_create_files_with_a_single_server():
+    with mock.patch("socket.gethostbyname", return_value="127.0.0.1"):
+        assert isinstance(create_files({"servers": ["metadata:6379"]}), Files)
+        assert isinstance(create_files(), Files)
+        assert isinstance(create_files({"servers": SERVERS}), ShardedFiles)
+
+def test_sharded_files_stores_blocks_with_their_document():
+    files = get_me_sharded_files()
+    assert files.get_block_shard("document-00") is files.get_shard("document")
+
+def test_sharded_files_get_blocks(monkeypatch):
+    files = get_me_sharded_files()
+    keys = ["document-{:d}-00".format(index) for index in xrange(20)]
+    for shard in files.shards.values():
+        def fake_get_blocks(shard_keys, shard=shard):
+            assert all(files.get_block_shard(key) is shard for key in shard_keys)
+            return [MetaBlock(key) for key in shard_keys]
+        monkeypatch.setattr(shard, "get_blocks", fake_get_blocks)
+    assert [block.key for block in files.get_blocks(keys)] == sorted(keys)
+
+def test_sharded_files_keys_follow_the_global_order(monkeypatch):
+    files = get_me_sharded_files()
+    paths = ["document-{:d}".format(index) for index in xrange(250)]
+    for shard in files.shards.values():
+        index = [(path, float(score)) for score, path in enumerate(paths) if files.get_shard(path) is shard]
+        def fake_zrange(name, start, end, withscores=False, index=index):
+            assert name == "file_index" and withscores
+            return index[start:end + 1]
+        monkeypatch.setattr(shard.redis, "zrange", fake_zrange)
+    assert files.keys() == paths
+
+def test_sharded_files_iter_values_resumes_every_server_from_the_cursor(monkeypatch):
+    files = get_me_sharded_files()
+    paths = ["document-{:03d}".format(index) for index in xrange(250)]
+    for shard in files.shards.values():
+        index = [(path, float(score // 2)) for score, path in enumerate(paths)
+                 if files.get_shard(path) is shard]
+        def fake_zrangebyscore(name, minimum, maximum, start=None, num=None, withscores=False,
+                               index=index):
+            assert name == "file_index" and withscores
+            exclusive = str(minimum).startswith("(")
+            lowest = float(str(minimum).lstrip("("))
+            selected = [(path, score) for path, score in index
+                        if (score > lowest if exclusive else score >= lowest) and
+                        (maximum == "+inf" or score <= float(maximum))]
+            if start is not None:
+                assert start == 0
+                selected = selected[:num]
+            return selected
+        monkeypatch.setattr(shard.redis, "zrangebyscore", fake_zrangebyscore)
+    monkeypatch.setattr(files, "get_files",
+                        lambda names, skip_missing=False: [MetaDocument(name) for name in sorted(names)])
+    assert [document.path for document in files.iter_values()] == paths
+    page = list(files.iter_listing(limit=120))
+    assert [document.path for _, document in page] == paths[:120]
+    assert [document.path for document in files.iter_values(cursor=page[-1][0], limit=10)] == \
+           paths[120:130]
+
+def test_sharded_files_put_registers_pointers_on_the_shard_of_the_block(monkeypatch):
+    files = get_me_sharded_files()
+    pipelines = {}
+    for server, shard in files.shards.items():
+        shard.provider_ids = {"a": 1}
+        pipelines[server] = mock.MagicMock()
+        monkeypatch.setattr(shard.redis, "pipeline",
+                            lambda transaction=True, server=server: pipelines[server])
+    document = MetaDocument("document")
+    document.blocks = [MetaBlock("document-00", providers=["a"])]
+    pointers = [["other-{:d}".format(index), 0] for index in xrange(10)]
+    document.entangling_blocks = pointers
+    assert files.put("document", document) == "document"
+    home = files.ring.get_node("document")
+    pipelines[home].hmset.assert_any_call(Files.FILE_PREFIX + "document", mock.ANY)
+    for path, _ in pointers:
+        pointer_shard = files.ring.get_node(path)
+        pipelines[pointer_shard].sadd.assert_any_call(Files.POINTED_BY_PREFIX + path + "-00", "document")
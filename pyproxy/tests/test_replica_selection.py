@@ -0,0 +1,59 @@
+"""
+Unit tests for the replica_selection module
+"""
+import pytest
+
+import pyproxy.providers.replica_selection as replica_selection
+from pyproxy.providers.replica_selection import ProviderScores
+
+def test_provider_scores_raises_ValueError_if_alpha_is_out_of_range():
+    with pytest.raises(ValueError, match="alpha argument must be a number greater than 0 and lower or equal to 1"):
+        ProviderScores(alpha=0)
+    with pytest.raises(ValueError, match="alpha argument must be a number greater than 0 and lower or equal to 1"):
+        ProviderScores(alpha=1.5)
+
+def test_provider_scores_raises_ValueError_if_half_life_is_not_positive():
+    with pytest.raises(ValueError, match="half_life argument must be a number greater than 0"):
+        ProviderScores(half_life=0)
+
+def test_provider_scores_raises_ValueError_if_exploration_is_out_of_range():
+    with pytest.raises(ValueError, match="exploration argument must be a number between 0 and 1"):
+        ProviderScores(exploration=-0.1)
+
+def test_provider_scores_orders_providers_by_expected_latency():
+    scores = ProviderScores(exploration=0)
+    for _ in xrange(10):
+        scores.record("slow", 0.5)
+        scores.record("fast", 0.01)
+        scores.record("failing", 0.5, failed=True)
+    assert scores.order(["slow", "failing", "fast"]) == ["fast", "slow", "failing"]
+    assert scores.order(["slow", "new", "fast"]) == ["fast", "new", "slow"]
+
+def test_provider_scores_decay_towards_the_average(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(replica_selection.time, "time", lambda: now[0])
+    scores = ProviderScores(half_life=10, exploration=0)
+    scores.record("slow", 1.0)
+    scores.record("fast", 0.2)
+    scores.record("failing", 0.2, failed=True)
+    statistics = scores.statistics()
+    assert statistics["slow"]["latency"] > statistics["fast"]["latency"]
+    assert statistics["failing"]["error_rate"] == pytest.approx(0.2)
+    now[0] += 10
+    statistics = scores.statistics()
+    average = (1.0 + 0.2 + 0.2) / 3
+    assert statistics["slow"]["latency"] == pytest.approx(average + (1.0 - average) / 2)
+    assert statistics["failing"]["error_rate"] == pytest.approx(0.1)
+    now[0] += 1000
+    statistics = scores.statistics()
+    assert statistics["slow"]["latency"] == pytest.approx(statistics["fast"]["latency"])
+    assert statistics["slow"]["reads"] == 1
+    assert statistics["failing"]["errors"] == 1
+
+def test_provider_scores_explores_random_orders(monkeypatch):
+    scores = ProviderScores(exploration=1)
+    for _ in xrange(10):
+        scores.record("slow", 0.5)
+        scores.record("fast", 0.01)
+    orders = set(tuple(scores.order(["slow", "fast"])) for _ in xrange(100))
+    assert orders == {("slow", "fast"), ("fast", "slow")}
@@ -0,0 +1,139 @@
+"""
+Unit tests for the s3 module, run against an in-memory stand-in of an
+S3-compatible server
+"""
+import hashlib
+import re
+import StringIO
+import threading
+
+import boto3
+import botocore.exceptions
+import pytest
+
+from pyproxy.providers.s3 import S3Provider
+
+def client_error(code, operation):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+class FakeS3(object):
+    """
+    Implements the subset of the S3 API used by the provider the way MinIO
+    does, including ranges and multipart uploads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.requests = []
+
+    def list_buckets(self):
+        return {"Buckets": [{"Name": name} for name in self.buckets]}
+
+    def create_bucket(self, Bucket):
+        self.buckets[Bucket] = {}
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.requests.append(("put_object", Key))
+        self.buckets[Bucket][Key] = str(Body)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        with self.lock:
+            self.requests.append(("get_object", Key, Range))
+        if Key not in self.buckets[Bucket]:
+            raise client_error("NoSuchKey", "GetObject")
+        data = self.buckets[Bucket][Key]
+        etag = '"{:s}"'.format(hashlib.md5(data).hexdigest())
+        if IfMatch is not None and IfMatch != etag:
+            raise client_error("PreconditionFailed", "GetObject")
+        response = {"ETag": etag}
+        if Range is not None:
+            start, end = [int(bound) for bound in re.match(r"^bytes=(\d+)-(\d+)$", Range).groups()]
+            if start >= len(data):
+                raise client_error("InvalidRange", "GetObject")
+            end = min(end, len(data) - 1)
+            response["ContentRange"] = "bytes {:d}-{:d}/{:d}".format(start, end, len(data))
+            data = data[start:end + 1]
+        response["Body"] = StringIO.StringIO(data)
+        return response
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self.lock:
+            upload_id = str(len(self.uploads))
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.requests.append(("upload_part", Key, PartNumber))
+            self.uploads[UploadId][PartNumber] = str(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.buckets[Bucket][Key] = "".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+
+@pytest.fixture
+def server(monkeypatch):
+    fake = FakeS3()
+    clients = []
+    def create_client(*args, **kwargs):
+        clients.append(kwargs)
+        return fake
+    monkeypatch.setattr(boto3, "client", create_client)
+    fake.clients = clients
+    return fake
+
+def test_s3_provider_raises_ValueError_if_the_transfer_settings_are_invalid(server):
+    with pytest.raises(ValueError, match="max_pool_connections argument must be an integer greater than 0"):
+        S3Provider(max_pool_connections=0)
+    with pytest.raises(ValueError, match="part_size argument must be an integer greater or equal to"):
+        S3Provider(part_size=1024)
+    with pytest.raises(ValueError, match="range_size argument must be an integer greater or equal to 0"):
+        S3Provider(range_size=-1)
+
+def test_s3_provider_sizes_the_connection_pool(server):
+    S3Provider(max_pool_connections=12)
+    assert server.clients[-1]["config"].max_pool_connections == 12
+
+def test_s3_provider_uploads_large_blocks_in_parts(server):
+    provider = S3Provider(multipart_threshold=1024, part_size=S3Provider.MINIMUM_PART_SIZE)
+    data = "0123456789" * (2 * S3Provider.MINIMUM_PART_SIZE / 10 + 1)
+    provider.put(data, "large-00")
+    provider.put("small", "small-00")
+    assert sorted(request[2] for request in server.requests if request[0] == "upload_part") == [1, 2, 3]
+    assert ("put_object", "small-00") in server.requests
+    assert server.buckets["playcloud"]["large-00"] == data
+    assert not server.uploads
+
+def test_s3_provider_aborts_failed_multipart_uploads(server, monkeypatch):
+    provider = S3Provider(multipart_threshold=1024, part_size=S3Provider.MINIMUM_PART_SIZE)
+    def fail(**kwargs):
+        raise client_error("InternalError", "UploadPart")
+    monkeypatch.setattr(server, "upload_part", fail)
+    with pytest.raises(botocore.exceptions.ClientError):
+        provider.put("a" * (S3Provider.MINIMUM_PART_SIZE + 1), "large-00")
+    assert not server.uploads
+    assert "large-00" not in server.buckets["playcloud"]
+
+def test_s3_provider_reads_large_blocks_by_ranges(server):
+    provider = S3Provider(range_size=4)
+    server.buckets["playcloud"].update({"block-00": "0123456789", "empty-00": "", "small-00": "abc"})
+    assert provider.get("block-00") == "0123456789"
+    assert sorted(request[2] for request in server.requests if request[1] == "block-00") == \
+           ["bytes=0-3", "bytes=4-7", "bytes=8-9"]
+    assert provider.get("small-00") == "abc"
+    assert provider.get("empty-00") == ""
+    assert provider.get_many(["missing", "small-00"]) == [None, "abc"]
+
+def test_s3_provider_reads_the_header_of_a_block(server):
+    provider = S3Provider()
+    server.buckets["playcloud"]["block-00"] = "header" + chr(29) + "data"
+    assert provider.get_range("block-00", 0, 6) == "header"
+    assert provider.get_range("block-00", 7, 100) == "data"
+    with pytest.raises(ValueError, match="length argument must be an integer greater than 0"):
+        provider.get_range("block-00", 0, 0)
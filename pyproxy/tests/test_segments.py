@@ -0,0 +1,115 @@
+"""
+Unit tests for the segments module
+"""
+import os
+
+import pytest
+
+from pyproxy.providers.segments import SegmentStore
+
+def list_segments(folder):
+    return sorted(entry for entry in os.listdir(str(folder)) if entry.endswith(".log"))
+
+def test_segment_store_raises_ValueError_if_arguments_are_invalid(tmpdir):
+    with pytest.raises(ValueError, match="segment_size argument must be an integer greater than 0"):
+        SegmentStore(str(tmpdir), segment_size=0)
+    with pytest.raises(ValueError, match="compaction_threshold argument must be a number greater than 0"):
+        SegmentStore(str(tmpdir), compaction_threshold=0)
+
+def test_segment_store_appends_blocks_to_segments(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=64)
+    for index in xrange(10):
+        store.put("data-{:d}".format(index) * 4, "key-{:d}".format(index))
+    store.put("overwritten", "key-3")
+    assert store.get("key-3") == "overwritten"
+    assert store.get("key-7") == "data-7" * 4
+    assert store.get("missing") is None
+    assert store.delete("key-7")
+    assert not store.delete("key-7")
+    assert store.get("key-7") is None
+    assert len(list_segments(tmpdir)) > 1
+    assert store.clear()
+    assert os.listdir(str(tmpdir)) == []
+    assert store.get("key-1") is None
+
+def test_segment_store_recovers_the_blocks_from_the_segments(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=64)
+    store.start_compacting = lambda: None
+    for index in xrange(10):
+        store.put("data-{:d}".format(index) * 4, "key-{:d}".format(index))
+    store.delete("key-2")
+    store.put("overwritten", "key-5")
+    recovered = SegmentStore(str(tmpdir), segment_size=64)
+    assert recovered.get("key-2") is None
+    assert recovered.get("key-5") == "overwritten"
+    for index in [0, 1, 3, 4, 6, 7, 8, 9]:
+        assert recovered.get("key-{:d}".format(index)) == "data-{:d}".format(index) * 4
+
+def test_segment_store_truncates_the_torn_records_of_the_last_segment(tmpdir):
+    store = SegmentStore(str(tmpdir))
+    store.put("first", "key-1")
+    store.put("second", "key-2")
+    path = os.path.join(str(tmpdir), list_segments(tmpdir)[-1])
+    size = os.path.getsize(path)
+    with open(path, "r+b") as handle:
+        handle.truncate(size - 3)
+    recovered = SegmentStore(str(tmpdir))
+    assert recovered.get("key-1") == "first"
+    assert recovered.get("key-2") is None
+    recovered.put("third", "key-3")
+    assert SegmentStore(str(tmpdir)).get("key-3") == "third"
+
+def test_segment_store_compacts_the_segments_with_dead_blocks(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=256, compaction_threshold=0.5)
+    store.start_compacting = lambda: None
+    for index in xrange(20):
+        store.put("data-{:d}".format(index) * 4, "key-{:d}".format(index))
+    first_segment = list_segments(tmpdir)[0]
+    for index in xrange(0, 20, 2):
+        store.delete("key-{:d}".format(index))
+    assert store.compact() > 0
+    assert first_segment not in list_segments(tmpdir)
+    for index in xrange(20):
+        expected = None if index % 2 == 0 else "data-{:d}".format(index) * 4
+        assert store.get("key-{:d}".format(index)) == expected
+    recovered = SegmentStore(str(tmpdir), segment_size=256)
+    for index in xrange(20):
+        expected = None if index % 2 == 0 else "data-{:d}".format(index) * 4
+        assert recovered.get("key-{:d}".format(index)) == expected
+
+def test_segment_store_serves_the_blocks_moved_during_a_compaction(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=256, compaction_threshold=0.5)
+    store.start_compacting = lambda: None
+    for index in xrange(20):
+        store.put("data-{:d}".format(index) * 4, "key-{:d}".format(index))
+    for index in xrange(0, 20, 2):
+        store.delete("key-{:d}".format(index))
+    load_index = store._SegmentStore__load_index
+    reads = []
+    def load_index_reading_the_moved_blocks(segment):
+        entries = load_index(segment)
+        for position, entry in enumerate(entries):
+            yield entry
+            # The previous entries of the segment were copied to the active segment
+            for _, key, _, _ in entries[:position + 1]:
+                reads.append((key, store.get(key)))
+            # A concurrent compaction skips the segment being compacted
+            assert store._SegmentStore__compact(segment) is False
+    store._SegmentStore__load_index = load_index_reading_the_moved_blocks
+    assert store.compact() > 0
+    assert reads
+    for key, data in reads:
+        index = int(key.split("-")[1])
+        assert data == (None if index % 2 == 0 else "data-{:d}".format(index) * 4)
+
+def test_segment_store_maps_the_sealed_segments(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=64, memory_map=True)
+    store.start_compacting = lambda: None
+    store.put("sealed" * 12, "key-1")
+    store.put("active", "key-2")
+    sealed = store.get("key-1")
+    assert isinstance(sealed, buffer)
+    assert str(sealed) == "sealed" * 12
+    assert store.get("key-2") == "active"
+    store.compact()
+    assert str(sealed) == "sealed" * 12
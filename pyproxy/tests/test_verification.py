@@ -0,0 +1,65 @@
+"""
+Unit tests for the verification module
+"""
+import hashlib
+import os
+import zlib
+
+import mock
+import pytest
+
+from pyproxy.metadata import MetaBlock
+import pyproxy.providers.verification as verification
+from pyproxy.providers.verification import BlockVerifier, VerificationMode
+
+DATA = os.urandom(3 * verification.CHUNK_SIZE + 17)
+
+def get_me_a_metablock(data=DATA):
+    return MetaBlock("hello-00", checksum=hashlib.sha256(data).digest(), size=len(data),
+                     fast_checksum=verification.compute_fast_checksum(data))
+
+def test_compute_fast_checksum_matches_the_crc32_of_the_data():
+    assert verification.compute_fast_checksum(DATA) == zlib.crc32(DATA) & 0xffffffff
+    assert verification.compute_fast_checksum("") == 0
+
+def test_block_verifier_raises_ValueError_if_arguments_are_invalid():
+    with pytest.raises(ValueError, match="mode argument must be a VerificationMode"):
+        BlockVerifier(mode="always")
+    with pytest.raises(ValueError, match="sample_rate argument must be a number between 0 and 1"):
+        BlockVerifier(sample_rate=1.5)
+
+def test_block_verifier_always_checks_the_checksum():
+    verifier = BlockVerifier()
+    metablock = get_me_a_metablock()
+    assert verifier.verify(DATA, metablock)
+    assert not verifier.verify(DATA[1:] + DATA[:1], metablock)
+    statistics = verifier.statistics()
+    assert statistics["mode"] == "ALWAYS"
+    assert statistics["checksums"] == 2
+    assert statistics["mismatches"] == 1
+
+def test_block_verifier_checks_the_fast_checksum_if_the_metablock_has_one():
+    verifier = BlockVerifier(mode=VerificationMode.FAST)
+    metablock = get_me_a_metablock()
+    with mock.patch.object(verification, "compute_checksum") as compute_checksum:
+        assert verifier.verify(DATA, metablock)
+        assert not verifier.verify(DATA[1:] + DATA[:1], metablock)
+    compute_checksum.assert_not_called()
+    metablock.fast_checksum = None
+    assert verifier.verify(DATA, metablock)
+    statistics = verifier.statistics()
+    assert statistics["fast_checksums"] == 2
+    assert statistics["checksums"] == 1
+
+def test_block_verifier_only_checks_the_size_of_the_replicas_that_are_not_sampled(monkeypatch):
+    verifier = BlockVerifier(mode=VerificationMode.SAMPLED, sample_rate=0.1)
+    metablock = get_me_a_metablock()
+    monkeypatch.setattr(verification.random, "random", lambda: 0.5)
+    assert verifier.verify("\x00" * len(DATA), metablock)
+    assert not verifier.verify(DATA[1:], metablock)
+    monkeypatch.setattr(verification.random, "random", lambda: 0.05)
+    assert not verifier.verify("\x00" * len(DATA), metablock)
+    statistics = verifier.statistics()
+    assert statistics["skipped"] == 2
+    assert statistics["checksums"] == 1
+    assert statistics["mismatches"] == 2
@@ -0,0 +1,107 @@
+"""
+Unit tests for the write_quorum module
+"""
+import concurrent.futures
+import mock
+import pytest
+
+from pyproxy.metadata import MetaBlock, MetaDocument
+from pyproxy.providers.io_pool import resolved
+from pyproxy.providers.write_quorum import QuorumWrite, WriteStatistics
+
+def failed(message="failed"):
+    future = concurrent.futures.Future()
+    future.set_exception(IOError(message))
+    return future
+
+def get_me_a_write(write_quorum=2, files=None, schedule=None):
+    metablocks = {index: MetaBlock("document-{:02d}".format(index), providers=[]) for index in xrange(2)}
+    replicas = {index: ["a", "b", "c"] for index in metablocks}
+    return QuorumWrite(MetaDocument("document"), metablocks, replicas, write_quorum,
+                       files or mock.MagicMock(), WriteStatistics(), schedule or mock.MagicMock())
+
+def test_quorum_write_completes_once_every_block_reached_its_quorum():
+    write = get_me_a_write()
+    write.confirm(0, "a", resolved(True))
+    write.confirm(0, "b", resolved(True))
+    write.confirm(1, "a", resolved(True))
+    assert not write.future.done()
+    write.confirm(1, "c", resolved(True))
+    document = write.future.result(timeout=1)
+    assert [block.providers for block in document.blocks] == [["a", "b"], ["a", "c"]]
+    assert write.statistics.statistics()["pending_background_replicas"] == 2
+
+def test_quorum_write_adds_the_background_replicas_to_the_metadata():
+    files = mock.MagicMock()
+    write = get_me_a_write(write_quorum=1, files=files)
+    write.confirm(0, "a", resolved(True))
+    write.confirm(1, "b", resolved(True))
+    assert write.future.done()
+    document = write.future.result(timeout=1)
+    write.confirm(0, "c", resolved(True))
+    files.add_block_providers.assert_called_once_with("document-00", ["c"])
+    assert [block.providers for block in document.blocks] == [["a"], ["b"]]
+    statistics = write.statistics.statistics()
+    assert statistics["background_replicas"] == 1
+    assert statistics["pending_background_replicas"] == 3
+
+def test_quorum_write_retries_the_metadata_updates():
+    files = mock.MagicMock()
+    files.add_block_providers.side_effect = [IOError("metadata server is down"), None]
+    scheduled = []
+    write = get_me_a_write(write_quorum=1, files=files,
+                           schedule=lambda delay, function: scheduled.append(function))
+    write.confirm(0, "a", resolved(True))
+    write.confirm(1, "a", resolved(True))
+    write.confirm(0, "b", resolved(True))
+    assert len(scheduled) == 1
+    scheduled[0]()
+    assert files.add_block_providers.call_count == 2
+    assert write.statistics.statistics()["retries"] == 1
+
+def test_quorum_write_surfaces_the_metadata_updates_that_keep_failing():
+    files = mock.MagicMock()
+    files.add_block_providers.side_effect = IOError("metadata server is down")
+    write = get_me_a_write(write_quorum=1, files=files, schedule=lambda delay, function: function())
+    write.confirm(0, "a", resolved(True))
+    write.confirm(1, "a", resolved(True))
+    write.confirm(0, "b", resolved(True))
+    assert files.add_block_providers.call_count == QuorumWrite.RETRIES + 1
+    statistics = write.statistics.statistics()
+    assert statistics["failed_metadata_updates"] == 1
+    assert "document-00" in statistics["recent_failures"][0]
+
+def test_quorum_write_fails_as_soon_as_a_block_cannot_reach_its_quorum():
+    write = get_me_a_write()
+    write.confirm(0, "a", failed())
+    assert not write.future.done()
+    write.confirm(0, "b", failed())
+    with pytest.raises(RuntimeError, match="Could not store block document-00 on 2 providers"):
+        write.future.result(timeout=1)
+    statistics = write.statistics.statistics()
+    assert statistics["failed_writes"] == 1
+    assert statistics["failed_replicas"] == 2
+
+def test_quorum_write_surfaces_the_background_replicas_that_failed():
+    write = get_me_a_write()
+    for index in xrange(2):
+        write.confirm(index, "a", resolved(True))
+        write.confirm(index, "b", resolved(True))
+    write.confirm(1, "c", failed("disk full"))
+    assert write.future.result(timeout=1).blocks[1].providers == ["a", "b"]
+    statistics = write.statistics.statistics()
+    assert statistics["failed_replicas"] == 1
+    assert "disk full" in statistics["recent_failures"][0]
+
+def test_quorum_write_fails_immediately_if_a_block_has_fewer_replicas_than_the_quorum():
+    metablocks = {0: MetaBlock("document-00", providers=[])}
+    write = QuorumWrite(MetaDocument("document"), metablocks, {0: ["a"]}, 2,
+                        mock.MagicMock(), WriteStatistics(), mock.MagicMock())
+    with pytest.raises(RuntimeError, match="Could not store block document-00 on 2 providers"):
+        write.future.result(timeout=1)
+    write.confirm(0, "a", resolved(True))
+    assert write.statistics.statistics()["failed_writes"] == 1
+
+def test_quorum_write_without_blocks_completes_immediately():
+    write = QuorumWrite(MetaDocument("document"), {}, {}, 2, mock.MagicMock(), WriteStatistics(), mock.MagicMock())
+    assert write.future.result(timeout=1).blocks == []
@@ -144,9 +144,16 @@ def create_dispatcher_configuration(configuration):
         for index in range(1, nodes + 1):
             name = "storage-node-{:d}".format(index)
             dispatcher_configuration["providers"][name] = make_node(name)
+    if configuration["storage"].get("cached", False):
+        for node in dispatcher_configuration["providers"].values():
+            node["cached"] = True
     replication_factor = int(configuration["storage"].get("replication_factor", 3))
     dispatcher_configuration["replication_factor"] = replication_factor
+    write_quorum = int(configuration["storage"].get("write_quorum", replication_factor))
+    dispatcher_configuration["write_quorum"] = write_quorum
     dispatcher_configuration["entanglement"] = configuration.get("entanglement", {})
+    dispatcher_configuration["metadata"] = configuration.get("metadata", {})
+    dispatcher_configuration["io"] = configuration.get("io", {})
     return dispatcher_configuration
 
 